@@ -0,0 +1,167 @@
+import time
+import argparse
+import numpy as np
+
+from backends import BACKENDS, available_backends, volume_class
+
+
+# Times the fusion backends on a synthetic scene: a box room with a few boxes
+# on its floor, rendered from random cameras inside of it with random labels
+# and colors. Every backend fuses the same frames into TSDFVolume with
+# fuse_labels and into ColorSDFVolume with fuse, and its volumes are compared
+# to the ones of the first backend.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", nargs="+", choices=list(BACKENDS))
+    parser.add_argument("--resolution", type=float, default=0.05)
+    parser.add_argument("--resolution_factor", type=int, default=2)
+    parser.add_argument("--num_labels", type=int, default=20)
+    parser.add_argument("--num_frames", type=int, default=10)
+    parser.add_argument("--height", type=int, default=240)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--num_threads", type=int, default=1)
+    # The number of z slices that the numpy backend fuses at a time.
+    parser.add_argument("--slab_size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def render_scene(num_frames, height, width, num_labels, seed):
+    # Renders the z-depth of a 6 x 5 x 3 m room analytically by intersecting
+    # the camera rays with its walls and boxes. Returns the bounding box of
+    # the room and the depth and projection matrix, the depth map, the label
+    # map and the color map of every frame.
+    rng = np.random.RandomState(seed)
+    room_min = np.array([0, 0, 0], dtype=np.float64)
+    room_max = np.array([6, 5, 3], dtype=np.float64)
+    box_min = rng.uniform([0.5, 0.5, 0], [5, 4, 0.5], size=(6, 3))
+    box_max = box_min + rng.uniform([0.3, 0.3, 0.4], [1.2, 1.2, 1.5],
+                                    size=(6, 3))
+    bbox = np.stack([room_min, room_max], 1).astype(np.float32)
+
+    focal_length = 525.0 * width / 640
+    intrinsics = np.array([[focal_length, 0, width / 2],
+                           [0, focal_length, height / 2],
+                           [0, 0, 1]])
+    pixel_y, pixel_x = np.mgrid[:height, :width]
+    # The camera rays, scaled to a unit z component in camera coordinates.
+    rays = np.stack([(pixel_x - width / 2) / focal_length,
+                     (pixel_y - height / 2) / focal_length,
+                     np.ones((height, width))], -1)
+    surface_colors = rng.randint(0, 256, size=(2 * 3 + len(box_min), 3))
+
+    frames = []
+    for _ in range(num_frames):
+        center = rng.uniform([1.5, 1.5, 1.2], [4.5, 3.5, 1.8])
+        yaw = rng.uniform(0, 2 * np.pi)
+        pitch = rng.uniform(-0.3, 0.1)
+        forward = np.array([np.cos(yaw) * np.cos(pitch),
+                            np.sin(yaw) * np.cos(pitch), np.sin(pitch)])
+        right = np.cross(forward, [0, 0, 1])
+        right /= np.linalg.norm(right)
+        down = np.cross(forward, right)
+        rotation = np.stack([right, down, forward])
+        directions = rays @ rotation
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # The walls of the room, which enclose the camera.
+            distances = np.stack([(room_min - center) / directions,
+                                  (room_max - center) / directions], -1)
+            distances = np.where(distances > 0, distances, np.inf)
+            distances = distances.reshape(height, width, -1)
+            depth = distances.min(-1)
+            surface = distances.argmin(-1)
+            for i in range(len(box_min)):
+                near = np.minimum((box_min[i] - center) / directions,
+                                  (box_max[i] - center) / directions).max(-1)
+                far = np.maximum((box_min[i] - center) / directions,
+                                 (box_max[i] - center) / directions).min(-1)
+                hit = (near <= far) & (near > 0) & (near < depth)
+                depth[hit] = near[hit]
+                surface[hit] = 2 * 3 + i
+
+        # Missing depth measurements.
+        depth[rng.rand(height, width) < 0.01] = 0
+
+        extrinsics = np.eye(4)
+        extrinsics[:3, :3] = rotation
+        extrinsics[:3, 3] = -rotation @ center
+        proj_matrix = (intrinsics @ extrinsics[:3]).astype(np.float32)
+        label_map = (surface % num_labels).astype(np.int32)
+        noise = rng.randint(-8, 9, size=(height, width, 3))
+        color_map = np.clip(surface_colors[surface] + noise, 0, 255)
+
+        frames.append({
+            "proj_matrix": proj_matrix,
+            "depth_map": depth.astype(np.float32),
+            "label_map": label_map,
+            "color_map": color_map.astype(np.uint8),
+        })
+
+    return bbox, frames
+
+
+def fuse_frames(volume, frames, fuse_frame):
+    # Fuses every frame and returns the elapsed time in seconds.
+    start = time.perf_counter()
+    for frame in frames:
+        fuse_frame(volume, frame)
+    return time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+
+    bbox, frames = render_scene(args.num_frames, args.height, args.width,
+                                args.num_labels, args.seed)
+
+    tasks = [
+        ("TSDFVolume",
+         lambda cls, kwargs: cls(args.num_labels, bbox, args.resolution,
+                                 args.resolution_factor, **kwargs),
+         lambda volume, frame: volume.fuse_labels(
+             frame["proj_matrix"], frame["proj_matrix"], frame["depth_map"],
+             frame["label_map"], num_threads=args.num_threads),
+         lambda volume: [volume.get_volume(copy=False)]),
+        ("ColorSDFVolume",
+         lambda cls, kwargs: cls(bbox, args.resolution,
+                                 args.resolution_factor, **kwargs),
+         lambda volume, frame: volume.fuse(
+             frame["proj_matrix"], frame["proj_matrix"], frame["depth_map"],
+             frame["color_map"], num_threads=args.num_threads),
+         lambda volume: [volume.get_volume(copy=False),
+                         volume.get_sdf_weight_data(copy=False),
+                         volume.get_color_weight_data(copy=False)]),
+    ]
+
+    for name, create_volume, fuse_frame, volume_arrays in tasks:
+        backends = args.backends or available_backends(name)
+        reference = None
+        for backend in backends:
+            kwargs = {}
+            if backend == "numpy":
+                kwargs["slab_size"] = args.slab_size
+            volume = create_volume(volume_class(name, backend), kwargs)
+            num_voxels = np.prod(
+                np.asarray(volume_arrays(volume)[0]).shape[:3])
+
+            elapsed = fuse_frames(volume, frames, fuse_frame)
+
+            arrays = [np.asarray(array) for array in volume_arrays(volume)]
+            if reference is None:
+                reference = arrays
+                difference = "reference"
+            else:
+                difference = "max difference {:g}".format(max(
+                    np.abs(array - reference_array).max()
+                    for array, reference_array in zip(arrays, reference)))
+
+            print("{} {}: {:.2f} frames/s, {:.1f} Mvoxels/s, {}".format(
+                name, backend, len(frames) / elapsed,
+                len(frames) * num_voxels / elapsed / 1e6, difference))
+
+
+if __name__ == "__main__":
+    main()
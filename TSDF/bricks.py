@@ -0,0 +1,36 @@
+import numpy as np
+
+
+def morton_order(block_table_shape):
+    # The coordinates of all blocks of a block table sorted by their Morton
+    # code, which interleaves the bits of (bi, bj, bk), so that blocks that
+    # are close in the volume are close in the order.
+    block_coords = np.indices(block_table_shape).reshape(3, -1).T
+    codes = np.zeros(len(block_coords), dtype=np.int64)
+    num_bits = int(max(block_table_shape) - 1).bit_length()
+    for bit in range(num_bits):
+        for axis in range(3):
+            codes |= ((block_coords[:, axis] >> bit) & 1) << \
+                (3 * bit + 2 - axis)
+    return block_coords[np.argsort(codes, kind="stable")].astype(np.int32)
+
+
+def bricks_to_dense(bricks, block_table, volume_shape):
+    # The dense [X, Y, Z, ...] volume of a pool of (num_blocks, B, B, B, ...)
+    # bricks in which every block of the block table is allocated. The bricks
+    # are gathered one block column at a time into the blocked view of the
+    # dense volume, which is then cropped to the volume shape without a copy.
+    block_size = bricks.shape[1]
+    table_shape = block_table.shape
+    channel_shape = bricks.shape[4:]
+    volume = np.empty((table_shape[0], block_size, table_shape[1], block_size,
+                       table_shape[2], block_size) + channel_shape,
+                      dtype=bricks.dtype)
+    blocked_view = volume.transpose((0, 2, 4, 1, 3, 5) +
+                                    tuple(range(6, volume.ndim)))
+    for bi in range(table_shape[0]):
+        for bj in range(table_shape[1]):
+            blocked_view[bi, bj] = bricks[block_table[bi, bj]]
+    volume = volume.reshape(tuple(s * block_size for s in table_shape) +
+                            channel_shape)
+    return volume[:volume_shape[0], :volume_shape[1], :volume_shape[2]]
@@ -0,0 +1,172 @@
+import os
+import glob
+import argparse
+import numpy as np
+
+from tsdf_volume import TSDFVolume
+from tsdf_fusion import read_labels, refuse_image
+from prefetch import load_npz
+
+
+# Checks the column-incremental projection of the fusion kernels against a
+# NumPy reference, which projects every voxel with the full matrix product
+# m[r, 0] * x + m[r, 1] * y + m[r, 2] * z + m[r, 3] in float32. For every
+# frame, the correspondences returned by TSDFVolume.project must equal the
+# reference ones, and the votes fused by TSDFVolume.fuse or fuse_labels must
+# equal the votes of the reference correspondences.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_path", required=True)
+    parser.add_argument("--frame_rate", type=int, default=1)
+    parser.add_argument("--num_frames", type=int, default=10)
+    parser.add_argument("--resolution", type=float, default=0.05)
+    parser.add_argument("--resolution_factor", type=int, default=2)
+    parser.add_argument("--num_threads", type=int, default=1)
+    return parser.parse_args()
+
+
+def round_half_away(values):
+    # libc round of a float32 value.
+    values = values.astype(np.float64)
+    return np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+
+def project_pixels(proj_matrix, x, y, z, height, width):
+    # The projection of the voxel centers into an image of the given size,
+    # the sums are evaluated in the same order as by the kernels. Returns the
+    # mask of the voxels in front of the camera and inside of the image, their
+    # pixel locations and their depths.
+    proj = [proj_matrix[r, 0] * x + proj_matrix[r, 1] * y +
+            proj_matrix[r, 2] * z + proj_matrix[r, 3] for r in range(3)]
+    valid = proj[2] > 0
+    proj_z = np.where(valid, proj[2], np.float32(1))
+    pixel_x = round_half_away(proj[0] / proj_z)
+    pixel_y = round_half_away(proj[1] / proj_z)
+    valid &= (pixel_x >= 0) & (pixel_y >= 0) & \
+        (pixel_x < width) & (pixel_y < height)
+    pixel_x = np.where(valid, pixel_x, 0).astype(np.int64)
+    pixel_y = np.where(valid, pixel_y, 0).astype(np.int64)
+    return valid, pixel_x, pixel_y, proj[2]
+
+
+def reference_correspondences(bbox, volume_shape, resolution, max_distance,
+                              depth_proj_matrix, label_proj_matrix,
+                              depth_map, label_height, label_width):
+    # Same as TSDFVolume.project without applying the free space votes.
+    grid = [bbox[d, 0] + np.arange(volume_shape[d]).astype(np.float32) *
+            resolution for d in range(3)]
+    y, z = np.meshgrid(grid[1], grid[2], indexing="ij")
+
+    voxel_indices = []
+    pixel_indices = []
+    behind = []
+    for i, x in enumerate(grid[0]):
+        x = np.full_like(y, x)
+        depth_valid, depth_x, depth_y, depth_z = project_pixels(
+            depth_proj_matrix, x, y, z, depth_map.shape[0], depth_map.shape[1])
+        label_valid, label_x, label_y, _ = project_pixels(
+            label_proj_matrix, x, y, z, label_height, label_width)
+        valid = depth_valid & label_valid
+        signed_distance = depth_map[depth_y, depth_x] - depth_z
+
+        free = valid & (signed_distance > max_distance)
+        band = valid & (np.abs(signed_distance) <= max_distance)
+        voxels = np.flatnonzero(free | band)
+        pixels = np.where(band, label_y * label_width + label_x, -1)
+
+        voxel_indices.append(i * y.size + voxels)
+        pixel_indices.append(pixels.ravel()[voxels])
+        behind.append((band & (signed_distance < 0)).ravel()[voxels])
+
+    return (np.concatenate(voxel_indices).astype(np.int32),
+            np.concatenate(pixel_indices).astype(np.int32),
+            np.concatenate(behind).astype(np.uint8))
+
+
+def sort_correspondences(voxel_indices, pixel_indices, behind):
+    order = np.argsort(voxel_indices, kind="stable")
+    return voxel_indices[order], pixel_indices[order], behind[order]
+
+
+def main():
+    args = parse_args()
+
+    bbox = np.loadtxt(os.path.join(args.input_path, "bbox.txt"))
+    num_labels, unknown_label = read_labels(args.input_path)
+
+    # The kernel volume is fused with fuse or fuse_labels and the reference
+    # volume with the reference correspondences of every frame.
+    tsdf_volume = TSDFVolume(num_labels, bbox, args.resolution,
+                             args.resolution_factor)
+    reference_volume = TSDFVolume(num_labels, bbox, args.resolution,
+                                  args.resolution_factor)
+    projection_volume = TSDFVolume(num_labels, bbox, args.resolution,
+                                   args.resolution_factor)
+    volume_shape = tsdf_volume.get_volume().shape
+    resolution = np.float32(args.resolution)
+    max_distance = np.float32(args.resolution * args.resolution_factor)
+    bbox = bbox.astype(np.float32)
+
+    image_paths = sorted(glob.glob(os.path.join(args.input_path,
+                                                "images/*.npz")))
+    image_paths = image_paths[::args.frame_rate][:args.num_frames]
+
+    num_failed = 0
+    for i, image_path in enumerate(image_paths):
+        image = load_npz(image_path)
+        if "label_proj_matrix" not in image:
+            print("Skipping registered image {}".format(
+                  os.path.basename(image_path)))
+            continue
+
+        depth_proj_matrix = image["depth_proj_matrix"].astype(np.float32)
+        label_proj_matrix = image["label_proj_matrix"].astype(np.float32)
+        depth_map = image["depth_map"].astype(np.float32)
+        label_map = image["label_map"]
+        if label_map.dtype != np.int32:
+            label_map = label_map.astype(np.float32)
+
+        reference = sort_correspondences(*reference_correspondences(
+            bbox, volume_shape, resolution, max_distance, depth_proj_matrix,
+            label_proj_matrix, depth_map, label_map.shape[0],
+            label_map.shape[1]))
+        kernel = sort_correspondences(*projection_volume.project(
+            depth_proj_matrix, label_proj_matrix, depth_map,
+            label_map.shape[0], label_map.shape[1], apply_free_space=False,
+            num_threads=args.num_threads))
+
+        if len(kernel[0]) == len(reference[0]):
+            num_different = int(np.sum((kernel[0] != reference[0]) |
+                                       (kernel[1] != reference[1]) |
+                                       (kernel[2] != reference[2])))
+        else:
+            num_different = len(np.setxor1d(kernel[0], reference[0]))
+
+        if label_map.dtype == np.int32:
+            tsdf_volume.fuse_labels(depth_proj_matrix, label_proj_matrix,
+                                    depth_map, label_map,
+                                    unknown_label=unknown_label,
+                                    num_threads=args.num_threads)
+        else:
+            tsdf_volume.fuse(depth_proj_matrix, label_proj_matrix, depth_map,
+                             label_map, num_threads=args.num_threads)
+        refuse_image(reference_volume, *reference, label_map, unknown_label,
+                     args.num_threads)
+        volume_difference = np.abs(tsdf_volume.get_volume() -
+                                   reference_volume.get_volume())
+
+        print("{} [{}/{}]: {} correspondences, {} different, "
+              "max volume difference {}".format(
+                  os.path.basename(image_path), i + 1, len(image_paths),
+                  len(reference[0]), num_different, volume_difference.max()))
+        if num_different > 0 or volume_difference.max() > 0:
+            num_failed += 1
+
+    print("{} of {} frames differ from the reference".format(
+          num_failed, len(image_paths)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import os
+import concurrent.futures
+import numpy as np
+
+
+def checkpoint_path(output_path):
+    return output_path + ".checkpoint.npz"
+
+
+def save_checkpoint(path, arrays):
+    # Write to a temporary file first, so that a run killed while writing
+    # leaves the previous checkpoint intact.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fid:
+        np.savez(fid, **arrays)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def remove_checkpoint(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class CheckpointWriter:
+
+    # Writes checkpoints in a background thread, so that fusion continues
+    # while they are written. The arrays have to be snapshots, i.e. copies
+    # that are not modified by the following frames. At most one checkpoint
+    # is written at a time, a new one waits for the previous one.
+
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.future = None
+
+    def write(self, path, arrays):
+        self.wait()
+        self.future = self.executor.submit(save_checkpoint, path, arrays)
+
+    def wait(self):
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
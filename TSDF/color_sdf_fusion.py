@@ -3,7 +3,13 @@ import glob
 import argparse
 import numpy as np
 
-from color_sdf_volume import ColorSDFVolume
+from backends import BACKENDS, volume_class
+from prefetch import load_npz, prefetch
+from checkpoint import CheckpointWriter, checkpoint_path, load_checkpoint, \
+    remove_checkpoint
+from snapshot import parse_snapshots, save_snapshot
+from memmap_volume import weight_path
+from registration import is_registered
 
 
 def parse_args():
@@ -13,7 +19,68 @@ def parse_args():
     parser.add_argument("--frame_rate", type=int, default=1)
     parser.add_argument("--resolution", type=float, default=0.05)
     parser.add_argument("--resolution_factor", type=int, default=2)
-    return parser.parse_args()
+    parser.add_argument("--num_threads", type=int, default=1)
+    # The fusion backend, auto uses the compiled kernels if they can be
+    # imported and the NumPy engine otherwise, see backends.py.
+    parser.add_argument("--backend", choices=["auto"] + list(BACKENDS),
+                        default="auto")
+    # uint8 colors, float16 sdf and uint16 weights, see precision.pxd for the
+    # error bounds.
+    parser.add_argument("--precision", choices=("full", "reduced"),
+                        default="full")
+    # Allocate the voxels in BLOCK_SIZE^3 blocks in Morton order, which are
+    # fused block by block.
+    parser.add_argument("--bricked", action="store_true")
+    # Fuse the volume in place into a memory-mapped OUTPUT_PATH.npy file and
+    # its weights into OUTPUT_PATH.sdf_weight_data.npy and
+    # OUTPUT_PATH.color_weight_data.npy, which are saved instead of
+    # OUTPUT_PATH.npz.
+    parser.add_argument("--memmap", action="store_true")
+    # Fuse by marching the rays of every N-th pixel instead of sweeping the
+    # voxels of the frustum.
+    parser.add_argument("--pixel_stride", type=int)
+    # Fuse this many frames per sweep over the volume.
+    parser.add_argument("--batch_size", type=int, default=1)
+    # Load and decompress up to this many of the next images in background
+    # threads while the current one is fused.
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--prefetch_workers", type=int, default=1)
+    parser.add_argument("--prefetch_memory_mb", type=float)
+    # Save the volume every N fused frames to OUTPUT_PATH.checkpoint.npz, and
+    # continue from this checkpoint with --resume.
+    parser.add_argument("--checkpoint_interval", type=int, default=0)
+    parser.add_argument("--resume", action="store_true")
+    # Save snapshots of the volume after these numbers of fused frames, e.g.
+    # 10,50,200, as compressed deltas to OUTPUT_PATH.snapshotNNNNNN.npz, see
+    # snapshot.load_snapshot.
+    parser.add_argument("--snapshots", type=parse_snapshots, default=[])
+    args = parser.parse_args()
+    if args.batch_size > 1 and args.pixel_stride is not None:
+        parser.error("--batch_size and --pixel_stride cannot be combined")
+    if args.snapshots and args.resume:
+        parser.error("--snapshots and --resume cannot be combined")
+    if args.bricked and (args.precision == "reduced" or
+                         args.pixel_stride is not None or
+                         args.batch_size > 1 or
+                         args.checkpoint_interval > 0 or args.resume):
+        parser.error("--bricked only supports full precision, the voxel "
+                     "sweep and no checkpoints")
+    if args.backend == "numpy" and (args.bricked or
+                                    args.precision == "reduced" or
+                                    args.pixel_stride is not None or
+                                    args.batch_size > 1):
+        parser.error("--backend numpy only supports dense full precision "
+                     "volumes fused with the voxel sweep")
+    if args.memmap and (args.bricked or args.precision == "reduced" or
+                        args.checkpoint_interval > 0 or args.resume):
+        parser.error("--memmap only supports dense full precision volumes "
+                     "and no checkpoints")
+    if is_registered(args.input_path, "color") and (
+            args.bricked or args.pixel_stride is not None or
+            args.batch_size > 1):
+        parser.error("registered images are only fused into dense volumes "
+                     "with the voxel sweep")
+    return args
 
 
 def write_ply(path, points, color):
@@ -33,32 +100,134 @@ def write_ply(path, points, color):
                                                    points[i, 2], *color))
 
 
+def fuse_image_batch(color_sdf_volume, images, num_threads):
+    # Fuse a list of images in order with a single sweep over the volume.
+    color_sdf_volume.fuse_batch(
+        np.stack([image["depth_proj_matrix"] for image in images]),
+        np.stack([image["color_proj_matrix"] for image in images]),
+        np.stack([image["depth_map"] for image in images]),
+        np.stack([image["color_map"] for image in images]),
+        num_threads=num_threads)
+
+
 def main():
     args = parse_args()
 
     bbox = np.loadtxt(os.path.join(args.input_path, "bbox.txt"))
 
-    color_sdf_volume = ColorSDFVolume(bbox, args.resolution, args.resolution_factor)
+    ColorSDFVolume = volume_class("ColorSDFVolume", args.backend)
+    if args.bricked:
+        BrickedColorSDFVolume = volume_class("BrickedColorSDFVolume",
+                                             args.backend)
+        color_sdf_volume = BrickedColorSDFVolume(bbox, args.resolution,
+                                                 args.resolution_factor)
+    elif args.memmap:
+        # Stale files would be fused into again.
+        volume_path = args.output_path + ".npy"
+        for path in (volume_path,
+                     weight_path(volume_path, "sdf_weight_data"),
+                     weight_path(volume_path, "color_weight_data")):
+            if os.path.exists(path):
+                os.remove(path)
+        color_sdf_volume = ColorSDFVolume(bbox, args.resolution,
+                                          args.resolution_factor,
+                                          volume=volume_path)
+    else:
+        color_sdf_volume = ColorSDFVolume(bbox, args.resolution, args.resolution_factor,
+                                          precision=args.precision)
+
+    # The index of the last frame fused into the volume.
+    last_frame = -1
+    if args.resume:
+        checkpoint = load_checkpoint(checkpoint_path(args.output_path))
+        if checkpoint is not None:
+            assert checkpoint["resolution"] == args.resolution
+            color_sdf_volume.set_volume(checkpoint["volume"],
+                                        checkpoint["sdf_weight_data"],
+                                        checkpoint["color_weight_data"])
+            last_frame = int(checkpoint["last_frame"])
+            print("Resuming {} after frame {}".format(args.output_path,
+                                                      last_frame + 1))
 
     image_paths = sorted(glob.glob(os.path.join(args.input_path,
                                                 "images/*.npz")))
 
-    for i, image_path in enumerate(image_paths):
-        if i % args.frame_rate != 0:
-            continue
+    frame_ids = range(0, len(image_paths), args.frame_rate)
+    frame_ids = [i for i in frame_ids if i > last_frame]
+    images = prefetch(load_npz, [image_paths[i] for i in frame_ids],
+                      args.prefetch, args.prefetch_workers,
+                      args.prefetch_memory_mb)
 
-        print("Processing {} [{}/{}]".format(
-              os.path.basename(image_path), i + 1, len(image_paths)))
-        image = np.load(image_path)
+    checkpoint_writer = CheckpointWriter()
 
-        
-        color_sdf_volume.fuse(image["depth_proj_matrix"], image["color_proj_matrix"],
-                            image["depth_map"], image["color_map"])
+    # The last snapshot and its number of fused frames.
+    snapshot = None
+    snapshot_num_fused = 0
 
-
-    np.savez(args.output_path + ".npz",
-             volume=color_sdf_volume.get_volume(),
-             resolution=args.resolution)
+    batch = []
+    for n, (i, image) in enumerate(zip(frame_ids, images)):
+        print("Processing {} [{}/{}]".format(
+              os.path.basename(image_paths[i]), i + 1, len(image_paths)))
+
+        # Color maps registered to the depth map (register_images) have no
+        # color_proj_matrix.
+        if "color_proj_matrix" not in image:
+            color_sdf_volume.fuse_registered(image["depth_proj_matrix"],
+                                             image["depth_map"],
+                                             image["color_map"],
+                                             num_threads=args.num_threads)
+        elif args.batch_size > 1:
+            batch.append(image)
+            if len(batch) == args.batch_size:
+                fuse_image_batch(color_sdf_volume, batch, args.num_threads)
+                batch = []
+        elif args.pixel_stride is not None:
+            color_sdf_volume.fuse_rays(image["depth_proj_matrix"], image["color_proj_matrix"],
+                                       image["depth_map"], image["color_map"],
+                                       pixel_stride=args.pixel_stride,
+                                       num_threads=args.num_threads)
+        else:
+            color_sdf_volume.fuse(image["depth_proj_matrix"], image["color_proj_matrix"],
+                                image["depth_map"], image["color_map"],
+                                num_threads=args.num_threads)
+
+        if n + 1 in args.snapshots:
+            if batch:
+                fuse_image_batch(color_sdf_volume, batch, args.num_threads)
+                batch = []
+            volume = color_sdf_volume.get_volume()
+            save_snapshot(args.output_path, n + 1, volume, snapshot,
+                          snapshot_num_fused, resolution=args.resolution)
+            snapshot = volume
+            snapshot_num_fused = n + 1
+
+        # get_volume and the weight getters return copies, which are written
+        # in the background while the fusion continues.
+        if (args.checkpoint_interval > 0 and
+                (n + 1) % args.checkpoint_interval == 0):
+            if batch:
+                fuse_image_batch(color_sdf_volume, batch, args.num_threads)
+                batch = []
+            checkpoint_writer.write(
+                checkpoint_path(args.output_path),
+                {"volume": color_sdf_volume.get_volume(),
+                 "sdf_weight_data": color_sdf_volume.get_sdf_weight_data(),
+                 "color_weight_data": color_sdf_volume.get_color_weight_data(),
+                 "last_frame": i,
+                 "resolution": args.resolution})
+
+    if batch:
+        fuse_image_batch(color_sdf_volume, batch, args.num_threads)
+
+    checkpoint_writer.close()
+
+    if args.memmap:
+        color_sdf_volume.flush()
+    else:
+        np.savez(args.output_path + ".npz",
+                 volume=color_sdf_volume.get_volume(copy=False),
+                 resolution=args.resolution)
+    remove_checkpoint(checkpoint_path(args.output_path))
 
 
 if __name__ == "__main__":
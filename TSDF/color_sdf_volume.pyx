@@ -4,7 +4,111 @@
 
 import numpy as np
 cimport numpy as np
-from libc.math cimport round
+from libc.stdint cimport uint8_t, uint16_t
+from cython.parallel cimport prange
+
+from frustum cimport FrustumBounds, frustum_voxel_bounds, clip_column, \
+    max_depth, tile_max_depth, box_in_frustum, DEPTH_TILE_SIZE
+from projection cimport ColumnProjection, fill_z_table, column_projection, \
+    project_voxel, project_voxel_column, depth_signed_distance_column, \
+    project_to_image_column
+from precision cimport float_to_half, half_to_float, float_to_uint8, \
+    increment_weight, color_t
+from label_votes cimport vote_label_probs, vote_label
+from raycast cimport Camera, RayTraversal, init_camera, start_ray, next_voxel, \
+    claim_voxel
+
+from bricks import morton_order, bricks_to_dense
+from memmap_volume import open_volume, flush_volume, weight_path
+
+
+# Side length in voxels of the blocks of the sparse volumes.
+cdef enum:
+    BLOCK_SIZE = 8
+
+# Number of color channels of the volumes, the fourth (alpha) channel of RGBA
+# color maps is ignored.
+cdef enum:
+    NUM_COLORS = 3
+
+
+cdef inline void update_color_sdf(float* voxel, float* sdf_weight,
+                                  float* color_weight, float signed_distance,
+                                  float max_distance,
+                                  color_t[:, :, ::1] color_map,
+                                  int color_image_proj_x,
+                                  int color_image_proj_y) noexcept nogil:
+    # Update the running averages of the sdf and the colors of a voxel, whose
+    # last channel is the sdf channel, with one observation.
+    cdef int ch
+    cdef float truncated_distance
+    cdef float prior_sdf_weight, prior_color_weight,new_sdf_weight, new_color_weight
+
+    # sdf fusion 
+    if signed_distance >= -max_distance:
+
+        if signed_distance > 0:
+            truncated_distance = min(signed_distance, max_distance)
+        else:
+            truncated_distance = signed_distance
+        
+        prior_sdf_weight = sdf_weight[0]
+        new_sdf_weight = prior_sdf_weight+1.0
+        voxel[NUM_COLORS] = (prior_sdf_weight * voxel[NUM_COLORS] + 1.0  * truncated_distance)/new_sdf_weight
+        sdf_weight[0] = new_sdf_weight
+
+    # color fusion
+    if abs(signed_distance) > max_distance:
+        return
+
+    prior_color_weight = color_weight[0]
+    new_color_weight = prior_color_weight+1.0
+
+    for ch in range(NUM_COLORS):
+        voxel[ch] = min((prior_color_weight * voxel[ch] + 1.0 *  color_map[color_image_proj_y, color_image_proj_x, ch])/new_color_weight, 255.0)
+
+    color_weight[0] = new_color_weight
+
+
+cdef inline void update_color_sdf_reduced(uint8_t* color, uint16_t* sdf,
+                                          uint16_t* sdf_weight,
+                                          uint16_t* color_weight,
+                                          float signed_distance,
+                                          float max_distance,
+                                          color_t[:, :, ::1] color_map,
+                                          int color_image_proj_x,
+                                          int color_image_proj_y) noexcept nogil:
+    # Same as update_color_sdf for uint8 colors, a float16 sdf and uint16
+    # weights, which stop counting at MAX_WEIGHT.
+    cdef int ch
+    cdef float truncated_distance
+    cdef float prior_weight, new_weight
+
+    if signed_distance >= -max_distance:
+        if signed_distance > 0:
+            truncated_distance = min(signed_distance, max_distance)
+        else:
+            truncated_distance = signed_distance
+
+        prior_weight = sdf_weight[0]
+        new_weight = prior_weight + 1
+        sdf[0] = float_to_half((prior_weight * half_to_float(sdf[0]) +
+                                truncated_distance) / new_weight)
+        increment_weight(sdf_weight)
+
+    if abs(signed_distance) > max_distance:
+        return
+
+    prior_weight = color_weight[0]
+    new_weight = prior_weight + 1
+
+    for ch in range(NUM_COLORS):
+        color[ch] = float_to_uint8(
+            (prior_weight * color[ch] +
+             color_map[color_image_proj_y, color_image_proj_x, ch]) /
+            new_weight)
+
+    increment_weight(color_weight)
 
 
 cdef class ColorSDFVolume:
@@ -15,10 +119,22 @@ cdef class ColorSDFVolume:
     cdef float[:, :, :, ::1] volume
     cdef float[:, :, ::1] sdf_weight_data
     cdef float[:, :, ::1] color_weight_data
+    cdef int volume_shape[4]
+    cdef bint reduced
+    cdef uint8_t[:, :, :, ::1] color_data
+    cdef uint16_t[:, :, ::1] half_sdf_data
+    cdef uint16_t[:, :, ::1] sdf_weight_counts
+    cdef uint16_t[:, :, ::1] color_weight_counts
+    cdef int[:, :, ::1] ray_stamps
+    cdef int ray_frame
+    # The arrays that back the full precision volume and weights.
+    cdef object volume_arrays
 
-    def __init__(self, bbox, resolution, resolution_factor):
+    def __init__(self, bbox, resolution, resolution_factor, precision="full",
+                 volume=None, sdf_weight_data=None, color_weight_data=None):
         assert resolution > 0
         assert resolution_factor > 0
+        assert precision in ("full", "reduced")
         
 
         self.bbox = bbox.astype(np.float32)
@@ -29,116 +145,1167 @@ cdef class ColorSDFVolume:
         volume_size = np.diff(bbox, axis=1)
         volume_shape = volume_size.ravel() / self.resolution
         volume_shape = np.ceil(volume_shape).astype(np.int32).tolist()
-        self.volume = np.zeros(volume_shape + [4],
-                               dtype=np.float32)
+        self.volume_shape = volume_shape + [4]
 
-        # the last channel is for fused sdf, and we initialize it to truncated_distance, i.e., self.max_distance
-        self.volume[:,:,:,-1] = self.max_distance 
+        # The reduced precision volume stores uint8 colors, float16 sdf bits
+        # and saturating uint16 weight counters. The running averages are
+        # computed in float32 and rounded once per update.
+        self.reduced = precision == "reduced"
+        if self.reduced:
+            self.color_data = np.zeros(volume_shape + [3], dtype=np.uint8)
+            self.half_sdf_data = np.full(
+                volume_shape, np.float16(self.max_distance).view(np.uint16),
+                dtype=np.uint16)
+            self.sdf_weight_counts = np.zeros(volume_shape, dtype=np.uint16)
+            self.color_weight_counts = np.zeros(volume_shape, dtype=np.uint16)
+            self.volume_arrays = []
+            assert volume is None, \
+                "reduced precision volumes are only allocated in memory"
+            return
 
+        # The volume and weights are fused into volume, sdf_weight_data and
+        # color_weight_data if given, e.g. np.memmaps, see
+        # TSDFVolume.__init__. A path of a .npy file for volume also stores
+        # the weights next to it by default, see memmap_volume.weight_path.
+        # Arrays are used as is, the sdf channel of a new volume has to be
+        # set to max_distance.
+        if volume is not None:
+            if isinstance(volume, str):
+                if sdf_weight_data is None:
+                    sdf_weight_data = weight_path(volume, "sdf_weight_data")
+                if color_weight_data is None:
+                    color_weight_data = weight_path(volume, "color_weight_data")
+            assert sdf_weight_data is not None and \
+                color_weight_data is not None
+            self.volume_arrays = [
+                open_volume(volume, volume_shape + [4], np.float32,
+                            np.array([0, 0, 0, self.max_distance],
+                                     dtype=np.float32)),
+                open_volume(sdf_weight_data, volume_shape, np.float32),
+                open_volume(color_weight_data, volume_shape, np.float32)]
+        else:
+            volume = np.zeros(volume_shape + [4],
+                              dtype=np.float32)
 
-        self.sdf_weight_data = np.zeros(volume_shape, dtype=np.float32)
-        self.color_weight_data = np.zeros(volume_shape, dtype=np.float32)
+            # the last channel is for fused sdf, and we initialize it to truncated_distance, i.e., self.max_distance
+            volume[:,:,:,-1] = self.max_distance 
+
+
+            self.volume_arrays = [
+                volume,
+                np.zeros(volume_shape, dtype=np.float32),
+                np.zeros(volume_shape, dtype=np.float32)]
+        self.volume, self.sdf_weight_data, self.color_weight_data = \
+            self.volume_arrays
+
+    def get_volume(self, copy=True):
+        # See TSDFVolume.get_volume for copy=False. The float32 volume of a
+        # reduced volume is assembled from its colors and sdf, which is
+        # always a new array.
+        if self.reduced:
+            volume = np.empty(list(self.volume_shape), dtype=np.float32)
+            volume[..., :-1] = self.color_data
+            volume[..., -1] = np.asarray(self.half_sdf_data).view(np.float16)
+            return volume
+        return np.array(self.volume, copy=copy)
+
+    def get_sdf_weight_data(self, copy=True):
+        if self.reduced:
+            return np.array(self.sdf_weight_counts, copy=copy)
+        return np.array(self.sdf_weight_data, copy=copy)
+
+    def get_color_weight_data(self, copy=True):
+        if self.reduced:
+            return np.array(self.color_weight_counts, copy=copy)
+        return np.array(self.color_weight_data, copy=copy)
+
+    def set_volume(self, volume, sdf_weight_data, color_weight_data):
+        # Restore a volume and weights returned by get_volume,
+        # get_sdf_weight_data and get_color_weight_data, e.g. from a
+        # checkpoint.
+        assert tuple(volume.shape) == tuple(self.volume_shape)
+        assert sdf_weight_data.shape == volume.shape[:3]
+        assert color_weight_data.shape == volume.shape[:3]
+        if self.reduced:
+            self.color_data = np.ascontiguousarray(volume[..., :-1],
+                                                   dtype=np.uint8)
+            self.half_sdf_data = np.ascontiguousarray(
+                volume[..., -1], dtype=np.float16).view(np.uint16)
+            self.sdf_weight_counts = np.ascontiguousarray(sdf_weight_data,
+                                                          dtype=np.uint16)
+            self.color_weight_counts = np.ascontiguousarray(
+                color_weight_data, dtype=np.uint16)
+        else:
+            # Copied in place, see TSDFVolume.set_volume.
+            for array, data in zip(self.volume_arrays,
+                                   (volume, sdf_weight_data,
+                                    color_weight_data)):
+                array[...] = data
+
+    def flush(self):
+        # Write the volume and weights of a memory-mapped volume to their
+        # files.
+        for array in self.volume_arrays:
+            flush_volume(array)
+
+    def merge(self,
+              np.float32_t[:, :, :, ::1] volume,
+              np.float32_t[:, :, ::1] sdf_weight_data,
+              np.float32_t[:, :, ::1] color_weight_data):
+        # Merge a volume fused from a disjoint set of frames into this one.
+        # The sdf and colors are running averages, so the merged values are
+        # the averages weighted by the observations of both volumes.
+        assert not self.reduced
+        assert volume.shape[0] == self.volume_shape[0]
+        assert volume.shape[1] == self.volume_shape[1]
+        assert volume.shape[2] == self.volume_shape[2]
+        assert volume.shape[3] == self.volume_shape[3]
+        assert sdf_weight_data.shape[0] == self.volume_shape[0]
+        assert sdf_weight_data.shape[1] == self.volume_shape[1]
+        assert sdf_weight_data.shape[2] == self.volume_shape[2]
+        assert color_weight_data.shape[0] == self.volume_shape[0]
+        assert color_weight_data.shape[1] == self.volume_shape[1]
+        assert color_weight_data.shape[2] == self.volume_shape[2]
+
+        cdef int i, j, k, ch
+        cdef float prior_weight, other_weight, new_weight
 
-    def get_volume(self):
-        return np.array(self.volume)
+        for i in range(self.volume_shape[0]):
+            for j in range(self.volume_shape[1]):
+                for k in range(self.volume_shape[2]):
+                    other_weight = sdf_weight_data[i, j, k]
+                    if other_weight > 0:
+                        prior_weight = self.sdf_weight_data[i, j, k]
+                        new_weight = prior_weight + other_weight
+                        self.volume[i, j, k, -1] = \
+                            (prior_weight * self.volume[i, j, k, -1] +
+                             other_weight * volume[i, j, k, -1]) / new_weight
+                        self.sdf_weight_data[i, j, k] = new_weight
+
+                    other_weight = color_weight_data[i, j, k]
+                    if other_weight > 0:
+                        prior_weight = self.color_weight_data[i, j, k]
+                        new_weight = prior_weight + other_weight
+                        for ch in range(self.volume_shape[3] - 1):
+                            self.volume[i, j, k, ch] = \
+                                (prior_weight * self.volume[i, j, k, ch] +
+                                 other_weight * volume[i, j, k, ch]) / \
+                                new_weight
+                        self.color_weight_data[i, j, k] = new_weight
+
+    cdef float[:, ::1] _z_table(self, float[:, ::1] proj_matrix):
+        # The z terms of the projections of the voxels of a column.
+        z_table = np.empty((self.volume_shape[2], 3), dtype=np.float32)
+        fill_z_table(proj_matrix, self.bbox[2, 0], self.resolution, z_table)
+        return z_table
 
     def fuse(self,
              np.float32_t[:, ::1] depth_proj_matrix,
              np.float32_t[:, ::1] color_proj_matrix,
              np.float32_t[:, ::1] depth_map,
-             np.float32_t[:, :, ::1] color_map):
-        assert color_map.shape[2] == self.volume.shape[3] - 1
+             color_t[:, :, ::1] color_map,
+             int num_threads=1):
+        assert color_map.shape[2] in (NUM_COLORS, NUM_COLORS + 1)
+        assert num_threads > 0
 
         cdef int i, j, k
-        cdef float x, y, z
-        cdef float depth_proj_x, depth_proj_y, depth_proj_z
-        cdef float color_proj_x, color_proj_y, color_proj_z
-        cdef int depth_image_proj_x, depth_image_proj_y
+        cdef int k_min, k_max
+        cdef float far_depth
+        cdef FrustumBounds bounds
+        cdef float x, y
         cdef int color_image_proj_x, color_image_proj_y
-        cdef float depth, signed_distance, truncated_signed_distance
-        cdef float prior_sdf_weight, prior_color_weight,new_sdf_weight, new_color_weight
-        
+        cdef float signed_distance
+        cdef ColumnProjection depth_column, color_column
+        cdef float[:, ::1] depth_z_table = self._z_table(depth_proj_matrix)
+        cdef float[:, ::1] color_z_table = self._z_table(color_proj_matrix)
+
+        # Voxels beyond the largest measured depth plus the truncation distance
+        # are never updated, so only sweep the part of the volume inside the
+        # camera frustum clipped at that depth.
+        far_depth = max_depth(depth_map) + self.max_distance
+        bounds = frustum_voxel_bounds(depth_proj_matrix,
+                                      depth_map.shape[1], depth_map.shape[0],
+                                      far_depth, self.bbox, self.resolution,
+                                      self.volume_shape[0],
+                                      self.volume_shape[1])
 
-        for i in range(self.volume.shape[0]):
+        # Every voxel is only written by the iteration that owns it, so the
+        # slices along x are fused in parallel without the GIL.
+        for i in prange(bounds.i_min, bounds.i_max, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
             x = self.bbox[0, 0] + i * self.resolution
-            for j in range(self.volume.shape[1]):
+            for j in range(bounds.j_min, bounds.j_max):
                 y = self.bbox[1, 0] + j * self.resolution
-                for k in range(self.volume.shape[2]):
-                    z = self.bbox[2, 0] + k * self.resolution
-
-                    # Compute the depth of the current voxel wrt. the camera.
-                    depth_proj_z = depth_proj_matrix[2, 0] * x + \
-                                   depth_proj_matrix[2, 1] * y + \
-                                   depth_proj_matrix[2, 2] * z + \
-                                   depth_proj_matrix[2, 3]
-                    color_proj_z = color_proj_matrix[2, 0] * x + \
-                                   color_proj_matrix[2, 1] * y + \
-                                   color_proj_matrix[2, 2] * z + \
-                                   color_proj_matrix[2, 3]
-
-                    # Check if voxel behind camera.
-                    if depth_proj_z <= 0 or color_proj_z <= 0:
+                # Variables that are only written through pointers have to be
+                # assigned in the loop body to be thread-private in prange.
+                k_min = 0
+                k_max = 0
+                signed_distance = 0
+                color_image_proj_x = 0
+                color_image_proj_y = 0
+                if not clip_column(depth_proj_matrix,
+                                   depth_map.shape[1], depth_map.shape[0],
+                                   far_depth, x, y, self.bbox[2, 0],
+                                   self.resolution, self.volume_shape[2],
+                                   &k_min, &k_max):
+                    continue
+                depth_column = column_projection(depth_proj_matrix, x, y)
+                color_column = column_projection(color_proj_matrix, x, y)
+                for k in range(k_min, k_max):
+                    if not project_voxel_column(&depth_column, depth_z_table,
+                                                &color_column, color_z_table,
+                                                depth_map, color_map.shape[0],
+                                                color_map.shape[1], k,
+                                                &signed_distance,
+                                                &color_image_proj_x,
+                                                &color_image_proj_y):
                         continue
 
-                    # Compute pixel location of the current voxel in the image.
-                    depth_proj_x = depth_proj_matrix[0, 0] * x + \
-                                   depth_proj_matrix[0, 1] * y + \
-                                   depth_proj_matrix[0, 2] * z + \
-                                   depth_proj_matrix[0, 3]
-                    depth_proj_y = depth_proj_matrix[1, 0] * x + \
-                                   depth_proj_matrix[1, 1] * y + \
-                                   depth_proj_matrix[1, 2] * z + \
-                                   depth_proj_matrix[1, 3]
-                    color_proj_x = color_proj_matrix[0, 0] * x + \
-                                   color_proj_matrix[0, 1] * y + \
-                                   color_proj_matrix[0, 2] * z + \
-                                   color_proj_matrix[0, 3]
-                    color_proj_y = color_proj_matrix[1, 0] * x + \
-                                   color_proj_matrix[1, 1] * y + \
-                                   color_proj_matrix[1, 2] * z + \
-                                   color_proj_matrix[1, 3]
-                    depth_image_proj_x = <int>round(depth_proj_x / depth_proj_z)
-                    depth_image_proj_y = <int>round(depth_proj_y / depth_proj_z)
-                    color_image_proj_x = <int>round(color_proj_x / color_proj_z)
-                    color_image_proj_y = <int>round(color_proj_y / color_proj_z)
-
-                    # Check if projection is inside image.
-                    if (depth_image_proj_x < 0 or depth_image_proj_y < 0 or
-                        depth_image_proj_x >= depth_map.shape[1] or
-                        depth_image_proj_y >= depth_map.shape[0] or
-                        color_image_proj_x < 0 or color_image_proj_y < 0 or
-                        color_image_proj_x >= color_map.shape[1] or
-                        color_image_proj_y >= color_map.shape[0]):
+                    if self.reduced:
+                        update_color_sdf_reduced(
+                            &self.color_data[i, j, k, 0],
+                            &self.half_sdf_data[i, j, k],
+                            &self.sdf_weight_counts[i, j, k],
+                            &self.color_weight_counts[i, j, k],
+                            signed_distance, self.max_distance, color_map,
+                            color_image_proj_x, color_image_proj_y)
                         continue
 
-                    # Extract measured depth at projection.
-                    depth = depth_map[depth_image_proj_y, depth_image_proj_x]
+                    update_color_sdf(&self.volume[i, j, k, 0],
+                                     &self.sdf_weight_data[i, j, k],
+                                     &self.color_weight_data[i, j, k],
+                                     signed_distance, self.max_distance,
+                                     color_map, color_image_proj_x,
+                                     color_image_proj_y)
+
+
+    cdef void _fuse_registered_slice(self, int i, FrustumBounds bounds,
+                                     float far_depth,
+                                     float[:, ::1] depth_proj_matrix,
+                                     float[:, ::1] depth_z_table,
+                                     float[:, ::1] depth_map,
+                                     color_t[:, :, ::1] color_map) noexcept nogil:
+        cdef int j, k, k_min, k_max
+        cdef float x = self.bbox[0, 0] + i * self.resolution
+        cdef float y
+        cdef float signed_distance
+        cdef int depth_image_proj_x, depth_image_proj_y
+        cdef ColumnProjection depth_column
+
+        for j in range(bounds.j_min, bounds.j_max):
+            y = self.bbox[1, 0] + j * self.resolution
+            if not clip_column(depth_proj_matrix,
+                               depth_map.shape[1], depth_map.shape[0],
+                               far_depth, x, y, self.bbox[2, 0],
+                               self.resolution, self.volume_shape[2],
+                               &k_min, &k_max):
+                continue
+            depth_column = column_projection(depth_proj_matrix, x, y)
+            for k in range(k_min, k_max):
+                if not depth_signed_distance_column(&depth_column,
+                                                    depth_z_table, depth_map,
+                                                    k, &signed_distance,
+                                                    &depth_image_proj_x,
+                                                    &depth_image_proj_y):
+                    continue
+
+                if self.reduced:
+                    update_color_sdf_reduced(&self.color_data[i, j, k, 0],
+                                             &self.half_sdf_data[i, j, k],
+                                             &self.sdf_weight_counts[i, j, k],
+                                             &self.color_weight_counts[i, j, k],
+                                             signed_distance,
+                                             self.max_distance, color_map,
+                                             depth_image_proj_x,
+                                             depth_image_proj_y)
+                    continue
+
+                update_color_sdf(&self.volume[i, j, k, 0],
+                                 &self.sdf_weight_data[i, j, k],
+                                 &self.color_weight_data[i, j, k],
+                                 signed_distance, self.max_distance,
+                                 color_map, depth_image_proj_x,
+                                 depth_image_proj_y)
+
+    def fuse_registered(self,
+                        np.float32_t[:, ::1] depth_proj_matrix,
+                        np.float32_t[:, ::1] depth_map,
+                        color_t[:, :, ::1] color_map,
+                        int num_threads=1):
+        # Same as fuse for a color image registered to the depth image (see
+        # registration.register_to_depth), so every voxel is only projected
+        # into the depth image.
+        assert color_map.shape[0] == depth_map.shape[0]
+        assert color_map.shape[1] == depth_map.shape[1]
+        assert color_map.shape[2] in (NUM_COLORS, NUM_COLORS + 1)
+        assert num_threads > 0
+
+        cdef int i
+        cdef float far_depth
+        cdef FrustumBounds bounds
+        cdef float[:, ::1] depth_z_table = self._z_table(depth_proj_matrix)
+
+        far_depth = max_depth(depth_map) + self.max_distance
+        bounds = frustum_voxel_bounds(depth_proj_matrix,
+                                      depth_map.shape[1], depth_map.shape[0],
+                                      far_depth, self.bbox, self.resolution,
+                                      self.volume_shape[0],
+                                      self.volume_shape[1])
+
+        for i in prange(bounds.i_min, bounds.i_max, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
+            self._fuse_registered_slice(i, bounds, far_depth,
+                                        depth_proj_matrix, depth_z_table,
+                                        depth_map, color_map)
+
+    cdef void _fuse_column_batch(self, int i, int j,
+                                 float[:, :, ::1] depth_proj_matrices,
+                                 float[:, :, ::1] color_proj_matrices,
+                                 float[:, :, ::1] depth_z_tables,
+                                 float[:, :, ::1] color_z_tables,
+                                 float[:, :, ::1] depth_maps,
+                                 float[::1] far_depths,
+                                 color_t[:, :, :, ::1] color_maps) noexcept nogil:
+        # Apply the updates of all frames in order to the voxel column (i, j),
+        # which stays in cache between the frames.
+        cdef int f, k, k_min, k_max
+        cdef float x = self.bbox[0, 0] + i * self.resolution
+        cdef float y = self.bbox[1, 0] + j * self.resolution
+        cdef int color_image_proj_x, color_image_proj_y
+        cdef float signed_distance
+        cdef float[:, ::1] depth_proj_matrix
+        cdef float[:, ::1] depth_map
+        cdef color_t[:, :, ::1] color_map
+        cdef ColumnProjection depth_column, color_column
+
+        for f in range(depth_maps.shape[0]):
+            depth_proj_matrix = depth_proj_matrices[f]
+            depth_map = depth_maps[f]
+            if not clip_column(depth_proj_matrix,
+                               depth_map.shape[1], depth_map.shape[0],
+                               far_depths[f], x, y, self.bbox[2, 0],
+                               self.resolution, self.volume_shape[2],
+                               &k_min, &k_max):
+                continue
+
+            depth_column = column_projection(depth_proj_matrix, x, y)
+            color_column = column_projection(color_proj_matrices[f], x, y)
+            color_map = color_maps[f]
+
+            for k in range(k_min, k_max):
+                if not project_voxel_column(&depth_column, depth_z_tables[f],
+                                            &color_column, color_z_tables[f],
+                                            depth_map, color_map.shape[0],
+                                            color_map.shape[1], k,
+                                            &signed_distance,
+                                            &color_image_proj_x,
+                                            &color_image_proj_y):
+                    continue
 
-                    
-                    signed_distance = depth - depth_proj_z
+                if self.reduced:
+                    update_color_sdf_reduced(&self.color_data[i, j, k, 0],
+                                             &self.half_sdf_data[i, j, k],
+                                             &self.sdf_weight_counts[i, j, k],
+                                             &self.color_weight_counts[i, j, k],
+                                             signed_distance,
+                                             self.max_distance, color_map,
+                                             color_image_proj_x,
+                                             color_image_proj_y)
+                else:
+                    update_color_sdf(&self.volume[i, j, k, 0],
+                                     &self.sdf_weight_data[i, j, k],
+                                     &self.color_weight_data[i, j, k],
+                                     signed_distance, self.max_distance,
+                                     color_map, color_image_proj_x,
+                                     color_image_proj_y)
 
-                    # sdf fusion 
-                    if signed_distance >= -self.max_distance:
+    def fuse_batch(self,
+                   np.float32_t[:, :, ::1] depth_proj_matrices,
+                   np.float32_t[:, :, ::1] color_proj_matrices,
+                   np.float32_t[:, :, ::1] depth_maps,
+                   color_t[:, :, :, ::1] color_maps,
+                   int num_threads=1):
+        # Same as calling fuse for every frame of the stacked inputs in order,
+        # but in a single sweep over the volume.
+        assert depth_proj_matrices.shape[0] == depth_maps.shape[0]
+        assert color_proj_matrices.shape[0] == depth_maps.shape[0]
+        assert color_maps.shape[0] == depth_maps.shape[0]
+        assert color_maps.shape[3] in (NUM_COLORS, NUM_COLORS + 1)
+        assert num_threads > 0
 
-                        if signed_distance > 0:
-                            truncated_distance = min(signed_distance, self.max_distance)
+        cdef int f, i, j
+        cdef FrustumBounds bounds
+        cdef FrustumBounds frame_bounds
+        cdef float[::1] far_depths
+        cdef float[:, :, ::1] depth_z_tables
+        cdef float[:, :, ::1] color_z_tables
+
+        depth_z_tables = np.stack([self._z_table(depth_proj_matrices[f])
+                                   for f in range(depth_maps.shape[0])])
+        color_z_tables = np.stack([self._z_table(color_proj_matrices[f])
+                                   for f in range(depth_maps.shape[0])])
+
+        # Sweep the union of the frustum AABBs of the frames.
+        far_depths = np.empty(depth_maps.shape[0], dtype=np.float32)
+        bounds.i_min = self.volume_shape[0]
+        bounds.i_max = 0
+        bounds.j_min = self.volume_shape[1]
+        bounds.j_max = 0
+        for f in range(depth_maps.shape[0]):
+            far_depths[f] = max_depth(depth_maps[f]) + self.max_distance
+            frame_bounds = frustum_voxel_bounds(depth_proj_matrices[f],
+                                                depth_maps.shape[2],
+                                                depth_maps.shape[1],
+                                                far_depths[f], self.bbox,
+                                                self.resolution,
+                                                self.volume_shape[0],
+                                                self.volume_shape[1])
+            if (frame_bounds.i_min >= frame_bounds.i_max or
+                    frame_bounds.j_min >= frame_bounds.j_max):
+                continue
+            bounds.i_min = min(bounds.i_min, frame_bounds.i_min)
+            bounds.i_max = max(bounds.i_max, frame_bounds.i_max)
+            bounds.j_min = min(bounds.j_min, frame_bounds.j_min)
+            bounds.j_max = max(bounds.j_max, frame_bounds.j_max)
+
+        for i in prange(bounds.i_min, bounds.i_max, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
+            for j in range(bounds.j_min, bounds.j_max):
+                self._fuse_column_batch(i, j, depth_proj_matrices,
+                                        color_proj_matrices, depth_z_tables,
+                                        color_z_tables, depth_maps,
+                                        far_depths, color_maps)
+
+    cdef void _march_row(self, int v, int pixel_stride, Camera* camera,
+                         float[:, ::1] depth_proj_matrix,
+                         float[:, ::1] color_proj_matrix,
+                         float[:, ::1] depth_map,
+                         color_t[:, :, ::1] color_map) noexcept nogil:
+        # Update the voxels crossed by the rays of a row of the depth map.
+        cdef int n, u, i, j, k
+        cdef float x, y, z
+        cdef int color_image_proj_x, color_image_proj_y
+        cdef float signed_distance
+        cdef RayTraversal ray
+
+        for n in range((depth_map.shape[1] + pixel_stride - 1) // pixel_stride):
+            u = n * pixel_stride
+            if depth_map[v, u] <= 0:
+                continue
+            if not start_ray(&ray, camera, u, v,
+                             depth_map[v, u] + self.max_distance, self.bbox,
+                             self.resolution, 0, self.volume_shape[0],
+                             self.volume_shape[1], self.volume_shape[2]):
+                continue
+
+            while True:
+                i = ray.index[0]
+                j = ray.index[1]
+                k = ray.index[2]
+                # The voxels are updated with their own projection exactly
+                # like in the voxel sweep, the rays only select them.
+                if claim_voxel(&self.ray_stamps[i, j, k], self.ray_frame):
+                    x = self.bbox[0, 0] + i * self.resolution
+                    y = self.bbox[1, 0] + j * self.resolution
+                    z = self.bbox[2, 0] + k * self.resolution
+                    if project_voxel(depth_proj_matrix, color_proj_matrix,
+                                     depth_map, color_map.shape[0],
+                                     color_map.shape[1], x, y, z,
+                                     &signed_distance, &color_image_proj_x,
+                                     &color_image_proj_y):
+                        if self.reduced:
+                            update_color_sdf_reduced(
+                                &self.color_data[i, j, k, 0],
+                                &self.half_sdf_data[i, j, k],
+                                &self.sdf_weight_counts[i, j, k],
+                                &self.color_weight_counts[i, j, k],
+                                signed_distance, self.max_distance, color_map,
+                                color_image_proj_x, color_image_proj_y)
                         else:
-                            truncated_distance = signed_distance
-                        
-                        prior_sdf_weight = self.sdf_weight_data[i, j, k]
-                        new_sdf_weight = prior_sdf_weight+1.0
-                        self.volume[i,j,k,-1] = (prior_sdf_weight * self.volume[i,j,k,-1] + 1.0  * truncated_distance)/new_sdf_weight
-                        self.sdf_weight_data[i, j, k] = new_sdf_weight
-
-                    # color fusion
-                    if abs(signed_distance) > self.max_distance:
+                            update_color_sdf(&self.volume[i, j, k, 0],
+                                             &self.sdf_weight_data[i, j, k],
+                                             &self.color_weight_data[i, j, k],
+                                             signed_distance,
+                                             self.max_distance, color_map,
+                                             color_image_proj_x,
+                                             color_image_proj_y)
+                if not next_voxel(&ray):
+                    break
+
+    def fuse_rays(self,
+                  np.float32_t[:, ::1] depth_proj_matrix,
+                  np.float32_t[:, ::1] color_proj_matrix,
+                  np.float32_t[:, ::1] depth_map,
+                  color_t[:, :, ::1] color_map,
+                  int pixel_stride=1,
+                  int num_threads=1):
+        # Same as fuse, but only visits the voxels crossed by the rays of
+        # every pixel_stride-th pixel (in both directions) with a valid depth,
+        # from the camera up to the truncation distance behind the measured
+        # depth. Every crossed voxel gets the same update as in fuse, voxels
+        # missed by all rays (e.g. smaller than the pixel footprint or behind
+        # depth discontinuities) are not updated.
+        assert color_map.shape[2] in (NUM_COLORS, NUM_COLORS + 1)
+        assert pixel_stride > 0
+        assert num_threads > 0
+
+        cdef int v
+        cdef Camera camera
+
+        if not init_camera(depth_proj_matrix, &camera):
+            return
+
+        # Every voxel remembers the last frame that updated it, so the stamps
+        # only have to be allocated for the first frame.
+        if self.ray_frame == 0:
+            self.ray_stamps = np.zeros(list(self.volume_shape)[:3],
+                                       dtype=np.int32)
+        self.ray_frame += 1
+
+        for v in prange(0, depth_map.shape[0], pixel_stride, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
+            self._march_row(v, pixel_stride, &camera, depth_proj_matrix,
+                            color_proj_matrix, depth_map, color_map)
+
+cdef class SparseColorSDFVolume:
+
+    # Same running averages as ColorSDFVolume, but the voxels are stored in
+    # BLOCK_SIZE^3 blocks, which are only allocated once a frame can update
+    # one of their voxels. The block table maps the coordinates of every block
+    # of the bbox to its slot in the block pools, or -1 if it is not allocated.
+
+    cdef float[:, ::1] bbox
+    cdef float resolution
+    cdef float max_distance
+    cdef int num_blocks
+    cdef int[:, :, ::1] block_table
+    cdef int[:, ::1] block_coords
+    cdef float[:, :, :, :, ::1] blocks
+    cdef float[:, :, :, ::1] sdf_weight_blocks
+    cdef float[:, :, :, ::1] color_weight_blocks
+    cdef object volume_shape
+
+    def __init__(self, bbox, resolution, resolution_factor,
+                 initial_num_blocks=1024):
+        assert resolution > 0
+        assert resolution_factor > 0
+        assert initial_num_blocks > 0
+
+        self.bbox = bbox.astype(np.float32)
+        self.resolution = resolution
+        self.max_distance = resolution_factor * self.resolution
+
+        volume_size = np.diff(bbox, axis=1)
+        volume_shape = volume_size.ravel() / self.resolution
+        volume_shape = np.ceil(volume_shape).astype(np.int32).tolist()
+        self.volume_shape = volume_shape
+
+        block_table_shape = [(s + BLOCK_SIZE - 1) // BLOCK_SIZE
+                             for s in volume_shape]
+        self.block_table = np.full(block_table_shape, -1, dtype=np.int32)
+        self.block_coords = np.zeros((initial_num_blocks, 3), dtype=np.int32)
+        self.blocks = np.zeros((initial_num_blocks, BLOCK_SIZE, BLOCK_SIZE,
+                                BLOCK_SIZE, 4), dtype=np.float32)
+        self.sdf_weight_blocks = np.zeros((initial_num_blocks, BLOCK_SIZE,
+                                           BLOCK_SIZE, BLOCK_SIZE),
+                                          dtype=np.float32)
+        self.color_weight_blocks = np.zeros((initial_num_blocks, BLOCK_SIZE,
+                                             BLOCK_SIZE, BLOCK_SIZE),
+                                            dtype=np.float32)
+        self.num_blocks = 0
+
+    def get_num_blocks(self):
+        return self.num_blocks
+
+    def get_volume(self, copy=True):
+        # The dense volume and weights are always new arrays.
+        return self.to_dense()
+
+    def get_sdf_weight_data(self, copy=True):
+        return self._blocks_to_dense(np.asarray(self.sdf_weight_blocks), 0)
+
+    def get_color_weight_data(self, copy=True):
+        return self._blocks_to_dense(np.asarray(self.color_weight_blocks), 0)
+
+    def to_dense(self):
+        return self._blocks_to_dense(np.asarray(self.blocks),
+                                     self.max_distance)
+
+    def _blocks_to_dense(self, blocks, sdf_init_value):
+        volume = np.zeros(self.volume_shape + list(blocks.shape[4:]),
+                          dtype=np.float32)
+        if volume.ndim == 4:
+            # the last channel is the sdf, which is the truncated distance
+            # in unobserved voxels.
+            volume[..., -1] = sdf_init_value
+        block_coords = np.asarray(self.block_coords)
+        for slot in range(self.num_blocks):
+            i, j, k = block_coords[slot] * BLOCK_SIZE
+            block_volume = volume[i:i + BLOCK_SIZE,
+                                  j:j + BLOCK_SIZE,
+                                  k:k + BLOCK_SIZE]
+            block_volume[...] = blocks[slot,
+                                       :block_volume.shape[0],
+                                       :block_volume.shape[1],
+                                       :block_volume.shape[2]]
+        return volume
+
+    def to_coords_features(self):
+        # The voxel indices and colors + sdf of all observed voxels.
+        offsets = np.arange(BLOCK_SIZE, dtype=np.int32)
+        offsets = np.stack(np.meshgrid(offsets, offsets, offsets,
+                                       indexing="ij"), axis=-1)
+        block_coords = np.asarray(self.block_coords)[:self.num_blocks]
+        coords = block_coords[:, None, None, None] * BLOCK_SIZE + offsets
+        coords = coords.reshape(-1, 3)
+        features = np.asarray(self.blocks)[:self.num_blocks].reshape(-1, 4)
+        sdf_weights = np.asarray(self.sdf_weight_blocks)[:self.num_blocks]
+        mask = np.all(coords < np.array(self.volume_shape), axis=1) & \
+            (sdf_weights.ravel() > 0)
+        return coords[mask], features[mask]
+
+    cdef int _allocate_block(self, int bi, int bj, int bk):
+        cdef int num_allocated = self.blocks.shape[0]
+        if self.num_blocks == num_allocated:
+            blocks = np.zeros((2 * num_allocated, BLOCK_SIZE, BLOCK_SIZE,
+                               BLOCK_SIZE, 4), dtype=np.float32)
+            blocks[:num_allocated] = self.blocks
+            self.blocks = blocks
+            sdf_weight_blocks = np.zeros((2 * num_allocated, BLOCK_SIZE,
+                                          BLOCK_SIZE, BLOCK_SIZE),
+                                         dtype=np.float32)
+            sdf_weight_blocks[:num_allocated] = self.sdf_weight_blocks
+            self.sdf_weight_blocks = sdf_weight_blocks
+            color_weight_blocks = np.zeros((2 * num_allocated, BLOCK_SIZE,
+                                            BLOCK_SIZE, BLOCK_SIZE),
+                                           dtype=np.float32)
+            color_weight_blocks[:num_allocated] = self.color_weight_blocks
+            self.color_weight_blocks = color_weight_blocks
+            block_coords = np.zeros((2 * num_allocated, 3), dtype=np.int32)
+            block_coords[:num_allocated] = self.block_coords
+            self.block_coords = block_coords
+
+        self.blocks[self.num_blocks, :, :, :, 3] = self.max_distance
+        self.block_coords[self.num_blocks, 0] = bi
+        self.block_coords[self.num_blocks, 1] = bj
+        self.block_coords[self.num_blocks, 2] = bk
+        self.block_table[bi, bj, bk] = self.num_blocks
+        self.num_blocks += 1
+        return self.num_blocks - 1
+
+    cdef object _touched_blocks(self, float[:, ::1] depth_proj_matrix,
+                                float[:, ::1] depth_map):
+        # Allocate the blocks that the frame can update and return their slots.
+        cdef FrustumBounds bounds
+        cdef int bi, bj, bk, slot
+        cdef int num_touched = 0
+        cdef float extent = (BLOCK_SIZE - 1) * self.resolution
+        cdef float[:, ::1] tiles
+        cdef int[::1] touched
+
+        bounds = frustum_voxel_bounds(depth_proj_matrix,
+                                      depth_map.shape[1], depth_map.shape[0],
+                                      max_depth(depth_map) + self.max_distance,
+                                      self.bbox, self.resolution,
+                                      self.volume_shape[0],
+                                      self.volume_shape[1])
+        if bounds.i_min >= bounds.i_max or bounds.j_min >= bounds.j_max:
+            return np.zeros(0, dtype=np.int32)
+
+        tiles = np.zeros(((depth_map.shape[0] + DEPTH_TILE_SIZE - 1) //
+                          DEPTH_TILE_SIZE,
+                          (depth_map.shape[1] + DEPTH_TILE_SIZE - 1) //
+                          DEPTH_TILE_SIZE), dtype=np.float32)
+        tile_max_depth(depth_map, tiles)
+
+        touched = np.empty(self.block_table.shape[0] *
+                           self.block_table.shape[1] *
+                           self.block_table.shape[2], dtype=np.int32)
+
+        for bi in range(bounds.i_min // BLOCK_SIZE,
+                        (bounds.i_max - 1) // BLOCK_SIZE + 1):
+            for bj in range(bounds.j_min // BLOCK_SIZE,
+                            (bounds.j_max - 1) // BLOCK_SIZE + 1):
+                for bk in range(self.block_table.shape[2]):
+                    if not box_in_frustum(
+                            depth_proj_matrix, tiles,
+                            depth_map.shape[1], depth_map.shape[0],
+                            self.max_distance,
+                            self.bbox[0, 0] + bi * BLOCK_SIZE * self.resolution,
+                            self.bbox[1, 0] + bj * BLOCK_SIZE * self.resolution,
+                            self.bbox[2, 0] + bk * BLOCK_SIZE * self.resolution,
+                            extent):
                         continue
+                    slot = self.block_table[bi, bj, bk]
+                    if slot < 0:
+                        slot = self._allocate_block(bi, bj, bk)
+                    touched[num_touched] = slot
+                    num_touched += 1
+
+        # In slot order, so that the blocks are fused in the order of the
+        # block pool in memory.
+        return np.sort(np.asarray(touched)[:num_touched])
+
+    def fuse(self,
+             np.float32_t[:, ::1] depth_proj_matrix,
+             np.float32_t[:, ::1] color_proj_matrix,
+             np.float32_t[:, ::1] depth_map,
+             color_t[:, :, ::1] color_map,
+             int num_threads=1):
+        assert color_map.shape[2] in (NUM_COLORS, NUM_COLORS + 1)
+        assert num_threads > 0
+
+        cdef int n, slot, a, b, c, i, j, k
+        cdef float x, y
+        cdef ColumnProjection depth_column, color_column
+        cdef float[:, ::1] depth_z_table = np.empty((self.volume_shape[2], 3),
+                                                    dtype=np.float32)
+        cdef float[:, ::1] color_z_table = np.empty_like(depth_z_table)
+        cdef int color_image_proj_x, color_image_proj_y
+        cdef float signed_distance
+        cdef int nx = self.volume_shape[0]
+        cdef int ny = self.volume_shape[1]
+        cdef int nz = self.volume_shape[2]
+        cdef np.int32_t[::1] touched
+
+        touched = self._touched_blocks(depth_proj_matrix, depth_map)
+        fill_z_table(depth_proj_matrix, self.bbox[2, 0], self.resolution,
+                     depth_z_table)
+        fill_z_table(color_proj_matrix, self.bbox[2, 0], self.resolution,
+                     color_z_table)
+
+        # Every voxel is only written by the iteration of its block, so the
+        # blocks are fused in parallel without the GIL.
+        for n in prange(touched.shape[0], nogil=True, schedule="dynamic",
+                        num_threads=num_threads):
+            slot = touched[n]
+            # Variables that are only written through pointers have to be
+            # assigned in the loop body to be thread-private in prange.
+            signed_distance = 0
+            color_image_proj_x = 0
+            color_image_proj_y = 0
+            for a in range(BLOCK_SIZE):
+                i = self.block_coords[slot, 0] * BLOCK_SIZE + a
+                if i >= nx:
+                    break
+                x = self.bbox[0, 0] + i * self.resolution
+                for b in range(BLOCK_SIZE):
+                    j = self.block_coords[slot, 1] * BLOCK_SIZE + b
+                    if j >= ny:
+                        break
+                    y = self.bbox[1, 0] + j * self.resolution
+                    depth_column = column_projection(depth_proj_matrix, x, y)
+                    color_column = column_projection(color_proj_matrix, x, y)
+                    for c in range(BLOCK_SIZE):
+                        k = self.block_coords[slot, 2] * BLOCK_SIZE + c
+                        if k >= nz:
+                            break
+
+                        if not project_voxel_column(
+                                &depth_column, depth_z_table, &color_column,
+                                color_z_table, depth_map, color_map.shape[0],
+                                color_map.shape[1], k, &signed_distance,
+                                &color_image_proj_x, &color_image_proj_y):
+                            continue
+
+                        update_color_sdf(&self.blocks[slot, a, b, c, 0],
+                                         &self.sdf_weight_blocks[slot, a, b, c],
+                                         &self.color_weight_blocks[slot, a, b, c],
+                                         signed_distance, self.max_distance,
+                                         color_map, color_image_proj_x,
+                                         color_image_proj_y)
+
+
+cdef class BrickedColorSDFVolume(SparseColorSDFVolume):
+
+    # Same as SparseColorSDFVolume, but all blocks of the bbox are allocated
+    # up front in the Morton order of their block coordinates, see
+    # BrickedTSDFVolume.
+
+    def __init__(self, bbox, resolution, resolution_factor):
+        SparseColorSDFVolume.__init__(self, bbox, resolution,
+                                      resolution_factor, initial_num_blocks=1)
+
+        block_coords = morton_order(np.asarray(self.block_table).shape)
+        num_blocks = len(block_coords)
+        blocks = np.zeros((num_blocks, BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE, 4),
+                          dtype=np.float32)
+        blocks[..., 3] = self.max_distance
+        self.blocks = blocks
+        self.sdf_weight_blocks = np.zeros((num_blocks, BLOCK_SIZE, BLOCK_SIZE,
+                                           BLOCK_SIZE), dtype=np.float32)
+        self.color_weight_blocks = np.zeros((num_blocks, BLOCK_SIZE,
+                                             BLOCK_SIZE, BLOCK_SIZE),
+                                            dtype=np.float32)
+        self.block_coords = block_coords
+        np.asarray(self.block_table)[tuple(block_coords.T)] = \
+            np.arange(num_blocks, dtype=np.int32)
+        self.num_blocks = num_blocks
+
+    def get_bricks(self):
+        # The color + sdf, sdf weight and color weight block pools without
+        # copying, with the block coordinates of their slots.
+        return (np.asarray(self.blocks), np.asarray(self.sdf_weight_blocks),
+                np.asarray(self.color_weight_blocks),
+                np.asarray(self.block_coords))
+
+    def _blocks_to_dense(self, blocks, sdf_init_value):
+        # Every block is allocated, so no voxel takes sdf_init_value.
+        return bricks_to_dense(blocks, np.asarray(self.block_table),
+                               self.volume_shape)
+
+
+cdef class SemanticColorSDFVolume:
+
+    # The label votes of a TSDFVolume and the sdf and colors of a
+    # ColorSDFVolume with the same bbox and resolution, fused from one set of
+    # frames. Every voxel is projected into the depth image once per frame
+    # for both, and the results are identical to fusing the frames into the
+    # two volumes separately.
+
+    cdef float[:, ::1] bbox
+    cdef float free_space_vote
+    cdef float occupied_space_vote
+    cdef float resolution
+    cdef float max_distance
+    cdef int volume_shape[3]
+    cdef int num_labels
+    cdef float[:, :, :, ::1] label_volume
+    cdef float[:, :, :, ::1] color_volume
+    cdef float[:, :, ::1] sdf_weight_data
+    cdef float[:, :, ::1] color_weight_data
+
+    def __init__(self, num_labels, bbox, resolution, resolution_factor,
+                 free_space_vote=0.5, occupied_space_vote=1):
+        assert num_labels > 0
+        assert resolution > 0
+        assert resolution_factor > 0
+        assert free_space_vote >= 0
+        assert occupied_space_vote >= 0
+
+        self.bbox = bbox.astype(np.float32)
+        self.resolution = resolution
+        self.max_distance = resolution_factor * self.resolution
+        self.free_space_vote = free_space_vote
+        self.occupied_space_vote = occupied_space_vote
+        self.num_labels = num_labels
+
+        volume_size = np.diff(bbox, axis=1)
+        volume_shape = volume_size.ravel() / self.resolution
+        volume_shape = np.ceil(volume_shape).astype(np.int32).tolist()
+        self.volume_shape = volume_shape
+
+        self.label_volume = np.zeros(volume_shape + [num_labels + 1],
+                                     dtype=np.float32)
+        self.color_volume = np.zeros(volume_shape + [4], dtype=np.float32)
+        self.color_volume[:, :, :, -1] = self.max_distance
+        self.sdf_weight_data = np.zeros(volume_shape, dtype=np.float32)
+        self.color_weight_data = np.zeros(volume_shape, dtype=np.float32)
+
+    def get_label_volume(self, copy=True):
+        # Same as TSDFVolume.get_volume.
+        return np.array(self.label_volume, copy=copy)
+
+    def get_color_volume(self, copy=True):
+        # Same as ColorSDFVolume.get_volume.
+        return np.array(self.color_volume, copy=copy)
+
+    def get_sdf_weight_data(self, copy=True):
+        return np.array(self.sdf_weight_data, copy=copy)
+
+    def get_color_weight_data(self, copy=True):
+        return np.array(self.color_weight_data, copy=copy)
+
+    cdef void _fuse_slice(self, int i, FrustumBounds bounds, float far_depth,
+                          float[:, ::1] depth_proj_matrix,
+                          float[:, ::1] label_proj_matrix,
+                          float[:, ::1] color_proj_matrix,
+                          float[:, :, ::1] z_tables,
+                          float[:, ::1] depth_map,
+                          float[:, :, ::1] label_probs,
+                          np.int32_t[:, ::1] label_ids,
+                          color_t[:, :, ::1] color_map,
+                          bint hard_labels,
+                          int unknown_label) noexcept nogil:
+        cdef int j, k, k_min, k_max
+        cdef float x = self.bbox[0, 0] + i * self.resolution
+        cdef float y
+        cdef float signed_distance
+        cdef int depth_image_proj_x, depth_image_proj_y
+        cdef int label_image_proj_x, label_image_proj_y
+        cdef int color_image_proj_x, color_image_proj_y
+        cdef int label_height, label_width
+        cdef ColumnProjection depth_column, label_column, color_column
+
+        if hard_labels:
+            label_height = label_ids.shape[0]
+            label_width = label_ids.shape[1]
+        else:
+            label_height = label_probs.shape[0]
+            label_width = label_probs.shape[1]
+
+        for j in range(bounds.j_min, bounds.j_max):
+            y = self.bbox[1, 0] + j * self.resolution
+            if not clip_column(depth_proj_matrix,
+                               depth_map.shape[1], depth_map.shape[0],
+                               far_depth, x, y, self.bbox[2, 0],
+                               self.resolution, self.volume_shape[2],
+                               &k_min, &k_max):
+                continue
+            depth_column = column_projection(depth_proj_matrix, x, y)
+            label_column = column_projection(label_proj_matrix, x, y)
+            color_column = column_projection(color_proj_matrix, x, y)
+            for k in range(k_min, k_max):
+                if not depth_signed_distance_column(&depth_column,
+                                                    z_tables[0], depth_map,
+                                                    k, &signed_distance,
+                                                    &depth_image_proj_x,
+                                                    &depth_image_proj_y):
+                    continue
+
+                if project_to_image_column(&label_column, z_tables[1],
+                                           label_height, label_width, k,
+                                           &label_image_proj_x,
+                                           &label_image_proj_y):
+                    if hard_labels:
+                        vote_label(&self.label_volume[i, j, k, 0],
+                                   self.num_labels, signed_distance,
+                                   self.max_distance, self.free_space_vote,
+                                   self.occupied_space_vote,
+                                   label_ids[label_image_proj_y,
+                                             label_image_proj_x],
+                                   unknown_label)
+                    else:
+                        vote_label_probs(&self.label_volume[i, j, k, 0],
+                                         signed_distance, self.max_distance,
+                                         self.free_space_vote,
+                                         self.occupied_space_vote,
+                                         label_probs, label_image_proj_x,
+                                         label_image_proj_y)
+
+                if project_to_image_column(&color_column, z_tables[2],
+                                           color_map.shape[0],
+                                           color_map.shape[1], k,
+                                           &color_image_proj_x,
+                                           &color_image_proj_y):
+                    update_color_sdf(&self.color_volume[i, j, k, 0],
+                                     &self.sdf_weight_data[i, j, k],
+                                     &self.color_weight_data[i, j, k],
+                                     signed_distance, self.max_distance,
+                                     color_map, color_image_proj_x,
+                                     color_image_proj_y)
+
+    cdef void _fuse(self,
+                    float[:, ::1] depth_proj_matrix,
+                    float[:, ::1] label_proj_matrix,
+                    float[:, ::1] color_proj_matrix,
+                    float[:, ::1] depth_map,
+                    float[:, :, ::1] label_probs,
+                    np.int32_t[:, ::1] label_ids,
+                    color_t[:, :, ::1] color_map,
+                    bint hard_labels,
+                    int unknown_label,
+                    int num_threads):
+        cdef int i
+        cdef float far_depth
+        cdef FrustumBounds bounds
+        cdef float[:, :, ::1] z_tables
+
+        # The z terms of the depth, label and color projections.
+        z_tables = np.empty((3, self.volume_shape[2], 3), dtype=np.float32)
+        fill_z_table(depth_proj_matrix, self.bbox[2, 0], self.resolution,
+                     z_tables[0])
+        fill_z_table(label_proj_matrix, self.bbox[2, 0], self.resolution,
+                     z_tables[1])
+        fill_z_table(color_proj_matrix, self.bbox[2, 0], self.resolution,
+                     z_tables[2])
+
+        # Both volumes use the same truncation distance, so they are updated
+        # in the same part of the frustum.
+        far_depth = max_depth(depth_map) + self.max_distance
+        bounds = frustum_voxel_bounds(depth_proj_matrix,
+                                      depth_map.shape[1], depth_map.shape[0],
+                                      far_depth, self.bbox, self.resolution,
+                                      self.volume_shape[0],
+                                      self.volume_shape[1])
+
+        for i in prange(bounds.i_min, bounds.i_max, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
+            self._fuse_slice(i, bounds, far_depth, depth_proj_matrix,
+                             label_proj_matrix, color_proj_matrix, z_tables,
+                             depth_map, label_probs, label_ids, color_map,
+                             hard_labels, unknown_label)
+
+    def fuse(self,
+             np.float32_t[:, ::1] depth_proj_matrix,
+             np.float32_t[:, ::1] label_proj_matrix,
+             np.float32_t[:, ::1] color_proj_matrix,
+             np.float32_t[:, ::1] depth_map,
+             np.float32_t[:, :, ::1] label_map,
+             color_t[:, :, ::1] color_map,
+             int num_threads=1):
+        # Same as TSDFVolume.fuse and ColorSDFVolume.fuse of the frame.
+        assert label_map.shape[2] == self.num_labels
+        assert color_map.shape[2] in (NUM_COLORS, NUM_COLORS + 1)
+        assert num_threads > 0
+
+        # Typed, so that _fuse is specialized for the color map.
+        cdef np.int32_t[:, ::1] label_ids = None
+        self._fuse(depth_proj_matrix, label_proj_matrix, color_proj_matrix,
+                   depth_map, label_map, label_ids, color_map, False, -1,
+                   num_threads)
+
+    def fuse_labels(self,
+                    np.float32_t[:, ::1] depth_proj_matrix,
+                    np.float32_t[:, ::1] label_proj_matrix,
+                    np.float32_t[:, ::1] color_proj_matrix,
+                    np.float32_t[:, ::1] depth_map,
+                    np.int32_t[:, ::1] label_map,
+                    color_t[:, :, ::1] color_map,
+                    int unknown_label=-1,
+                    int num_threads=1):
+        # Same as TSDFVolume.fuse_labels and ColorSDFVolume.fuse of the frame.
+        assert unknown_label < self.num_labels
+        assert color_map.shape[2] in (NUM_COLORS, NUM_COLORS + 1)
+        assert num_threads > 0
+
+        # Typed, so that _fuse is specialized for the color map.
+        cdef float[:, :, ::1] label_probs = None
+        self._fuse(depth_proj_matrix, label_proj_matrix, color_proj_matrix,
+                   depth_map, label_probs, label_map, color_map, True,
+                   unknown_label, num_threads)
+
+
+    cdef void _fuse_registered_slice(self, int i, FrustumBounds bounds,
+                                     float far_depth,
+                                     float[:, ::1] depth_proj_matrix,
+                                     float[:, ::1] depth_z_table,
+                                     float[:, ::1] depth_map,
+                                     float[:, :, ::1] label_probs,
+                                     np.int32_t[:, ::1] label_ids,
+                                     color_t[:, :, ::1] color_map,
+                                     bint hard_labels,
+                                     int unknown_label) noexcept nogil:
+        cdef int j, k, k_min, k_max
+        cdef float x = self.bbox[0, 0] + i * self.resolution
+        cdef float y
+        cdef float signed_distance
+        cdef int depth_image_proj_x, depth_image_proj_y
+        cdef ColumnProjection depth_column
+
+        for j in range(bounds.j_min, bounds.j_max):
+            y = self.bbox[1, 0] + j * self.resolution
+            if not clip_column(depth_proj_matrix,
+                               depth_map.shape[1], depth_map.shape[0],
+                               far_depth, x, y, self.bbox[2, 0],
+                               self.resolution, self.volume_shape[2],
+                               &k_min, &k_max):
+                continue
+            depth_column = column_projection(depth_proj_matrix, x, y)
+            for k in range(k_min, k_max):
+                if not depth_signed_distance_column(&depth_column,
+                                                    depth_z_table, depth_map,
+                                                    k, &signed_distance,
+                                                    &depth_image_proj_x,
+                                                    &depth_image_proj_y):
+                    continue
+
+                if hard_labels:
+                    vote_label(&self.label_volume[i, j, k, 0],
+                               self.num_labels, signed_distance,
+                               self.max_distance, self.free_space_vote,
+                               self.occupied_space_vote,
+                               label_ids[depth_image_proj_y,
+                                         depth_image_proj_x],
+                               unknown_label)
+                else:
+                    vote_label_probs(&self.label_volume[i, j, k, 0],
+                                     signed_distance, self.max_distance,
+                                     self.free_space_vote,
+                                     self.occupied_space_vote, label_probs,
+                                     depth_image_proj_x, depth_image_proj_y)
+
+                update_color_sdf(&self.color_volume[i, j, k, 0],
+                                 &self.sdf_weight_data[i, j, k],
+                                 &self.color_weight_data[i, j, k],
+                                 signed_distance, self.max_distance,
+                                 color_map, depth_image_proj_x,
+                                 depth_image_proj_y)
+
+    cdef void _fuse_registered(self,
+                               float[:, ::1] depth_proj_matrix,
+                               float[:, ::1] depth_map,
+                               float[:, :, ::1] label_probs,
+                               np.int32_t[:, ::1] label_ids,
+                               color_t[:, :, ::1] color_map,
+                               bint hard_labels,
+                               int unknown_label,
+                               int num_threads):
+        cdef int i
+        cdef float far_depth
+        cdef FrustumBounds bounds
+        cdef float[:, ::1] depth_z_table
+
+        depth_z_table = np.empty((self.volume_shape[2], 3), dtype=np.float32)
+        fill_z_table(depth_proj_matrix, self.bbox[2, 0], self.resolution,
+                     depth_z_table)
+
+        far_depth = max_depth(depth_map) + self.max_distance
+        bounds = frustum_voxel_bounds(depth_proj_matrix,
+                                      depth_map.shape[1], depth_map.shape[0],
+                                      far_depth, self.bbox, self.resolution,
+                                      self.volume_shape[0],
+                                      self.volume_shape[1])
+
+        for i in prange(bounds.i_min, bounds.i_max, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
+            self._fuse_registered_slice(i, bounds, far_depth,
+                                        depth_proj_matrix, depth_z_table,
+                                        depth_map, label_probs, label_ids,
+                                        color_map, hard_labels,
+                                        unknown_label)
 
-                    prior_color_weight = self.color_weight_data[i,j,k]
-                    new_color_weight = prior_color_weight+1.0
+    def fuse_registered(self,
+                        np.float32_t[:, ::1] depth_proj_matrix,
+                        np.float32_t[:, ::1] depth_map,
+                        np.float32_t[:, :, ::1] label_map,
+                        color_t[:, :, ::1] color_map,
+                        int num_threads=1):
+        # Same as TSDFVolume.fuse_registered and ColorSDFVolume.fuse_registered
+        # of the frame, for label and color images registered to the depth
+        # image (register_images). Every voxel is only projected into the
+        # depth image, and its label and color are read at the same pixel.
+        assert label_map.shape[0] == depth_map.shape[0]
+        assert label_map.shape[1] == depth_map.shape[1]
+        assert label_map.shape[2] == self.num_labels
+        assert color_map.shape[0] == depth_map.shape[0]
+        assert color_map.shape[1] == depth_map.shape[1]
+        assert color_map.shape[2] in (NUM_COLORS, NUM_COLORS + 1)
+        assert num_threads > 0
 
-                    for ch in range(color_map.shape[2]):
-                        self.volume[i, j, k, ch] = min((prior_color_weight * self.volume[i,j,k,ch] + 1.0 *  color_map[color_image_proj_y, color_image_proj_x, ch])/new_color_weight, 255.0)
+        # Typed, so that _fuse_registered is specialized for the color map.
+        cdef np.int32_t[:, ::1] label_ids = None
+        self._fuse_registered(depth_proj_matrix, depth_map, label_map,
+                              label_ids, color_map, False, -1, num_threads)
 
-                    self.color_weight_data[i,j,k] = new_color_weight
+    def fuse_labels_registered(self,
+                               np.float32_t[:, ::1] depth_proj_matrix,
+                               np.float32_t[:, ::1] depth_map,
+                               np.int32_t[:, ::1] label_map,
+                               color_t[:, :, ::1] color_map,
+                               int unknown_label=-1,
+                               int num_threads=1):
+        # Same as fuse_registered for a hard label image, see fuse_labels.
+        assert label_map.shape[0] == depth_map.shape[0]
+        assert label_map.shape[1] == depth_map.shape[1]
+        assert color_map.shape[0] == depth_map.shape[0]
+        assert color_map.shape[1] == depth_map.shape[1]
+        assert color_map.shape[2] in (NUM_COLORS, NUM_COLORS + 1)
+        assert unknown_label < self.num_labels
+        assert num_threads > 0
 
+        # Typed, so that _fuse_registered is specialized for the color map.
+        cdef float[:, :, ::1] label_probs = None
+        self._fuse_registered(depth_proj_matrix, depth_map, label_probs,
+                              label_map, color_map, True, unknown_label,
+                              num_threads)
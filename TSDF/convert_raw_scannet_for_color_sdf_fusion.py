@@ -124,8 +124,8 @@ def main():
             depth_map = skimage.io.imread(depth_map_path)
             depth_map = depth_map.astype(np.float32) / 1000
 
+            # The uint8 color map is fused as it is.
             color_map = skimage.io.imread(color_map_path)
-            color_map = color_map.astype(np.float32)
 
             # Write the output into one combined NumPy file.
             np.savez_compressed(
@@ -112,6 +112,9 @@ def parse_args():
     parser.add_argument("--label_map_path", required=True)
     parser.add_argument("--overwrite", type=int, default=False)
     parser.add_argument("--resolution", type=float, default=0.05)
+    # Also write the color images, so that the same images can be fused by
+    # tsdf_fusion, color_sdf_fusion and semantic_color_sdf_fusion.
+    parser.add_argument("--with_color", type=int, default=False)
     return parser.parse_args()
 
 
@@ -215,6 +218,13 @@ def main():
             assert os.path.exists(depth_map_path)
             assert os.path.exists(label_map_path)
 
+            color_arrays = {}
+            if args.with_color:
+                color_map_path = os.path.join(
+                    args.scene_path,
+                    "sensor/frame-{:06d}.color.jpg".format(image_id))
+                assert os.path.exists(color_map_path)
+
             pose = np.loadtxt(pose_path)
 
             proj_matrix = np.linalg.inv(pose)
@@ -235,27 +245,20 @@ def main():
                     label_map_converted[label_map==label] = label_mapping[label]
             label_map = label_map_converted
 
+            # The labels are annotated in the color images.
+            if args.with_color:
+                color_map = skimage.io.imread(color_map_path)
+                color_arrays["color_proj_matrix"] = label_proj_matrix
+                color_arrays["color_map"] = color_map
+
             # Write the output into one combined NumPy file.
             np.savez_compressed(
                 output_path,
                 depth_proj_matrix=depth_proj_matrix,
                 label_proj_matrix=label_proj_matrix,
                 depth_map=depth_map,
-                label_map=label_map)
-
-        else:
-            image = np.load(output_path)
-            depth_proj_matrix = image["depth_proj_matrix"]
-            label_proj_matrix = image["label_proj_matrix"]
-            depth_map = image["depth_map"]
-            label_map = image["label_map"]
-
-        # Convert label map to per class probability map.
-        label_probs = np.zeros((label_map.shape[0],
-                                label_map.shape[1],
-                                len(NYU40_LABELS)), dtype=np.float32)
-        rr, cc = np.mgrid[:label_map.shape[0], :label_map.shape[1]]
-        label_probs[(rr.ravel(), cc.ravel(), label_map.ravel())] = 1
+                label_map=label_map,
+                **color_arrays)
 
 
     # Save the label and color mapping.
@@ -0,0 +1,505 @@
+#cython: boundscheck=False
+#cython: initializedcheck=False
+#cython: cdivision=True
+
+from libc.math cimport floor, ceil
+
+
+# Safety margins used when culling, so that floating point differences between
+# the culling and the per-voxel projection can never reject a voxel that the
+# fusion kernels would have updated.
+cdef enum:
+    PIXEL_MARGIN = 1
+    VOXEL_MARGIN = 1
+
+# Side length in pixels of the tiles of the per-frame max depth grid.
+cdef enum:
+    DEPTH_TILE_SIZE = 8
+
+
+cdef struct FrustumBounds:
+    # Half-open voxel index ranges [min, max) along each axis.
+    int i_min
+    int i_max
+    int j_min
+    int j_max
+
+
+cdef inline float max_depth(float[:, ::1] depth_map) noexcept nogil:
+    cdef int r, c
+    cdef float max_value = 0
+    for r in range(depth_map.shape[0]):
+        for c in range(depth_map.shape[1]):
+            if depth_map[r, c] > max_value:
+                max_value = depth_map[r, c]
+    return max_value
+
+
+cdef inline int _clamp(int value, int low, int high) noexcept nogil:
+    if value < low:
+        return low
+    if value > high:
+        return high
+    return value
+
+
+cdef inline FrustumBounds frustum_voxel_bounds(float[:, ::1] proj_matrix,
+                                               int width, int height,
+                                               float far_depth,
+                                               float[:, ::1] bbox,
+                                               float resolution,
+                                               int nx, int ny) noexcept nogil:
+    # Compute the voxel index AABB of the camera frustum between the camera
+    # center and the plane at far_depth. The frustum is a pyramid, so its AABB
+    # is the AABB of the camera center and the four far corners, which we get
+    # by back-projecting the image corners through the inverse of the left
+    # 3x3 block of the projection matrix.
+    cdef FrustumBounds bounds
+    cdef double m[3][3]
+    cdef double inv[3][3]
+    cdef double p[3]
+    cdef double rhs[3]
+    cdef double corners[5][3]
+    cdef double us[2]
+    cdef double vs[2]
+    cdef double det, lo, hi
+    cdef int r, c, n, a
+
+    bounds.i_min = 0
+    bounds.i_max = nx
+    bounds.j_min = 0
+    bounds.j_max = ny
+
+    for r in range(3):
+        for c in range(3):
+            m[r][c] = proj_matrix[r, c]
+        p[r] = proj_matrix[r, 3]
+
+    inv[0][0] = m[1][1] * m[2][2] - m[1][2] * m[2][1]
+    inv[0][1] = m[0][2] * m[2][1] - m[0][1] * m[2][2]
+    inv[0][2] = m[0][1] * m[1][2] - m[0][2] * m[1][1]
+    inv[1][0] = m[1][2] * m[2][0] - m[1][0] * m[2][2]
+    inv[1][1] = m[0][0] * m[2][2] - m[0][2] * m[2][0]
+    inv[1][2] = m[0][2] * m[1][0] - m[0][0] * m[1][2]
+    inv[2][0] = m[1][0] * m[2][1] - m[1][1] * m[2][0]
+    inv[2][1] = m[0][1] * m[2][0] - m[0][0] * m[2][1]
+    inv[2][2] = m[0][0] * m[1][1] - m[0][1] * m[1][0]
+    det = m[0][0] * inv[0][0] + m[0][1] * inv[1][0] + m[0][2] * inv[2][0]
+
+    # Degenerate projection, fall back to sweeping the whole volume.
+    if det == 0:
+        return bounds
+
+    for r in range(3):
+        for c in range(3):
+            inv[r][c] /= det
+
+    # The camera center followed by the four far corners of the frustum.
+    us[0] = -0.5 - PIXEL_MARGIN
+    us[1] = width - 0.5 + PIXEL_MARGIN
+    vs[0] = -0.5 - PIXEL_MARGIN
+    vs[1] = height - 0.5 + PIXEL_MARGIN
+    for n in range(5):
+        if n == 0:
+            rhs[0] = -p[0]
+            rhs[1] = -p[1]
+            rhs[2] = -p[2]
+        else:
+            rhs[0] = far_depth * us[(n - 1) % 2] - p[0]
+            rhs[1] = far_depth * vs[(n - 1) // 2] - p[1]
+            rhs[2] = far_depth - p[2]
+        for r in range(3):
+            corners[n][r] = inv[r][0] * rhs[0] + \
+                            inv[r][1] * rhs[1] + \
+                            inv[r][2] * rhs[2]
+
+    for a in range(2):
+        lo = corners[0][a]
+        hi = corners[0][a]
+        for n in range(1, 5):
+            if corners[n][a] < lo:
+                lo = corners[n][a]
+            if corners[n][a] > hi:
+                hi = corners[n][a]
+        lo = floor((lo - bbox[a, 0]) / resolution) - VOXEL_MARGIN
+        hi = ceil((hi - bbox[a, 0]) / resolution) + VOXEL_MARGIN + 1
+        if a == 0:
+            bounds.i_min = _clamp(<int>lo, 0, nx)
+            bounds.i_max = _clamp(<int>hi, 0, nx)
+        else:
+            bounds.j_min = _clamp(<int>lo, 0, ny)
+            bounds.j_max = _clamp(<int>hi, 0, ny)
+
+    return bounds
+
+
+cdef inline bint _clip_halfspace(double a, double b,
+                                 double* k_min, double* k_max) noexcept nogil:
+    # Restrict [k_min, k_max] to the values of k with a + b * k >= 0.
+    if b > 0:
+        if -a / b > k_min[0]:
+            k_min[0] = -a / b
+    elif b < 0:
+        if -a / b < k_max[0]:
+            k_max[0] = -a / b
+    elif a < 0:
+        return False
+    return k_min[0] <= k_max[0]
+
+
+cdef inline bint clip_column(float[:, ::1] proj_matrix,
+                             int width, int height, float far_depth,
+                             float x, float y, float z0, float resolution,
+                             int nz, int* k_min, int* k_max) noexcept nogil:
+    # Clip the voxel column (x, y, z0 + k * resolution) against the frustum
+    # planes. Every projected coordinate is linear in k, so each plane
+    # restricts k to a half-line. Returns False if the column misses the
+    # frustum, otherwise sets the half-open range [k_min, k_max).
+    cdef double proj_x, proj_y, proj_z
+    cdef double step_x, step_y, step_z
+    cdef double lo = -VOXEL_MARGIN
+    cdef double hi = nz - 1 + VOXEL_MARGIN
+    cdef double low_u = 0.5 + PIXEL_MARGIN
+    cdef double high_u = width - 0.5 + PIXEL_MARGIN
+    cdef double low_v = 0.5 + PIXEL_MARGIN
+    cdef double high_v = height - 0.5 + PIXEL_MARGIN
+
+    proj_x = proj_matrix[0, 0] * x + proj_matrix[0, 1] * y + \
+             proj_matrix[0, 2] * z0 + proj_matrix[0, 3]
+    proj_y = proj_matrix[1, 0] * x + proj_matrix[1, 1] * y + \
+             proj_matrix[1, 2] * z0 + proj_matrix[1, 3]
+    proj_z = proj_matrix[2, 0] * x + proj_matrix[2, 1] * y + \
+             proj_matrix[2, 2] * z0 + proj_matrix[2, 3]
+    step_x = proj_matrix[0, 2] * resolution
+    step_y = proj_matrix[1, 2] * resolution
+    step_z = proj_matrix[2, 2] * resolution
+
+    # In front of the camera and not beyond the far plane.
+    if not _clip_halfspace(proj_z, step_z, &lo, &hi):
+        return False
+    if not _clip_halfspace(far_depth + resolution - proj_z, -step_z,
+                           &lo, &hi):
+        return False
+
+    # Inside the left, right, top and bottom planes of the image.
+    if not _clip_halfspace(proj_x + low_u * proj_z,
+                           step_x + low_u * step_z, &lo, &hi):
+        return False
+    if not _clip_halfspace(high_u * proj_z - proj_x,
+                           high_u * step_z - step_x, &lo, &hi):
+        return False
+    if not _clip_halfspace(proj_y + low_v * proj_z,
+                           step_y + low_v * step_z, &lo, &hi):
+        return False
+    if not _clip_halfspace(high_v * proj_z - proj_y,
+                           high_v * step_z - step_y, &lo, &hi):
+        return False
+
+    k_min[0] = _clamp(<int>floor(lo) - VOXEL_MARGIN, 0, nz)
+    k_max[0] = _clamp(<int>ceil(hi) + VOXEL_MARGIN + 1, 0, nz)
+    return k_min[0] < k_max[0]
+
+
+cdef inline void tile_max_depth(float[:, ::1] depth_map,
+                                float[:, ::1] tiles) noexcept nogil:
+    # Maximum depth in every DEPTH_TILE_SIZE x DEPTH_TILE_SIZE tile of the
+    # depth map, tiles has to be zero-initialized.
+    cdef int r, c
+    for r in range(depth_map.shape[0]):
+        for c in range(depth_map.shape[1]):
+            if depth_map[r, c] > tiles[r // DEPTH_TILE_SIZE,
+                                       c // DEPTH_TILE_SIZE]:
+                tiles[r // DEPTH_TILE_SIZE, c // DEPTH_TILE_SIZE] = \
+                    depth_map[r, c]
+
+
+cdef inline bint box_in_frustum(float[:, ::1] proj_matrix,
+                                float[:, ::1] tiles, int width, int height,
+                                float max_distance, float x0, float y0,
+                                float z0, float extent) noexcept nogil:
+    # Conservatively test whether fusing a frame can update a point in the
+    # box [x0, x0 + extent] x [y0, y0 + extent] x [z0, z0 + extent]. The box
+    # is rejected if it projects outside of the image, or if it is further
+    # from the camera than the largest depth (plus max_distance) of the depth
+    # tiles covered by its projection.
+    cdef double proj_x, proj_y, proj_z
+    cdef double u_min = 0, u_max = 0, v_min = 0, v_max = 0, z_min = 0
+    cdef double tile_depth = 0
+    cdef int n, r, c, r_min, r_max, c_min, c_max
+    cdef int num_behind = 0
+
+    for n in range(8):
+        proj_x = proj_matrix[0, 0] * (x0 + (n & 1) * extent) + \
+                 proj_matrix[0, 1] * (y0 + ((n >> 1) & 1) * extent) + \
+                 proj_matrix[0, 2] * (z0 + ((n >> 2) & 1) * extent) + \
+                 proj_matrix[0, 3]
+        proj_y = proj_matrix[1, 0] * (x0 + (n & 1) * extent) + \
+                 proj_matrix[1, 1] * (y0 + ((n >> 1) & 1) * extent) + \
+                 proj_matrix[1, 2] * (z0 + ((n >> 2) & 1) * extent) + \
+                 proj_matrix[1, 3]
+        proj_z = proj_matrix[2, 0] * (x0 + (n & 1) * extent) + \
+                 proj_matrix[2, 1] * (y0 + ((n >> 1) & 1) * extent) + \
+                 proj_matrix[2, 2] * (z0 + ((n >> 2) & 1) * extent) + \
+                 proj_matrix[2, 3]
+        if proj_z <= 0:
+            num_behind += 1
+            continue
+        if n == num_behind or proj_z < z_min:
+            z_min = proj_z
+        if n == num_behind or proj_x / proj_z < u_min:
+            u_min = proj_x / proj_z
+        if n == num_behind or proj_x / proj_z > u_max:
+            u_max = proj_x / proj_z
+        if n == num_behind or proj_y / proj_z < v_min:
+            v_min = proj_y / proj_z
+        if n == num_behind or proj_y / proj_z > v_max:
+            v_max = proj_y / proj_z
+
+    # Entirely behind the camera.
+    if num_behind == 8:
+        return False
+
+    # The box crosses the camera plane, so its projection is unbounded.
+    if num_behind > 0:
+        return True
+
+    c_min = _clamp(<int>floor(u_min - PIXEL_MARGIN), 0, width)
+    c_max = _clamp(<int>ceil(u_max + PIXEL_MARGIN), -1, width - 1)
+    r_min = _clamp(<int>floor(v_min - PIXEL_MARGIN), 0, height)
+    r_max = _clamp(<int>ceil(v_max + PIXEL_MARGIN), -1, height - 1)
+    if c_min > c_max or r_min > r_max:
+        return False
+
+    for r in range(r_min // DEPTH_TILE_SIZE, r_max // DEPTH_TILE_SIZE + 1):
+        for c in range(c_min // DEPTH_TILE_SIZE,
+                       c_max // DEPTH_TILE_SIZE + 1):
+            if tiles[r, c] > tile_depth:
+                tile_depth = tiles[r, c]
+
+    # Relative margin for rounding differences to the per-voxel projection.
+    return z_min <= (tile_depth + max_distance) * 1.001 + 0.001
+
+
+# Maximum number of levels of a depth pyramid, enough for any image size.
+cdef enum:
+    MAX_PYRAMID_LEVELS = 32
+
+# Classification of a voxel box against a depth pyramid.
+cdef enum:
+    BOX_OUTSIDE = 0
+    BOX_SURFACE = 1
+    BOX_FREE = 2
+
+
+cdef struct DepthPyramid:
+    # Level l stores the min and max depth of the 2^l x 2^l pixel cells of
+    # the depth map, in row-major order at offsets[l] of the min and max
+    # arrays. Level 0 is the depth map and the last level a single cell.
+    int num_levels
+    int widths[MAX_PYRAMID_LEVELS]
+    int heights[MAX_PYRAMID_LEVELS]
+    Py_ssize_t offsets[MAX_PYRAMID_LEVELS]
+
+
+cdef struct ProjectedBox:
+    # Image space bounds of the corners of a box, u, v and z are only valid
+    # if no corner is behind the camera.
+    int num_behind
+    double u_min
+    double u_max
+    double v_min
+    double v_max
+    double z_min
+    double z_max
+
+
+cdef inline Py_ssize_t init_depth_pyramid(
+        int width, int height, DepthPyramid* pyramid) noexcept nogil:
+    # Set the level sizes of the pyramid of a width x height depth map and
+    # return the number of values of its min and max arrays.
+    cdef Py_ssize_t size = 0
+    cdef int l = 0
+    while True:
+        pyramid.widths[l] = width
+        pyramid.heights[l] = height
+        pyramid.offsets[l] = size
+        size += <Py_ssize_t>width * height
+        l += 1
+        if width == 1 and height == 1:
+            break
+        width = (width + 1) // 2
+        height = (height + 1) // 2
+    pyramid.num_levels = l
+    return size
+
+
+cdef inline void build_depth_pyramid(float[:, ::1] depth_map,
+                                     DepthPyramid* pyramid,
+                                     float[::1] min_depths,
+                                     float[::1] max_depths) noexcept nogil:
+    # Fill the min and max arrays of a pyramid set up by init_depth_pyramid.
+    # Missing depths (0) are included, so a cell with a missing depth has a
+    # min depth of 0.
+    cdef int l, r, c, dr, dc, r2, c2
+    cdef Py_ssize_t src, dst
+    cdef float min_value, max_value
+
+    for r in range(depth_map.shape[0]):
+        for c in range(depth_map.shape[1]):
+            min_depths[r * depth_map.shape[1] + c] = depth_map[r, c]
+            max_depths[r * depth_map.shape[1] + c] = depth_map[r, c]
+
+    for l in range(1, pyramid.num_levels):
+        src = pyramid.offsets[l - 1]
+        dst = pyramid.offsets[l]
+        for r in range(pyramid.heights[l]):
+            for c in range(pyramid.widths[l]):
+                min_value = min_depths[src + 2 * r * pyramid.widths[l - 1] +
+                                       2 * c]
+                max_value = max_depths[src + 2 * r * pyramid.widths[l - 1] +
+                                       2 * c]
+                for dr in range(2):
+                    for dc in range(2):
+                        r2 = 2 * r + dr
+                        c2 = 2 * c + dc
+                        if (r2 >= pyramid.heights[l - 1] or
+                                c2 >= pyramid.widths[l - 1]):
+                            continue
+                        if min_depths[src + r2 * pyramid.widths[l - 1] +
+                                      c2] < min_value:
+                            min_value = min_depths[
+                                src + r2 * pyramid.widths[l - 1] + c2]
+                        if max_depths[src + r2 * pyramid.widths[l - 1] +
+                                      c2] > max_value:
+                            max_value = max_depths[
+                                src + r2 * pyramid.widths[l - 1] + c2]
+                min_depths[dst + r * pyramid.widths[l] + c] = min_value
+                max_depths[dst + r * pyramid.widths[l] + c] = max_value
+
+
+cdef inline void pyramid_depth_range(DepthPyramid* pyramid,
+                                     float[::1] min_depths,
+                                     float[::1] max_depths,
+                                     int c_min, int c_max, int r_min,
+                                     int r_max, float* depth_low,
+                                     float* depth_high) noexcept nogil:
+    # Bounds of the depths in the pixel rectangle [c_min, c_max] x
+    # [r_min, r_max] (inclusive, inside of the image), read from the first
+    # level at which the rectangle covers at most 2 x 2 cells. The cells may
+    # extend beyond the rectangle, so the bounds are conservative.
+    cdef int l = 0
+    cdef int r, c
+    cdef Py_ssize_t index
+
+    while ((c_max >> l) - (c_min >> l) > 1 or
+           (r_max >> l) - (r_min >> l) > 1):
+        l += 1
+
+    index = pyramid.offsets[l] + (r_min >> l) * pyramid.widths[l] + \
+        (c_min >> l)
+    depth_low[0] = min_depths[index]
+    depth_high[0] = max_depths[index]
+    for r in range(r_min >> l, (r_max >> l) + 1):
+        for c in range(c_min >> l, (c_max >> l) + 1):
+            index = pyramid.offsets[l] + r * pyramid.widths[l] + c
+            if min_depths[index] < depth_low[0]:
+                depth_low[0] = min_depths[index]
+            if max_depths[index] > depth_high[0]:
+                depth_high[0] = max_depths[index]
+
+
+cdef inline void project_box(float[:, ::1] proj_matrix, float x0, float y0,
+                             float z0, float extent,
+                             ProjectedBox* box) noexcept nogil:
+    # Project the corners of the box [x0, x0 + extent] x [y0, y0 + extent] x
+    # [z0, z0 + extent]. If they are all in front of the camera, the
+    # projection of every point of the box lies in their bounds.
+    cdef double x, y, z, proj_x, proj_y, proj_z, u, v
+    cdef int n
+
+    box.num_behind = 0
+    for n in range(8):
+        x = x0 + (n & 1) * extent
+        y = y0 + ((n >> 1) & 1) * extent
+        z = z0 + ((n >> 2) & 1) * extent
+        proj_z = proj_matrix[2, 0] * x + proj_matrix[2, 1] * y + \
+                 proj_matrix[2, 2] * z + proj_matrix[2, 3]
+        if proj_z <= 0:
+            box.num_behind += 1
+            continue
+        proj_x = proj_matrix[0, 0] * x + proj_matrix[0, 1] * y + \
+                 proj_matrix[0, 2] * z + proj_matrix[0, 3]
+        proj_y = proj_matrix[1, 0] * x + proj_matrix[1, 1] * y + \
+                 proj_matrix[1, 2] * z + proj_matrix[1, 3]
+        u = proj_x / proj_z
+        v = proj_y / proj_z
+        if n == box.num_behind:
+            box.u_min = box.u_max = u
+            box.v_min = box.v_max = v
+            box.z_min = box.z_max = proj_z
+            continue
+        box.u_min = min(box.u_min, u)
+        box.u_max = max(box.u_max, u)
+        box.v_min = min(box.v_min, v)
+        box.v_max = max(box.v_max, v)
+        box.z_min = min(box.z_min, proj_z)
+        box.z_max = max(box.z_max, proj_z)
+
+
+cdef inline bint box_inside_image(ProjectedBox* box, int width,
+                                  int height) noexcept nogil:
+    # Whether every point of a projected box is in front of the camera and
+    # its pixel (the rounded projection) is inside of the image.
+    return (box.num_behind == 0 and
+            box.u_min - PIXEL_MARGIN >= 0 and
+            box.u_max + PIXEL_MARGIN <= width - 1 and
+            box.v_min - PIXEL_MARGIN >= 0 and
+            box.v_max + PIXEL_MARGIN <= height - 1)
+
+
+cdef inline int classify_box(float[:, ::1] proj_matrix,
+                             DepthPyramid* pyramid, float[::1] min_depths,
+                             float[::1] max_depths, int width, int height,
+                             float max_distance, float x0, float y0, float z0,
+                             float extent) noexcept nogil:
+    # Conservatively classify the box [x0, x0 + extent] x [y0, y0 + extent] x
+    # [z0, z0 + extent] against the depth map of the pyramid. BOX_OUTSIDE: no
+    # point of the box is updated, because it projects outside of the image
+    # or lies behind the truncation band of every depth it projects to.
+    # BOX_FREE: every point projects inside of the image and lies in front of
+    # the truncation band of its depth, so it only gets a free space vote.
+    # BOX_SURFACE: anything else, which needs the per-voxel projection.
+    cdef ProjectedBox box
+    cdef int c_min, c_max, r_min, r_max
+    cdef float depth_low = 0
+    cdef float depth_high = 0
+
+    project_box(proj_matrix, x0, y0, z0, extent, &box)
+
+    # Entirely behind the camera.
+    if box.num_behind == 8:
+        return BOX_OUTSIDE
+
+    # The box crosses the camera plane, so its projection is unbounded.
+    if box.num_behind > 0:
+        return BOX_SURFACE
+
+    if (box.u_max + PIXEL_MARGIN < 0 or box.u_min - PIXEL_MARGIN > width - 1 or
+            box.v_max + PIXEL_MARGIN < 0 or
+            box.v_min - PIXEL_MARGIN > height - 1):
+        return BOX_OUTSIDE
+
+    c_min = <int>floor(max(box.u_min - PIXEL_MARGIN, 0))
+    c_max = <int>ceil(min(box.u_max + PIXEL_MARGIN, width - 1))
+    r_min = <int>floor(max(box.v_min - PIXEL_MARGIN, 0))
+    r_max = <int>ceil(min(box.v_max + PIXEL_MARGIN, height - 1))
+    pyramid_depth_range(pyramid, min_depths, max_depths, c_min, c_max,
+                        r_min, r_max, &depth_low, &depth_high)
+
+    # Relative margins for rounding differences to the per-voxel projection.
+    if box.z_min > (depth_high + max_distance) * 1.001 + 0.001:
+        return BOX_OUTSIDE
+    if (box_inside_image(&box, width, height) and
+            (box.z_max + max_distance) * 1.001 + 0.001 < depth_low):
+        return BOX_FREE
+    return BOX_SURFACE
@@ -0,0 +1,117 @@
+#cython: boundscheck=False
+#cython: initializedcheck=False
+#cython: cdivision=True
+
+from libc.stdint cimport uint16_t
+
+from precision cimport float_to_half, half_to_float
+
+
+cdef inline void vote_label_probs(float* voxel, float signed_distance,
+                                  float max_distance, float free_space_vote,
+                                  float occupied_space_vote,
+                                  float[:, :, ::1] label_map,
+                                  int label_image_proj_x,
+                                  int label_image_proj_y) noexcept nogil:
+    # Accumulate the votes of one observation into the label channels of a
+    # voxel, whose last channel is the free space channel.
+    cdef int label
+    cdef int num_labels = label_map.shape[2]
+    cdef float label_prob
+
+    # Check if voxel is inside the truncated distance field.
+    if abs(signed_distance) > max_distance:
+        # Check if voxel is between observed depth and camera.
+        if signed_distance > 0:
+            # Vote for free space.
+            voxel[num_labels] -= free_space_vote
+        return
+
+    # Accumulate the votes for each label.
+    for label in range(num_labels):
+        label_prob = label_map[label_image_proj_y, label_image_proj_x, label]
+        if signed_distance < 0:
+            voxel[label] -= label_prob * occupied_space_vote
+        else:
+            voxel[label] += label_prob * occupied_space_vote
+
+
+cdef inline void vote_label(float* voxel, int num_labels,
+                            float signed_distance, float max_distance,
+                            float free_space_vote, float occupied_space_vote,
+                            int label, int unknown_label) noexcept nogil:
+    # Same as vote_label_probs for a hard label. Labels outside
+    # [0, num_labels) are voted to unknown_label, or only contribute free
+    # space votes if unknown_label is negative.
+
+    # Check if voxel is inside the truncated distance field.
+    if abs(signed_distance) > max_distance:
+        # Check if voxel is between observed depth and camera.
+        if signed_distance > 0:
+            # Vote for free space.
+            voxel[num_labels] -= free_space_vote
+        return
+
+    # Accumulate the vote for the observed label.
+    if label < 0 or label >= num_labels:
+        label = unknown_label
+        if label < 0:
+            return
+    if signed_distance < 0:
+        voxel[label] -= occupied_space_vote
+    else:
+        voxel[label] += occupied_space_vote
+
+
+cdef inline void vote_label_probs_half(uint16_t* voxel, float signed_distance,
+                                       float max_distance,
+                                       float free_space_vote,
+                                       float occupied_space_vote,
+                                       float[:, :, ::1] label_map,
+                                       int label_image_proj_x,
+                                       int label_image_proj_y) noexcept nogil:
+    # Same as vote_label_probs for a voxel stored as float16 bits.
+    cdef int label
+    cdef int num_labels = label_map.shape[2]
+    cdef float label_prob
+
+    if abs(signed_distance) > max_distance:
+        if signed_distance > 0:
+            voxel[num_labels] = float_to_half(
+                half_to_float(voxel[num_labels]) - free_space_vote)
+        return
+
+    for label in range(num_labels):
+        label_prob = label_map[label_image_proj_y, label_image_proj_x, label]
+        if label_prob == 0:
+            continue
+        if signed_distance < 0:
+            voxel[label] = float_to_half(
+                half_to_float(voxel[label]) - label_prob * occupied_space_vote)
+        else:
+            voxel[label] = float_to_half(
+                half_to_float(voxel[label]) + label_prob * occupied_space_vote)
+
+
+cdef inline void vote_label_half(uint16_t* voxel, int num_labels,
+                                 float signed_distance, float max_distance,
+                                 float free_space_vote,
+                                 float occupied_space_vote,
+                                 int label, int unknown_label) noexcept nogil:
+    # Same as vote_label for a voxel stored as float16 bits.
+    if abs(signed_distance) > max_distance:
+        if signed_distance > 0:
+            voxel[num_labels] = float_to_half(
+                half_to_float(voxel[num_labels]) - free_space_vote)
+        return
+
+    if label < 0 or label >= num_labels:
+        label = unknown_label
+        if label < 0:
+            return
+    if signed_distance < 0:
+        voxel[label] = float_to_half(
+            half_to_float(voxel[label]) - occupied_space_vote)
+    else:
+        voxel[label] = float_to_half(
+            half_to_float(voxel[label]) + occupied_space_vote)
@@ -0,0 +1,42 @@
+import os
+import numpy as np
+
+
+def weight_path(volume_path, name):
+    # The .npy file next to a memory-mapped color sdf volume that holds one of
+    # its weight grids, e.g. scene.npy -> scene.sdf_weight_data.npy.
+    return os.path.splitext(volume_path)[0] + "." + name + ".npy"
+
+
+def open_volume(volume, shape, dtype, fill_value=0):
+    # The array that backs a volume: either volume itself, e.g. a np.memmap
+    # or a slab of one, which is used as is, or the path of a .npy file,
+    # which is memory-mapped and created filled with fill_value (broadcast
+    # over the volume) if it does not exist. The kernels write into the
+    # array in place, so it must be C-contiguous and have the shape and dtype
+    # of the volume.
+    if isinstance(volume, str):
+        if os.path.exists(volume):
+            volume = np.load(volume, mmap_mode="r+")
+        else:
+            volume_dir = os.path.dirname(volume)
+            if volume_dir:
+                os.makedirs(volume_dir, exist_ok=True)
+            volume = np.lib.format.open_memmap(volume, mode="w+",
+                                               dtype=dtype,
+                                               shape=tuple(shape))
+            # A new file reads as zeros without touching its pages.
+            if np.any(fill_value):
+                volume[...] = fill_value
+    assert tuple(volume.shape) == tuple(shape), \
+        "volume shape {} instead of {}".format(volume.shape, tuple(shape))
+    assert volume.dtype == dtype, \
+        "volume dtype {} instead of {}".format(volume.dtype, np.dtype(dtype))
+    assert volume.flags.c_contiguous and volume.flags.writeable
+    return volume
+
+
+def flush_volume(volume):
+    # Write the updated pages of a memory-mapped array to its file.
+    if isinstance(volume, np.memmap):
+        volume.flush()
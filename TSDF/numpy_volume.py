@@ -0,0 +1,339 @@
+import numpy as np
+
+from memmap_volume import open_volume, flush_volume, weight_path
+
+
+# NumPy versions of the dense full precision TSDFVolume (tsdf_volume) and
+# ColorSDFVolume (color_sdf_volume), which only need NumPy, see backends.py.
+# The volume is fused in slabs of slab_size voxels along z, all voxels of a
+# slab are projected and updated at once. The projections and updates are
+# evaluated in the same order and precision as in the kernels, so both
+# backends fuse the same volumes, see benchmark_backends.
+
+
+# Number of color channels of the color sdf volume, the fourth (alpha)
+# channel of RGBA color maps is ignored.
+NUM_COLORS = 3
+
+
+def voxel_coordinates(origin, resolution, begin, end):
+    # The float32 coordinates origin + i * resolution of the voxels
+    # [begin, end) along an axis.
+    return origin + np.arange(begin, end).astype(np.float32) * resolution
+
+
+def round_half_away(values):
+    # libc round of float32 values.
+    values = values.astype(np.float64)
+    return np.copysign(np.floor(np.abs(values) + 0.5), values)
+
+
+def column_terms(proj_matrix, x, y):
+    # The x and y terms m[r, 0] * x + m[r, 1] * y of the rows of a projection
+    # matrix for all voxel columns, see projection.ColumnProjection.
+    return [proj_matrix[r, 0] * x[:, None, None] +
+            proj_matrix[r, 1] * y[None, :, None] for r in range(3)]
+
+
+def project_slab(proj_matrix, xy_terms, z, image_height, image_width):
+    # Project the voxels of a slab with the z coordinates z into an image.
+    # Returns the mask of the voxels in front of the camera that project into
+    # the image, their pixel locations and their depths.
+    proj = [xy_terms[r] + proj_matrix[r, 2] * z[None, None, :] +
+            proj_matrix[r, 3] for r in range(3)]
+    valid = proj[2] > 0
+    proj_z = np.where(valid, proj[2], np.float32(1))
+    pixel_x = round_half_away(proj[0] / proj_z)
+    pixel_y = round_half_away(proj[1] / proj_z)
+    valid &= (pixel_x >= 0) & (pixel_y >= 0) & \
+        (pixel_x < image_width) & (pixel_y < image_height)
+    pixel_x = np.where(valid, pixel_x, 0).astype(np.intp)
+    pixel_y = np.where(valid, pixel_y, 0).astype(np.intp)
+    return valid, pixel_x, pixel_y, proj[2]
+
+
+def volume_shape(bbox, resolution):
+    # Same as the shape computed by the kernels for a float32 resolution.
+    volume_size = np.diff(bbox, axis=1)
+    volume_shape = volume_size.ravel() / float(resolution)
+    return np.ceil(volume_shape).astype(np.int32).tolist()
+
+
+class SlabVolume:
+
+    # The slab sweep shared by the volumes. For every slab of every frame,
+    # _fuse_slab gets the mask of the voxels that project into the depth
+    # image and the second (label or color) image, their signed distances to
+    # the measured depths and their pixels in the second image.
+
+    def _sweep(self, depth_proj_matrix, image_proj_matrix, depth_map,
+               image_height, image_width, fuse_slab):
+        # A second image without projection matrix is registered to the depth
+        # image, see registration.register_to_depth.
+        x = voxel_coordinates(self.bbox[0, 0], self.resolution,
+                              self.x_offset, self.x_offset + self.shape[0])
+        y = voxel_coordinates(self.bbox[1, 0], self.resolution, 0,
+                              self.shape[1])
+        depth_xy = column_terms(depth_proj_matrix, x, y)
+        if image_proj_matrix is not None:
+            image_xy = column_terms(image_proj_matrix, x, y)
+
+        # Projections far outside of the image overflow, they are outside.
+        with np.errstate(over="ignore", invalid="ignore"):
+            for k_begin in range(0, self.shape[2], self.slab_size):
+                k_end = min(k_begin + self.slab_size, self.shape[2])
+                z = voxel_coordinates(self.bbox[2, 0], self.resolution,
+                                      k_begin, k_end)
+                valid, depth_x, depth_y, depth_z = project_slab(
+                    depth_proj_matrix, depth_xy, z, depth_map.shape[0],
+                    depth_map.shape[1])
+                if image_proj_matrix is None:
+                    image_x, image_y = depth_x, depth_y
+                else:
+                    image_valid, image_x, image_y, _ = project_slab(
+                        image_proj_matrix, image_xy, z, image_height,
+                        image_width)
+                    valid &= image_valid
+                if not valid.any():
+                    continue
+                signed_distance = depth_map[depth_y, depth_x] - depth_z
+                fuse_slab(k_begin, k_end, valid, signed_distance, image_x,
+                          image_y)
+
+
+class TSDFVolume(SlabVolume):
+
+    def __init__(self, num_labels, bbox, resolution, resolution_factor,
+                 free_space_vote=0.5, occupied_space_vote=1, x_range=None,
+                 precision="full", volume=None, slab_size=16):
+        assert num_labels > 0
+        assert precision == "full", \
+            "the numpy backend only fuses full precision volumes"
+        assert resolution > 0
+        assert resolution_factor > 0
+        assert free_space_vote >= 0
+        assert occupied_space_vote >= 0
+        assert slab_size > 0
+
+        self.bbox = bbox.astype(np.float32)
+        self.resolution = np.float32(resolution)
+        self.max_distance = np.float32(resolution_factor *
+                                       float(self.resolution))
+        self.free_space_vote = np.float32(free_space_vote)
+        self.occupied_space_vote = np.float32(occupied_space_vote)
+        self.slab_size = slab_size
+
+        shape = volume_shape(bbox, self.resolution)
+
+        # See tsdf_volume.TSDFVolume.__init__ for x_range and volume.
+        self.x_offset = 0
+        if x_range is not None:
+            assert 0 <= x_range[0] < x_range[1] <= shape[0]
+            self.x_offset = x_range[0]
+            shape[0] = x_range[1] - x_range[0]
+        self.shape = shape
+
+        if volume is not None:
+            self.volume = open_volume(volume, shape + [num_labels + 1],
+                                      np.float32)
+        else:
+            self.volume = np.zeros(shape + [num_labels + 1],
+                                   dtype=np.float32)
+
+    def get_volume(self, copy=True):
+        return np.array(self.volume, copy=copy)
+
+    def set_volume(self, volume):
+        assert volume.shape == self.volume.shape
+        self.volume[...] = volume
+
+    def flush(self):
+        flush_volume(self.volume)
+
+    def _fuse(self, depth_proj_matrix, label_proj_matrix, depth_map,
+              label_map, hard_labels, unknown_label):
+        num_labels = self.volume.shape[3] - 1
+        depth_map = np.asarray(depth_map, dtype=np.float32)
+
+        def fuse_slab(k_begin, k_end, valid, signed_distance, label_x,
+                      label_y):
+            slab = self.volume[:, :, k_begin:k_end]
+
+            # Voxels between the camera and the truncation band vote for free
+            # space, see label_votes.vote_label_probs.
+            free = valid & (signed_distance > self.max_distance)
+            free_space = slab[..., num_labels]
+            free_space[free] -= self.free_space_vote
+
+            band = valid & (np.abs(signed_distance) <= self.max_distance)
+            behind = signed_distance[band] < 0
+            if hard_labels:
+                labels = label_map[label_y[band], label_x[band]]
+                labels[(labels < 0) | (labels >= num_labels)] = unknown_label
+                votes = np.where(behind, -self.occupied_space_vote,
+                                 self.occupied_space_vote)
+                voted = labels >= 0
+                i, j, k = np.nonzero(band)
+                slab[i[voted], j[voted], k[voted], labels[voted]] += \
+                    votes[voted]
+            else:
+                votes = label_map[label_y[band], label_x[band]] * \
+                    self.occupied_space_vote
+                label_votes = slab[..., :num_labels]
+                label_votes[band] += np.where(behind[:, None], -votes, votes)
+
+        self._sweep(np.asarray(depth_proj_matrix, dtype=np.float32),
+                    None if label_proj_matrix is None else
+                    np.asarray(label_proj_matrix, dtype=np.float32),
+                    depth_map, label_map.shape[0], label_map.shape[1],
+                    fuse_slab)
+
+    def fuse(self, depth_proj_matrix, label_proj_matrix, depth_map,
+             label_map, num_threads=1):
+        # num_threads is accepted for the kernel signatures, the slabs are
+        # fused by NumPy in the calling thread.
+        label_map = np.asarray(label_map, dtype=np.float32)
+        assert label_map.shape[2] == self.volume.shape[3] - 1
+        self._fuse(depth_proj_matrix, label_proj_matrix, depth_map,
+                   label_map, False, -1)
+
+    def fuse_labels(self, depth_proj_matrix, label_proj_matrix, depth_map,
+                    label_map, unknown_label=-1, num_threads=1):
+        assert unknown_label < self.volume.shape[3] - 1
+        self._fuse(depth_proj_matrix, label_proj_matrix, depth_map,
+                   np.asarray(label_map, dtype=np.int32), True,
+                   unknown_label)
+
+    def fuse_registered(self, depth_proj_matrix, depth_map, label_map,
+                        num_threads=1):
+        label_map = np.asarray(label_map, dtype=np.float32)
+        assert label_map.shape[:2] == depth_map.shape
+        assert label_map.shape[2] == self.volume.shape[3] - 1
+        self._fuse(depth_proj_matrix, None, depth_map, label_map, False, -1)
+
+    def fuse_labels_registered(self, depth_proj_matrix, depth_map, label_map,
+                               unknown_label=-1, num_threads=1):
+        assert label_map.shape == depth_map.shape
+        assert unknown_label < self.volume.shape[3] - 1
+        self._fuse(depth_proj_matrix, None, depth_map,
+                   np.asarray(label_map, dtype=np.int32), True,
+                   unknown_label)
+
+
+class ColorSDFVolume(SlabVolume):
+
+    def __init__(self, bbox, resolution, resolution_factor, precision="full",
+                 volume=None, sdf_weight_data=None, color_weight_data=None,
+                 slab_size=16):
+        assert resolution > 0
+        assert resolution_factor > 0
+        assert precision == "full", \
+            "the numpy backend only fuses full precision volumes"
+        assert slab_size > 0
+
+        self.bbox = bbox.astype(np.float32)
+        self.resolution = np.float32(resolution)
+        self.max_distance = np.float32(resolution_factor *
+                                       float(self.resolution))
+        self.slab_size = slab_size
+        self.x_offset = 0
+        self.shape = volume_shape(bbox, self.resolution)
+
+        # See color_sdf_volume.ColorSDFVolume.__init__ for the volume and
+        # weight files.
+        if volume is not None:
+            if isinstance(volume, str):
+                if sdf_weight_data is None:
+                    sdf_weight_data = weight_path(volume, "sdf_weight_data")
+                if color_weight_data is None:
+                    color_weight_data = weight_path(volume, "color_weight_data")
+            assert sdf_weight_data is not None and \
+                color_weight_data is not None
+            self.volume = open_volume(
+                volume, self.shape + [NUM_COLORS + 1], np.float32,
+                np.array([0, 0, 0, self.max_distance], dtype=np.float32))
+            self.sdf_weight_data = open_volume(sdf_weight_data, self.shape,
+                                               np.float32)
+            self.color_weight_data = open_volume(color_weight_data,
+                                                 self.shape, np.float32)
+        else:
+            self.volume = np.zeros(self.shape + [NUM_COLORS + 1],
+                                   dtype=np.float32)
+            self.volume[..., -1] = self.max_distance
+            self.sdf_weight_data = np.zeros(self.shape, dtype=np.float32)
+            self.color_weight_data = np.zeros(self.shape, dtype=np.float32)
+
+    def get_volume(self, copy=True):
+        return np.array(self.volume, copy=copy)
+
+    def get_sdf_weight_data(self, copy=True):
+        return np.array(self.sdf_weight_data, copy=copy)
+
+    def get_color_weight_data(self, copy=True):
+        return np.array(self.color_weight_data, copy=copy)
+
+    def set_volume(self, volume, sdf_weight_data, color_weight_data):
+        assert volume.shape == self.volume.shape
+        assert sdf_weight_data.shape == volume.shape[:3]
+        assert color_weight_data.shape == volume.shape[:3]
+        self.volume[...] = volume
+        self.sdf_weight_data[...] = sdf_weight_data
+        self.color_weight_data[...] = color_weight_data
+
+    def flush(self):
+        for array in (self.volume, self.sdf_weight_data,
+                      self.color_weight_data):
+            flush_volume(array)
+
+    def _fuse(self, depth_proj_matrix, color_proj_matrix, depth_map,
+              color_map):
+        # float32 or uint8 color maps, see color_sdf_volume.
+        assert color_map.dtype in (np.float32, np.uint8)
+        assert color_map.shape[2] in (NUM_COLORS, NUM_COLORS + 1)
+        depth_map = np.asarray(depth_map, dtype=np.float32)
+
+        def fuse_slab(k_begin, k_end, valid, signed_distance, color_x,
+                      color_y):
+            # The running averages of color_sdf_volume.update_color_sdf,
+            # whose sums are evaluated in double precision.
+            slab = self.volume[:, :, k_begin:k_end]
+            sdf_weights = self.sdf_weight_data[:, :, k_begin:k_end]
+            color_weights = self.color_weight_data[:, :, k_begin:k_end]
+
+            update = valid & (signed_distance >= -self.max_distance)
+            distance = signed_distance[update]
+            truncated_distance = np.where(
+                distance > 0, np.minimum(distance, self.max_distance),
+                distance)
+            sdf = slab[..., NUM_COLORS]
+            prior_weight = sdf_weights[update]
+            sdf[update] = ((prior_weight * sdf[update]).astype(np.float64) +
+                           truncated_distance) / (prior_weight + 1)
+            sdf_weights[update] = prior_weight + 1
+
+            band = valid & (np.abs(signed_distance) <= self.max_distance)
+            colors = slab[..., :NUM_COLORS]
+            prior_weight = color_weights[band][:, None]
+            observed = color_map[color_y[band], color_x[band], :NUM_COLORS]
+            colors[band] = np.minimum(
+                ((prior_weight * colors[band]).astype(np.float64) +
+                 observed) / (prior_weight + 1), 255.0)
+            color_weights[band] = prior_weight[:, 0] + 1
+
+        self._sweep(np.asarray(depth_proj_matrix, dtype=np.float32),
+                    None if color_proj_matrix is None else
+                    np.asarray(color_proj_matrix, dtype=np.float32),
+                    depth_map, color_map.shape[0], color_map.shape[1],
+                    fuse_slab)
+
+    def fuse(self, depth_proj_matrix, color_proj_matrix, depth_map,
+             color_map, num_threads=1):
+        # num_threads is accepted for the kernel signatures, the slabs are
+        # fused by NumPy in the calling thread.
+        self._fuse(depth_proj_matrix, color_proj_matrix, depth_map,
+                   color_map)
+
+    def fuse_registered(self, depth_proj_matrix, depth_map, color_map,
+                        num_threads=1):
+        assert color_map.shape[:2] == depth_map.shape
+        self._fuse(depth_proj_matrix, None, depth_map, color_map)
@@ -0,0 +1,259 @@
+#cython: boundscheck=False
+#cython: initializedcheck=False
+#cython: cdivision=True
+
+from libc.math cimport round
+
+
+cdef struct ColumnProjection:
+    # The x and y terms m[r, 0] * x + m[r, 1] * y and the translation m[r, 3]
+    # of the rows r of a projection matrix m for a voxel column (x, y, z_k).
+    # With the z terms m[r, 2] * z_k from fill_z_table, the projection of the
+    # voxel k costs two additions per row and is bit-identical to the full
+    # product m[r, 0] * x + m[r, 1] * y + m[r, 2] * z_k + m[r, 3].
+    float xy[3]
+    float offset[3]
+
+
+cdef inline void fill_z_table(float[:, ::1] proj_matrix, float z0,
+                              float resolution,
+                              float[:, ::1] z_table) noexcept nogil:
+    # The z terms of the voxels z_k = z0 + k * resolution of a column, once
+    # per frame and shared by all columns.
+    cdef int k, r
+    cdef float z
+    for k in range(z_table.shape[0]):
+        z = z0 + k * resolution
+        for r in range(3):
+            z_table[k, r] = proj_matrix[r, 2] * z
+
+
+cdef inline ColumnProjection column_projection(float[:, ::1] proj_matrix,
+                                               float x,
+                                               float y) noexcept nogil:
+    # Returned by value, so that it is thread-private when assigned in the
+    # body of a prange loop.
+    cdef ColumnProjection column
+    cdef int r
+    for r in range(3):
+        column.xy[r] = proj_matrix[r, 0] * x + proj_matrix[r, 1] * y
+        column.offset[r] = proj_matrix[r, 3]
+    return column
+
+
+cdef inline float column_coordinate(ColumnProjection* column,
+                                    float[:, ::1] z_table, int k,
+                                    int r) noexcept nogil:
+    return column.xy[r] + z_table[k, r] + column.offset[r]
+
+
+cdef inline bint _image_pixel(float proj_x, float proj_y, float proj_z,
+                              int image_height, int image_width,
+                              int* image_pixel_x,
+                              int* image_pixel_y) noexcept nogil:
+    # Round the projection (in front of the camera) to its pixel, returns
+    # False if it is outside of the image.
+    image_pixel_x[0] = <int>round(proj_x / proj_z)
+    image_pixel_y[0] = <int>round(proj_y / proj_z)
+    return (image_pixel_x[0] >= 0 and image_pixel_y[0] >= 0 and
+            image_pixel_x[0] < image_width and
+            image_pixel_y[0] < image_height)
+
+
+cdef inline bint _depth_pixel(float proj_x, float proj_y, float proj_z,
+                              float[:, ::1] depth_map,
+                              float* signed_distance,
+                              int* depth_pixel_x,
+                              int* depth_pixel_y) noexcept nogil:
+    # The pixel of a projection into the depth image and the signed distance
+    # of the voxel to the measured depth.
+    if not _image_pixel(proj_x, proj_y, proj_z, depth_map.shape[0],
+                        depth_map.shape[1], depth_pixel_x, depth_pixel_y):
+        return False
+    signed_distance[0] = depth_map[depth_pixel_y[0], depth_pixel_x[0]] - \
+        proj_z
+    return True
+
+
+cdef inline bint project_voxel(float[:, ::1] depth_proj_matrix,
+                               float[:, ::1] image_proj_matrix,
+                               float[:, ::1] depth_map,
+                               int image_height, int image_width,
+                               float x, float y, float z,
+                               float* signed_distance,
+                               int* image_pixel_x,
+                               int* image_pixel_y) noexcept nogil:
+    # Project the voxel center at (x, y, z) into the depth image and a second
+    # (label or color) image. Returns False if it is behind the camera or
+    # outside of either image, otherwise its signed distance to the measured
+    # depth and its pixel location in the second image.
+    cdef float depth_proj_x, depth_proj_y, depth_proj_z
+    cdef float image_proj_x, image_proj_y, image_proj_z
+    cdef int depth_image_proj_x, depth_image_proj_y
+
+    # Compute the depth of the current voxel wrt. the camera.
+    depth_proj_z = depth_proj_matrix[2, 0] * x + \
+                   depth_proj_matrix[2, 1] * y + \
+                   depth_proj_matrix[2, 2] * z + \
+                   depth_proj_matrix[2, 3]
+    image_proj_z = image_proj_matrix[2, 0] * x + \
+                   image_proj_matrix[2, 1] * y + \
+                   image_proj_matrix[2, 2] * z + \
+                   image_proj_matrix[2, 3]
+
+    # Check if voxel behind camera.
+    if depth_proj_z <= 0 or image_proj_z <= 0:
+        return False
+
+    # Compute pixel location of the current voxel in the image.
+    depth_proj_x = depth_proj_matrix[0, 0] * x + \
+                   depth_proj_matrix[0, 1] * y + \
+                   depth_proj_matrix[0, 2] * z + \
+                   depth_proj_matrix[0, 3]
+    depth_proj_y = depth_proj_matrix[1, 0] * x + \
+                   depth_proj_matrix[1, 1] * y + \
+                   depth_proj_matrix[1, 2] * z + \
+                   depth_proj_matrix[1, 3]
+    image_proj_x = image_proj_matrix[0, 0] * x + \
+                   image_proj_matrix[0, 1] * y + \
+                   image_proj_matrix[0, 2] * z + \
+                   image_proj_matrix[0, 3]
+    image_proj_y = image_proj_matrix[1, 0] * x + \
+                   image_proj_matrix[1, 1] * y + \
+                   image_proj_matrix[1, 2] * z + \
+                   image_proj_matrix[1, 3]
+
+    # Check if projection is inside image and extract measured depth.
+    return (_image_pixel(image_proj_x, image_proj_y, image_proj_z,
+                         image_height, image_width, image_pixel_x,
+                         image_pixel_y) and
+            _depth_pixel(depth_proj_x, depth_proj_y, depth_proj_z, depth_map,
+                         signed_distance, &depth_image_proj_x,
+                         &depth_image_proj_y))
+
+
+cdef inline bint project_voxel_column(ColumnProjection* depth_column,
+                                      float[:, ::1] depth_z_table,
+                                      ColumnProjection* image_column,
+                                      float[:, ::1] image_z_table,
+                                      float[:, ::1] depth_map,
+                                      int image_height, int image_width,
+                                      int k, float* signed_distance,
+                                      int* image_pixel_x,
+                                      int* image_pixel_y) noexcept nogil:
+    # Same as project_voxel for the voxel k of a column.
+    cdef float depth_proj_z, image_proj_z
+    cdef int depth_image_proj_x, depth_image_proj_y
+
+    depth_proj_z = column_coordinate(depth_column, depth_z_table, k, 2)
+    image_proj_z = column_coordinate(image_column, image_z_table, k, 2)
+    if depth_proj_z <= 0 or image_proj_z <= 0:
+        return False
+
+    return (_image_pixel(column_coordinate(image_column, image_z_table, k, 0),
+                         column_coordinate(image_column, image_z_table, k, 1),
+                         image_proj_z, image_height, image_width,
+                         image_pixel_x, image_pixel_y) and
+            _depth_pixel(column_coordinate(depth_column, depth_z_table, k, 0),
+                         column_coordinate(depth_column, depth_z_table, k, 1),
+                         depth_proj_z, depth_map, signed_distance,
+                         &depth_image_proj_x, &depth_image_proj_y))
+
+
+cdef inline bint depth_signed_distance(float[:, ::1] depth_proj_matrix,
+                                       float[:, ::1] depth_map,
+                                       float x, float y, float z,
+                                       float* signed_distance,
+                                       int* depth_pixel_x,
+                                       int* depth_pixel_y) noexcept nogil:
+    # The depth image part of project_voxel, for kernels that project a voxel
+    # into several images or into images registered to the depth image.
+    # Returns False if the voxel center is behind the camera or outside of
+    # the depth image, otherwise its signed distance to the measured depth
+    # and its pixel location in the depth image.
+    cdef float depth_proj_x, depth_proj_y, depth_proj_z
+
+    depth_proj_z = depth_proj_matrix[2, 0] * x + \
+                   depth_proj_matrix[2, 1] * y + \
+                   depth_proj_matrix[2, 2] * z + \
+                   depth_proj_matrix[2, 3]
+    if depth_proj_z <= 0:
+        return False
+
+    depth_proj_x = depth_proj_matrix[0, 0] * x + \
+                   depth_proj_matrix[0, 1] * y + \
+                   depth_proj_matrix[0, 2] * z + \
+                   depth_proj_matrix[0, 3]
+    depth_proj_y = depth_proj_matrix[1, 0] * x + \
+                   depth_proj_matrix[1, 1] * y + \
+                   depth_proj_matrix[1, 2] * z + \
+                   depth_proj_matrix[1, 3]
+    return _depth_pixel(depth_proj_x, depth_proj_y, depth_proj_z, depth_map,
+                        signed_distance, depth_pixel_x, depth_pixel_y)
+
+
+cdef inline bint depth_signed_distance_column(ColumnProjection* depth_column,
+                                              float[:, ::1] depth_z_table,
+                                              float[:, ::1] depth_map, int k,
+                                              float* signed_distance,
+                                              int* depth_pixel_x,
+                                              int* depth_pixel_y
+                                              ) noexcept nogil:
+    # Same as depth_signed_distance for the voxel k of a column.
+    cdef float depth_proj_z
+
+    depth_proj_z = column_coordinate(depth_column, depth_z_table, k, 2)
+    if depth_proj_z <= 0:
+        return False
+    return _depth_pixel(column_coordinate(depth_column, depth_z_table, k, 0),
+                        column_coordinate(depth_column, depth_z_table, k, 1),
+                        depth_proj_z, depth_map, signed_distance,
+                        depth_pixel_x, depth_pixel_y)
+
+
+cdef inline bint project_to_image(float[:, ::1] image_proj_matrix,
+                                  int image_height, int image_width,
+                                  float x, float y, float z,
+                                  int* image_pixel_x,
+                                  int* image_pixel_y) noexcept nogil:
+    # The second image part of project_voxel. Returns False if the voxel
+    # center is behind the camera or outside of the image, otherwise its
+    # pixel location. The voxels accepted by both this and
+    # depth_signed_distance are exactly the voxels accepted by project_voxel.
+    cdef float image_proj_x, image_proj_y, image_proj_z
+
+    image_proj_z = image_proj_matrix[2, 0] * x + \
+                   image_proj_matrix[2, 1] * y + \
+                   image_proj_matrix[2, 2] * z + \
+                   image_proj_matrix[2, 3]
+    if image_proj_z <= 0:
+        return False
+
+    image_proj_x = image_proj_matrix[0, 0] * x + \
+                   image_proj_matrix[0, 1] * y + \
+                   image_proj_matrix[0, 2] * z + \
+                   image_proj_matrix[0, 3]
+    image_proj_y = image_proj_matrix[1, 0] * x + \
+                   image_proj_matrix[1, 1] * y + \
+                   image_proj_matrix[1, 2] * z + \
+                   image_proj_matrix[1, 3]
+    return _image_pixel(image_proj_x, image_proj_y, image_proj_z,
+                        image_height, image_width, image_pixel_x,
+                        image_pixel_y)
+
+
+cdef inline bint project_to_image_column(ColumnProjection* image_column,
+                                         float[:, ::1] image_z_table,
+                                         int image_height, int image_width,
+                                         int k, int* image_pixel_x,
+                                         int* image_pixel_y) noexcept nogil:
+    # Same as project_to_image for the voxel k of a column.
+    cdef float image_proj_z
+
+    image_proj_z = column_coordinate(image_column, image_z_table, k, 2)
+    if image_proj_z <= 0:
+        return False
+    return _image_pixel(column_coordinate(image_column, image_z_table, k, 0),
+                        column_coordinate(image_column, image_z_table, k, 1),
+                        image_proj_z, image_height, image_width,
+                        image_pixel_x, image_pixel_y)
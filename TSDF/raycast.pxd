@@ -0,0 +1,156 @@
+#cython: boundscheck=False
+#cython: initializedcheck=False
+#cython: cdivision=True
+
+from libc.math cimport floor, INFINITY
+
+
+cdef extern from *:
+    # Atomic exchange, returns the previous value.
+    int __sync_lock_test_and_set(int* ptr, int value) nogil
+
+
+cdef struct Camera:
+    # Camera center and inverse of the left 3x3 block (row-major) of a
+    # projection matrix.
+    double center[3]
+    double inv[9]
+
+
+cdef struct RayTraversal:
+    # State of a 3D DDA through the voxel grid, see start_ray.
+    int index[3]
+    int step[3]
+    int shape[3]
+    double t_next[3]
+    double t_delta[3]
+    double t_end
+
+
+cdef inline bint init_camera(float[:, ::1] proj_matrix,
+                             Camera* camera) noexcept nogil:
+    # Returns False if the projection matrix is degenerate.
+    cdef double m[9]
+    cdef double det
+    cdef int r, c
+
+    for r in range(3):
+        for c in range(3):
+            m[3 * r + c] = proj_matrix[r, c]
+
+    camera.inv[0] = m[4] * m[8] - m[5] * m[7]
+    camera.inv[1] = m[2] * m[7] - m[1] * m[8]
+    camera.inv[2] = m[1] * m[5] - m[2] * m[4]
+    camera.inv[3] = m[5] * m[6] - m[3] * m[8]
+    camera.inv[4] = m[0] * m[8] - m[2] * m[6]
+    camera.inv[5] = m[2] * m[3] - m[0] * m[5]
+    camera.inv[6] = m[3] * m[7] - m[4] * m[6]
+    camera.inv[7] = m[1] * m[6] - m[0] * m[7]
+    camera.inv[8] = m[0] * m[4] - m[1] * m[3]
+    det = m[0] * camera.inv[0] + m[1] * camera.inv[3] + m[2] * camera.inv[6]
+    if det == 0:
+        return False
+
+    for r in range(9):
+        camera.inv[r] /= det
+
+    for r in range(3):
+        camera.center[r] = -(camera.inv[3 * r] * proj_matrix[0, 3] +
+                             camera.inv[3 * r + 1] * proj_matrix[1, 3] +
+                             camera.inv[3 * r + 2] * proj_matrix[2, 3])
+    return True
+
+
+cdef inline bint start_ray(RayTraversal* ray, Camera* camera,
+                           double u, double v, double far_depth,
+                           float[:, ::1] bbox, float resolution,
+                           int x_offset, int nx, int ny,
+                           int nz) noexcept nogil:
+    # Start walking the voxels crossed by the ray through pixel (u, v) from
+    # the camera center up to far_depth. The ray is X = center + t * d with
+    # d = inv * (u, v, 1), so that t is the depth of X. Voxel (i, j, k) is
+    # centered at bbox[:, 0] + (i + x_offset, j, k) * resolution. Returns
+    # False if the ray misses the nx x ny x nz voxels.
+    cdef double origin[3]
+    cdef double direction[3]
+    cdef double t_min = 0
+    cdef double t_max = far_depth
+    cdef double t0, t1, tmp, position
+    cdef int a
+
+    ray.shape[0] = nx
+    ray.shape[1] = ny
+    ray.shape[2] = nz
+
+    # Everything in grid coordinates, in which voxel n spans [n, n + 1).
+    for a in range(3):
+        direction[a] = (camera.inv[3 * a] * u + camera.inv[3 * a + 1] * v +
+                        camera.inv[3 * a + 2]) / resolution
+        origin[a] = (camera.center[a] - bbox[a, 0]) / resolution + 0.5
+    origin[0] -= x_offset
+
+    # Clip the ray to the grid.
+    for a in range(3):
+        if direction[a] == 0:
+            if origin[a] < 0 or origin[a] >= ray.shape[a]:
+                return False
+            continue
+        t0 = -origin[a] / direction[a]
+        t1 = (ray.shape[a] - origin[a]) / direction[a]
+        if t0 > t1:
+            tmp = t0
+            t0 = t1
+            t1 = tmp
+        if t0 > t_min:
+            t_min = t0
+        if t1 < t_max:
+            t_max = t1
+    if t_min > t_max:
+        return False
+
+    ray.t_end = t_max
+    for a in range(3):
+        position = origin[a] + t_min * direction[a]
+        ray.index[a] = <int>floor(position)
+        if ray.index[a] < 0:
+            ray.index[a] = 0
+        if ray.index[a] >= ray.shape[a]:
+            ray.index[a] = ray.shape[a] - 1
+        if direction[a] > 0:
+            ray.step[a] = 1
+            ray.t_next[a] = (ray.index[a] + 1 - origin[a]) / direction[a]
+            ray.t_delta[a] = 1 / direction[a]
+        elif direction[a] < 0:
+            ray.step[a] = -1
+            ray.t_next[a] = (ray.index[a] - origin[a]) / direction[a]
+            ray.t_delta[a] = -1 / direction[a]
+        else:
+            ray.step[a] = 0
+            ray.t_next[a] = INFINITY
+            ray.t_delta[a] = INFINITY
+    return True
+
+
+cdef inline bint next_voxel(RayTraversal* ray) noexcept nogil:
+    # Step to the next voxel crossed by the ray, returns False at its end.
+    cdef int a = 0
+    if ray.t_next[1] < ray.t_next[a]:
+        a = 1
+    if ray.t_next[2] < ray.t_next[a]:
+        a = 2
+    if ray.t_next[a] > ray.t_end:
+        return False
+    ray.index[a] += ray.step[a]
+    if ray.index[a] < 0 or ray.index[a] >= ray.shape[a]:
+        return False
+    ray.t_next[a] += ray.t_delta[a]
+    return True
+
+
+cdef inline bint claim_voxel(int* stamp, int frame) noexcept nogil:
+    # Returns True for the first ray of the frame to reach the voxel, so that
+    # it is only updated once per frame even if several rays cross it. Most
+    # voxels are crossed by many rays, so check before the atomic exchange.
+    if stamp[0] == frame:
+        return False
+    return __sync_lock_test_and_set(stamp, frame) != frame
@@ -0,0 +1,88 @@
+import os
+import glob
+import argparse
+import numpy as np
+
+from tsdf_volume import TSDFVolume
+from tsdf_fusion import read_labels, refuse_image
+from prefetch import prefetch
+
+
+# Rebuilds a datacost volume from the projection cache recorded by
+# tsdf_fusion --projection_cache and the label maps of another input path
+# with the same depth maps, poses and label image size (e.g. the predicted
+# segmentations of a scene whose groundtruth was fused), without projecting
+# any voxels.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_path", required=True)
+    parser.add_argument("--projection_cache", required=True)
+    parser.add_argument("--output_path", required=True)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--prefetch_workers", type=int, default=1)
+    parser.add_argument("--prefetch_memory_mb", type=float)
+    return parser.parse_args()
+
+
+def load_frame(paths):
+    # Only decompress the label map of the image.
+    frame_path, image_path = paths
+    with np.load(frame_path) as data:
+        frame = {key: data[key] for key in data.files}
+    with np.load(image_path) as data:
+        frame["label_map"] = data["label_map"]
+    return frame
+
+
+def main():
+    args = parse_args()
+
+    num_labels, unknown_label = read_labels(args.input_path)
+
+    with np.load(os.path.join(args.projection_cache, "volume.npz")) as data:
+        cache = {key: data[key] for key in data.files}
+    assert cache["num_labels"] == num_labels
+
+    tsdf_volume = TSDFVolume(num_labels, cache["bbox"],
+                             float(cache["resolution"]),
+                             int(cache["resolution_factor"]),
+                             precision=str(cache["precision"]))
+
+    # The free space votes of all frames, the label votes are added below.
+    volume = tsdf_volume.get_volume()
+    volume[..., -1] = cache["free_space"]
+    tsdf_volume.set_volume(volume)
+
+    frame_paths = sorted(glob.glob(os.path.join(args.projection_cache,
+                                                "frames/*.npz")))
+    image_paths = [os.path.join(args.input_path, "images",
+                                os.path.basename(frame_path))
+                   for frame_path in frame_paths]
+    for image_path in image_paths:
+        assert os.path.exists(image_path), \
+            "Missing image of the cached frame: {}".format(image_path)
+
+    frames = prefetch(load_frame, list(zip(frame_paths, image_paths)),
+                      args.prefetch, args.prefetch_workers,
+                      args.prefetch_memory_mb)
+
+    for i, frame in enumerate(frames):
+        print("Processing {} [{}/{}]".format(
+              os.path.basename(frame_paths[i]), i + 1, len(frame_paths)))
+
+        label_map = frame["label_map"]
+        assert tuple(frame["label_shape"]) == label_map.shape[:2]
+        refuse_image(tsdf_volume, frame["voxel_indices"],
+                     frame["pixel_indices"], frame["behind"], label_map,
+                     unknown_label, args.num_threads)
+
+    np.savez(args.output_path + ".npz",
+             volume=tsdf_volume.get_volume(copy=False),
+             resolution=cache["resolution"])
+
+
+if __name__ == "__main__":
+    main()
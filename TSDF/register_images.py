@@ -0,0 +1,50 @@
+import os
+import glob
+import shutil
+import argparse
+import numpy as np
+
+from registration import register_image
+
+
+# Converter stage that warps the label and color maps of converted images
+# (convert_scannet*.py, convert_raw_scannet_for_color_sdf_fusion.py) into
+# their depth cameras, so that they are stored at depth resolution and the
+# fusion scripts project every voxel only into the depth image.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_path", required=True)
+    parser.add_argument("--output_path", required=True)
+    parser.add_argument("--overwrite", type=int, default=False)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if not os.path.exists(os.path.join(args.output_path, "images")):
+        os.makedirs(os.path.join(args.output_path, "images"))
+
+    for file_name in ("bbox.txt", "labels.txt"):
+        if os.path.exists(os.path.join(args.input_path, file_name)):
+            shutil.copy(os.path.join(args.input_path, file_name),
+                        os.path.join(args.output_path, file_name))
+
+    image_paths = sorted(glob.glob(os.path.join(args.input_path,
+                                                "images/*.npz")))
+    for i, image_path in enumerate(image_paths):
+        print("Processing {} [{}/{}]".format(
+              os.path.basename(image_path), i + 1, len(image_paths)))
+
+        output_path = os.path.join(args.output_path, "images",
+                                   os.path.basename(image_path))
+        if args.overwrite or not os.path.exists(output_path):
+            with np.load(image_path) as data:
+                image = {key: data[key] for key in data.files}
+            np.savez_compressed(output_path, **register_image(image))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import os
+import glob
+import numpy as np
+
+
+def register_to_depth(depth_map, depth_proj_matrix, image_proj_matrix, image):
+    # Warp a label or color image into the depth camera. Every depth pixel is
+    # back-projected to its 3D point, which takes the value of the nearest
+    # image pixel it projects to. Both projection matrices map world to pixel
+    # coordinates, so the depth to color extrinsics are part of the warp.
+    # Returns the registered image with the size of the depth map, and the
+    # mask of the depth pixels with a valid depth that project into the image.
+    height, width = depth_map.shape
+    v, u = np.mgrid[:height, :width]
+    depth = depth_map.astype(np.float64)
+
+    depth_proj_matrix = depth_proj_matrix.astype(np.float64)
+    rhs = np.stack((depth * u - depth_proj_matrix[0, 3],
+                    depth * v - depth_proj_matrix[1, 3],
+                    depth - depth_proj_matrix[2, 3]), axis=-1)
+    points = rhs @ np.linalg.inv(depth_proj_matrix[:, :3]).T
+
+    image_proj_matrix = image_proj_matrix.astype(np.float64)
+    image_proj = points @ image_proj_matrix[:, :3].T + image_proj_matrix[:, 3]
+
+    valid = (depth > 0) & (image_proj[..., 2] > 0)
+    image_proj_z = np.where(valid, image_proj[..., 2], 1)
+    image_x = np.round(image_proj[..., 0] / image_proj_z)
+    image_y = np.round(image_proj[..., 1] / image_proj_z)
+    valid &= (image_x >= 0) & (image_y >= 0) & \
+        (image_x < image.shape[1]) & (image_y < image.shape[0])
+
+    image_x = np.where(valid, image_x, 0).astype(np.int64)
+    image_y = np.where(valid, image_y, 0).astype(np.int64)
+    registered = np.ascontiguousarray(image[image_y, image_x])
+    registered[~valid] = 0
+    return registered, valid
+
+
+def register_image(image):
+    # Register the label and color maps of a converted image to its depth
+    # map. The depth of pixels without a registered label or color is set to
+    # 0, so that they are skipped by the fusion like voxels that project
+    # outside of the label or color image. The projection matrices of the
+    # registered maps are dropped, which marks the image as registered for
+    # the fusion scripts.
+    depth_map = image["depth_map"]
+    depth_proj_matrix = image["depth_proj_matrix"]
+    registered = {"depth_proj_matrix": depth_proj_matrix}
+    valid = depth_map > 0
+    for name in ("label", "color"):
+        if name + "_map" not in image:
+            continue
+        registered[name + "_map"], image_valid = register_to_depth(
+            depth_map, depth_proj_matrix, image[name + "_proj_matrix"],
+            image[name + "_map"])
+        valid &= image_valid
+    registered["depth_map"] = np.where(valid, depth_map,
+                                       0).astype(np.float32)
+    return registered
+
+
+def is_registered(input_path, name):
+    # Whether the label or color maps (name) of the converted images in
+    # input_path are registered to their depth maps, judged from the first
+    # image, so that the fusion scripts can reject unsupported options
+    # before the fusion.
+    image_paths = sorted(glob.glob(os.path.join(input_path, "images/*.npz")))
+    if not image_paths:
+        return False
+    with np.load(image_paths[0]) as data:
+        return (name + "_map" in data.files and
+                name + "_proj_matrix" not in data.files)
@@ -0,0 +1,96 @@
+import os
+import glob
+import argparse
+import numpy as np
+
+from color_sdf_volume import SemanticColorSDFVolume
+from tsdf_fusion import read_labels
+from prefetch import load_npz, prefetch
+
+
+# Fuses the datacost volume of tsdf_fusion and the color sdf volume of
+# color_sdf_fusion in one pass over images with depth, labels and colors
+# (convert_scannet --with_color), projecting every voxel into the depth image
+# once for both. Images registered with register_images are fused with
+# SemanticColorSDFVolume.fuse_registered.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_path", required=True)
+    parser.add_argument("--output_path", required=True)
+    parser.add_argument("--color_output_path", required=True)
+    parser.add_argument("--frame_rate", type=int, default=1)
+    parser.add_argument("--resolution", type=float, default=0.05)
+    parser.add_argument("--resolution_factor", type=int, default=2)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--prefetch_workers", type=int, default=1)
+    parser.add_argument("--prefetch_memory_mb", type=float)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    bbox = np.loadtxt(os.path.join(args.input_path, "bbox.txt"))
+
+    num_labels, unknown_label = read_labels(args.input_path)
+
+    volume = SemanticColorSDFVolume(num_labels, bbox, args.resolution,
+                                    args.resolution_factor)
+
+    image_paths = sorted(glob.glob(os.path.join(args.input_path,
+                                                "images/*.npz")))
+
+    frame_ids = range(0, len(image_paths), args.frame_rate)
+    images = prefetch(load_npz, [image_paths[i] for i in frame_ids],
+                      args.prefetch, args.prefetch_workers,
+                      args.prefetch_memory_mb)
+
+    for i, image in zip(frame_ids, images):
+        print("Processing {} [{}/{}]".format(
+              os.path.basename(image_paths[i]), i + 1, len(image_paths)))
+
+        # Hard label maps are fused directly, see tsdf_fusion.fuse_image.
+        # Label and color maps registered to the depth map (register_images)
+        # have no label_proj_matrix and color_proj_matrix.
+        if "label_proj_matrix" not in image:
+            if image["label_map"].dtype == np.int32:
+                volume.fuse_labels_registered(image["depth_proj_matrix"],
+                                              image["depth_map"],
+                                              image["label_map"],
+                                              image["color_map"],
+                                              unknown_label=unknown_label,
+                                              num_threads=args.num_threads)
+            else:
+                volume.fuse_registered(image["depth_proj_matrix"],
+                                       image["depth_map"], image["label_map"],
+                                       image["color_map"],
+                                       num_threads=args.num_threads)
+        elif image["label_map"].dtype == np.int32:
+            volume.fuse_labels(image["depth_proj_matrix"],
+                               image["label_proj_matrix"],
+                               image["color_proj_matrix"],
+                               image["depth_map"], image["label_map"],
+                               image["color_map"],
+                               unknown_label=unknown_label,
+                               num_threads=args.num_threads)
+        else:
+            volume.fuse(image["depth_proj_matrix"],
+                        image["label_proj_matrix"],
+                        image["color_proj_matrix"],
+                        image["depth_map"], image["label_map"],
+                        image["color_map"],
+                        num_threads=args.num_threads)
+
+    np.savez(args.output_path + ".npz",
+             volume=volume.get_label_volume(copy=False),
+             resolution=args.resolution)
+    np.savez(args.color_output_path + ".npz",
+             volume=volume.get_color_volume(copy=False),
+             resolution=args.resolution)
+
+
+if __name__ == "__main__":
+    main()
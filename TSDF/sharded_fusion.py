@@ -0,0 +1,187 @@
+import os
+import glob
+import argparse
+import multiprocessing
+import numpy as np
+
+from tsdf_volume import TSDFVolume
+from color_sdf_volume import ColorSDFVolume
+from tsdf_fusion import read_labels, fuse_image
+
+
+# Fuses disjoint subsets of the frames of a scene in separate processes and
+# merges the partial volumes. Run it with --num_workers to fuse all shards on
+# this machine, or with --num_shards and --shard on several nodes followed by
+# a --merge run over the written partial volumes.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--volume_type", choices=["tsdf", "color_sdf"],
+                        default="tsdf")
+    parser.add_argument("--input_path")
+    parser.add_argument("--output_path", required=True)
+    parser.add_argument("--frame_rate", type=int, default=1)
+    parser.add_argument("--resolution", type=float, default=0.05)
+    parser.add_argument("--resolution_factor", type=int, default=2)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--num_shards", type=int)
+    parser.add_argument("--shard", type=int)
+    parser.add_argument("--merge", action="store_true")
+    args = parser.parse_args()
+    if not args.merge and args.input_path is None:
+        parser.error("--input_path is required unless merging")
+    if args.num_shards is None:
+        args.num_shards = args.num_workers
+    if args.shard is not None and not 0 <= args.shard < args.num_shards:
+        parser.error("--shard must be in [0, num_shards)")
+    return args
+
+
+def partial_path(output_path, shard):
+    return "{}.part{:04d}.npz".format(output_path, shard)
+
+
+def shard_image_paths(image_paths, frame_rate, num_shards):
+    # Split the selected frames into contiguous, disjoint shards.
+    image_paths = image_paths[::frame_rate]
+    bounds = np.linspace(0, len(image_paths), num_shards + 1).astype(np.int64)
+    return [image_paths[bounds[shard]:bounds[shard + 1]]
+            for shard in range(num_shards)]
+
+
+def create_volume(volume_type, num_labels, bbox, resolution,
+                  resolution_factor):
+    if volume_type == "tsdf":
+        return TSDFVolume(num_labels, bbox, resolution, resolution_factor)
+    else:
+        return ColorSDFVolume(bbox, resolution, resolution_factor)
+
+
+def save_partial(path, volume_type, volume, num_labels, bbox, resolution,
+                 resolution_factor):
+    partial = dict(volume_type=volume_type,
+                   volume=volume.get_volume(copy=False),
+                   num_labels=num_labels,
+                   bbox=bbox,
+                   resolution=resolution,
+                   resolution_factor=resolution_factor)
+    if volume_type == "color_sdf":
+        partial["sdf_weight_data"] = volume.get_sdf_weight_data(copy=False)
+        partial["color_weight_data"] = volume.get_color_weight_data(
+            copy=False)
+
+    # Write to a temporary file first so that a killed worker never leaves
+    # a truncated partial volume behind.
+    np.savez(path + ".tmp.npz", **partial)
+    os.replace(path + ".tmp.npz", path)
+
+
+def fuse_shard(volume_type, input_path, image_paths, resolution,
+               resolution_factor, num_threads, output_path):
+    bbox = np.loadtxt(os.path.join(input_path, "bbox.txt"))
+    num_labels, unknown_label = 0, -1
+    if volume_type == "tsdf":
+        num_labels, unknown_label = read_labels(input_path)
+
+    volume = create_volume(volume_type, num_labels, bbox, resolution,
+                           resolution_factor)
+
+    for image_path in image_paths:
+        image = np.load(image_path)
+        if volume_type == "tsdf":
+            fuse_image(volume, image["depth_proj_matrix"],
+                       image.get("label_proj_matrix"), image["depth_map"],
+                       image["label_map"], unknown_label, num_threads)
+        else:
+            volume.fuse(image["depth_proj_matrix"],
+                        image["color_proj_matrix"],
+                        image["depth_map"], image["color_map"],
+                        num_threads=num_threads)
+
+    save_partial(output_path, volume_type, volume, num_labels, bbox,
+                 resolution, resolution_factor)
+
+    print("Fused {} frames into {}".format(len(image_paths), output_path))
+
+    return output_path
+
+
+def _fuse_shard_star(shard_args):
+    return fuse_shard(*shard_args)
+
+
+def merge_partials(partial_paths):
+    volume = None
+    for path in partial_paths:
+        partial = np.load(path)
+        volume_type = str(partial["volume_type"])
+        if volume is None:
+            volume = create_volume(volume_type, int(partial["num_labels"]),
+                                   partial["bbox"],
+                                   float(partial["resolution"]),
+                                   int(partial["resolution_factor"]))
+        if volume_type == "tsdf":
+            volume.merge(partial["volume"])
+        else:
+            volume.merge(partial["volume"], partial["sdf_weight_data"],
+                         partial["color_weight_data"])
+    return volume
+
+
+def main():
+    args = parse_args()
+
+    if not args.merge:
+        image_paths = sorted(glob.glob(os.path.join(args.input_path,
+                                                    "images/*.npz")))
+        shards = shard_image_paths(image_paths, args.frame_rate,
+                                   args.num_shards)
+
+        if args.shard is not None:
+            shard_ids = [args.shard]
+        else:
+            shard_ids = list(range(args.num_shards))
+
+        shard_args = [(args.volume_type, args.input_path, shards[shard],
+                       args.resolution, args.resolution_factor,
+                       args.num_threads,
+                       partial_path(args.output_path, shard))
+                      for shard in shard_ids]
+
+        if args.num_workers > 1:
+            pool = multiprocessing.Pool(args.num_workers)
+            try:
+                pool.map(_fuse_shard_star, shard_args, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for shard_arg in shard_args:
+                fuse_shard(*shard_arg)
+
+        # Partial volumes of other nodes are merged in a separate --merge run.
+        if args.shard is not None:
+            return
+
+    partial_paths = [partial_path(args.output_path, shard)
+                     for shard in range(args.num_shards)]
+    missing_paths = [path for path in partial_paths
+                     if not os.path.exists(path)]
+    if missing_paths:
+        raise IOError("Missing partial volumes: {}".format(
+                      ", ".join(missing_paths)))
+
+    volume = merge_partials(partial_paths)
+
+    np.savez(args.output_path + ".npz",
+             volume=volume.get_volume(copy=False),
+             resolution=float(np.load(partial_paths[0])["resolution"]))
+
+    for path in partial_paths:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import os
+import glob
+import argparse
+import multiprocessing
+import numpy as np
+
+from tsdf_volume import TSDFVolume
+from tsdf_fusion import read_labels, fuse_image
+
+
+# Fuses a scene in slabs along x, each slab in its own worker process, so that
+# the memory of every worker scales with the slab and not with the scene. The
+# slabs are fused in place into one memory-mapped volume on disk, which is
+# finally streamed into the output npz.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_path", required=True)
+    parser.add_argument("--output_path", required=True)
+    parser.add_argument("--frame_rate", type=int, default=1)
+    parser.add_argument("--resolution", type=float, default=0.05)
+    parser.add_argument("--resolution_factor", type=int, default=2)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--num_slabs", type=int, default=4)
+    parser.add_argument("--num_workers", type=int, default=1)
+    return parser.parse_args()
+
+
+def volume_shape(bbox, resolution):
+    # Same as the shape computed in TSDFVolume.
+    volume_size = np.diff(bbox, axis=1)
+    volume_shape = volume_size.ravel() / np.float32(resolution)
+    return np.ceil(volume_shape).astype(np.int32).tolist()
+
+
+def slab_ranges(num_voxels, num_slabs):
+    bounds = np.linspace(0, num_voxels, num_slabs + 1).astype(np.int64)
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(num_slabs)
+            if bounds[i] < bounds[i + 1]]
+
+
+def fuse_slab(input_path, image_paths, x_range, resolution,
+              resolution_factor, num_threads, volume_path):
+    bbox = np.loadtxt(os.path.join(input_path, "bbox.txt"))
+    num_labels, unknown_label = read_labels(input_path)
+
+    # The slab of the memory-mapped volume is contiguous, so that it backs the
+    # slab volume without a copy and the pages are written as they are fused.
+    volume = np.load(volume_path, mmap_mode="r+")
+    tsdf_volume = TSDFVolume(num_labels, bbox, resolution, resolution_factor,
+                             x_range=x_range,
+                             volume=volume[x_range[0]:x_range[1]])
+    del volume
+
+    num_fused = 0
+    for image_path in image_paths:
+        image = np.load(image_path)
+
+        # Skip the frames whose frustum misses the slab before decompressing
+        # the label map.
+        depth_proj_matrix = image["depth_proj_matrix"]
+        depth_map = image["depth_map"]
+        if not tsdf_volume.in_frustum(depth_proj_matrix, depth_map):
+            continue
+
+        fuse_image(tsdf_volume, depth_proj_matrix,
+                   image.get("label_proj_matrix"), depth_map,
+                   image["label_map"], unknown_label, num_threads)
+        num_fused += 1
+
+    tsdf_volume.flush()
+    del tsdf_volume
+
+    print("Fused {} of {} frames into slab [{}, {})".format(
+          num_fused, len(image_paths), *x_range))
+
+
+def _fuse_slab_star(slab_args):
+    return fuse_slab(*slab_args)
+
+
+def main():
+    args = parse_args()
+
+    bbox = np.loadtxt(os.path.join(args.input_path, "bbox.txt"))
+    num_labels, _ = read_labels(args.input_path)
+
+    image_paths = sorted(glob.glob(os.path.join(args.input_path,
+                                                "images/*.npz")))
+    image_paths = image_paths[::args.frame_rate]
+
+    shape = volume_shape(bbox, args.resolution)
+    volume_path = args.output_path + ".slabs.npy"
+    volume = np.lib.format.open_memmap(volume_path, mode="w+",
+                                       dtype=np.float32,
+                                       shape=tuple(shape + [num_labels + 1]))
+    del volume
+
+    slab_args = [(args.input_path, image_paths, x_range, args.resolution,
+                  args.resolution_factor, args.num_threads, volume_path)
+                 for x_range in slab_ranges(shape[0], args.num_slabs)]
+
+    if args.num_workers > 1:
+        pool = multiprocessing.Pool(args.num_workers)
+        try:
+            pool.map(_fuse_slab_star, slab_args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for slab_arg in slab_args:
+            fuse_slab(*slab_arg)
+
+    # np.savez streams the memory-mapped volume in chunks.
+    volume = np.load(volume_path, mmap_mode="r")
+    np.savez(args.output_path + ".npz",
+             volume=volume,
+             resolution=args.resolution)
+    del volume
+
+    os.remove(volume_path)
+
+
+if __name__ == "__main__":
+    main()
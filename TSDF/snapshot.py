@@ -0,0 +1,52 @@
+import numpy as np
+
+
+def parse_snapshots(value):
+    # Comma separated numbers of fused frames, e.g. 10,50,200.
+    return sorted(set(int(num_frames) for num_frames in value.split(",")))
+
+
+def snapshot_path(output_path, num_frames):
+    return "{}.snapshot{:06d}.npz".format(output_path, num_frames)
+
+
+def save_snapshot(output_path, num_frames, volume, previous=None,
+                  previous_num_frames=0, **arrays):
+    # Save the volume after num_frames fused frames as a compressed delta
+    # against the previous snapshot, or an empty volume for the first one.
+    # The delta holds the indices of the voxels with changed values (compared
+    # bitwise) and their new values along the last axis.
+    if previous is None:
+        previous = np.zeros_like(volume)
+    assert previous.shape == volume.shape and previous.dtype == volume.dtype
+
+    bits = np.dtype("u{}".format(volume.dtype.itemsize))
+    voxels = volume.reshape(-1, volume.shape[-1])
+    changed = np.any(voxels.view(bits) !=
+                     previous.reshape(-1, volume.shape[-1]).view(bits), axis=1)
+    voxel_indices = np.flatnonzero(changed)
+
+    np.savez_compressed(snapshot_path(output_path, num_frames),
+                        voxel_indices=voxel_indices,
+                        values=voxels[voxel_indices],
+                        shape=volume.shape,
+                        num_frames=num_frames,
+                        previous_num_frames=previous_num_frames,
+                        **arrays)
+
+
+def load_snapshot(output_path, num_frames):
+    # Rebuild the volume of a snapshot by applying the deltas of all
+    # snapshots up to it.
+    deltas = []
+    while num_frames > 0:
+        with np.load(snapshot_path(output_path, num_frames)) as data:
+            deltas.append({key: data[key] for key in data.files})
+        num_frames = int(deltas[-1]["previous_num_frames"])
+    assert deltas
+
+    volume = np.zeros(deltas[0]["shape"], dtype=deltas[0]["values"].dtype)
+    voxels = volume.reshape(-1, volume.shape[-1])
+    for delta in reversed(deltas):
+        voxels[delta["voxel_indices"]] = delta["values"]
+    return volume
@@ -0,0 +1,146 @@
+import os
+import glob
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+from tsdf_volume import TSDFVolume
+from tsdf_fusion import read_labels, refuse_image
+from prefetch import load_npz, prefetch
+
+
+# Fuses many random subsets of the frames of a scene, e.g. to synthesize
+# incomplete inputs for training. Every frame is projected once into its
+# contribution, the correspondences of all voxels it votes for, and the
+# volume of a subset is assembled from the contributions of its frames
+# without projecting again. The contributions are saved to one file per frame
+# in the cache path, so only those of the fused frame are held in memory.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_path", required=True)
+    parser.add_argument("--output_path", required=True)
+    # Frames to draw the subsets from.
+    parser.add_argument("--frame_rate", type=int, default=1)
+    parser.add_argument("--num_subsets", type=int, default=10)
+    parser.add_argument("--subset_size", type=int, required=True)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--resolution", type=float, default=0.05)
+    parser.add_argument("--resolution_factor", type=int, default=2)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--precision", choices=("full", "reduced"),
+                        default="full")
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--prefetch_workers", type=int, default=1)
+    parser.add_argument("--prefetch_memory_mb", type=float)
+    # Directory for the contributions of the frames, by default a temporary
+    # directory next to the output path, which is removed at the end.
+    parser.add_argument("--cache_path")
+    return parser.parse_args()
+
+
+def frame_contribution(tsdf_volume, image, num_threads):
+    # The correspondences of all voxels the frame votes for and its label
+    # map, see TSDFVolume.project. The volume is not modified. A label map
+    # registered to the depth map (register_images) has no label_proj_matrix,
+    # its pixels are those of the depth map.
+    label_map = image["label_map"]
+    label_proj_matrix = image.get("label_proj_matrix",
+                                  image["depth_proj_matrix"])
+    voxel_indices, pixel_indices, behind = tsdf_volume.project(
+        image["depth_proj_matrix"], label_proj_matrix,
+        image["depth_map"], label_map.shape[0], label_map.shape[1],
+        apply_free_space=False, num_threads=num_threads)
+    return voxel_indices, pixel_indices, behind, label_map
+
+
+def save_contribution(path, contribution):
+    # Uncompressed, like the frames of tsdf_fusion --projection_cache.
+    voxel_indices, pixel_indices, behind, label_map = contribution
+    np.savez(path, voxel_indices=voxel_indices, pixel_indices=pixel_indices,
+             behind=behind, label_map=label_map)
+
+
+def load_contribution(path):
+    with np.load(path) as data:
+        return (data["voxel_indices"], data["pixel_indices"], data["behind"],
+                data["label_map"])
+
+
+def subset_volumes(create_volume, contribution_paths, subsets, unknown_label,
+                   num_threads):
+    # Yield the volume of every subset of frame indices into
+    # contribution_paths. The contributions are loaded and applied in frame
+    # order, so the volumes are identical to fusing the frames of the
+    # subsets.
+    for subset in subsets:
+        tsdf_volume = create_volume()
+        for index in sorted(subset):
+            refuse_image(tsdf_volume,
+                         *load_contribution(contribution_paths[index]),
+                         unknown_label, num_threads)
+        yield tsdf_volume.get_volume(copy=False)
+
+
+def main():
+    args = parse_args()
+
+    bbox = np.loadtxt(os.path.join(args.input_path, "bbox.txt"))
+
+    num_labels, unknown_label = read_labels(args.input_path)
+
+    def create_volume():
+        return TSDFVolume(num_labels, bbox, args.resolution,
+                          args.resolution_factor, precision=args.precision)
+
+    image_paths = sorted(glob.glob(os.path.join(args.input_path,
+                                                "images/*.npz")))
+    image_paths = image_paths[::args.frame_rate]
+    assert 0 < args.subset_size <= len(image_paths)
+
+    images = prefetch(load_npz, image_paths, args.prefetch,
+                      args.prefetch_workers, args.prefetch_memory_mb)
+
+    if args.cache_path is None:
+        output_dir = os.path.dirname(os.path.abspath(args.output_path))
+        cache_path = tempfile.mkdtemp(prefix="contributions.", dir=output_dir)
+    else:
+        cache_path = args.cache_path
+        os.makedirs(cache_path, exist_ok=True)
+
+    try:
+        tsdf_volume = create_volume()
+        contribution_paths = []
+        for i, image in enumerate(images):
+            print("Projecting {} [{}/{}]".format(
+                  os.path.basename(image_paths[i]), i + 1, len(image_paths)))
+            contribution_path = os.path.join(
+                cache_path, os.path.basename(image_paths[i]))
+            save_contribution(contribution_path,
+                              frame_contribution(tsdf_volume, image,
+                                                 args.num_threads))
+            contribution_paths.append(contribution_path)
+
+        random = np.random.RandomState(args.seed)
+        subsets = [random.choice(len(image_paths), args.subset_size,
+                                 replace=False)
+                   for _ in range(args.num_subsets)]
+
+        volumes = subset_volumes(create_volume, contribution_paths, subsets,
+                                 unknown_label, args.num_threads)
+        for n, (subset, volume) in enumerate(zip(subsets, volumes)):
+            print("Saving subset [{}/{}]".format(n + 1, args.num_subsets))
+            image_ids = [int(os.path.splitext(os.path.basename(
+                         image_paths[index]))[0]) for index in sorted(subset)]
+            np.savez("{}_{:03d}.npz".format(args.output_path, n),
+                     volume=volume,
+                     resolution=args.resolution,
+                     image_ids=image_ids)
+    finally:
+        if args.cache_path is None:
+            shutil.rmtree(cache_path)
+
+if __name__ == "__main__":
+    main()
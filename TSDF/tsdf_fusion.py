@@ -3,17 +3,260 @@ import glob
 import argparse
 import numpy as np
 
-from tsdf_volume import TSDFVolume
+from backends import BACKENDS, volume_class
+from prefetch import load_npz, prefetch
+from checkpoint import CheckpointWriter, checkpoint_path, load_checkpoint, \
+    remove_checkpoint
+from snapshot import parse_snapshots, save_snapshot
+from registration import is_registered
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_path", required=True)
-    parser.add_argument("--output_path", required=True)
+    parser.add_argument("--output_path")
+    # Additional output volumes fused in the same pass over the images, e.g.
+    # --target datacost frame_rate=50 --target groundtruth_datacost
+    parser.add_argument("--target", nargs="+", action="append", default=[],
+                        metavar=("OUTPUT_PATH", "OPTION"),
+                        help="options: frame_rate=N, frame_ids=I,J,... or "
+                             "frame_ids=@ids.txt, resolution=R")
     parser.add_argument("--frame_rate", type=int, default=1)
     parser.add_argument("--resolution", type=float, default=0.05)
     parser.add_argument("--resolution_factor", type=int, default=2)
-    return parser.parse_args()
+    parser.add_argument("--num_threads", type=int, default=1)
+    # The fusion backend, auto uses the compiled kernels if they can be
+    # imported and the NumPy engine otherwise, see backends.py.
+    parser.add_argument("--backend", choices=["auto"] + list(BACKENDS),
+                        default="auto")
+    # Only allocate the voxel blocks observed by the frames.
+    parser.add_argument("--sparse", action="store_true")
+    # Allocate all voxel blocks up front in Morton order, which are fused
+    # block by block like the sparse volumes.
+    parser.add_argument("--bricked", action="store_true")
+    # Only keep the votes of the top_k labels of every voxel and save them as
+    # label_ids, label_votes and free_space instead of the dense volume.
+    parser.add_argument("--top_k", type=int)
+    # float16 votes, see precision.pxd for the error bounds.
+    parser.add_argument("--precision", choices=("full", "reduced"),
+                        default="full")
+    # Fuse the dense volumes in place into memory-mapped OUTPUT_PATH.npy
+    # files, which are saved instead of OUTPUT_PATH.npz, so that the volumes
+    # do not have to fit into memory.
+    parser.add_argument("--memmap", action="store_true")
+    # Fuse by marching the rays of every N-th pixel instead of sweeping the
+    # voxels of the frustum.
+    parser.add_argument("--pixel_stride", type=int)
+    # Fuse this many frames per sweep over the volume.
+    parser.add_argument("--batch_size", type=int, default=1)
+    # Load and decompress up to this many of the next images in background
+    # threads while the current one is fused.
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--prefetch_workers", type=int, default=1)
+    parser.add_argument("--prefetch_memory_mb", type=float)
+    # Save the volumes every N fused frames to OUTPUT_PATH.checkpoint.npz,
+    # and continue from these checkpoints with --resume.
+    parser.add_argument("--checkpoint_interval", type=int, default=0)
+    parser.add_argument("--resume", action="store_true")
+    # Save the voxel to label pixel correspondences of every frame to this
+    # directory, from which refuse_labels rebuilds the volume for the label
+    # maps of another input path with the same depth maps and poses.
+    parser.add_argument("--projection_cache")
+    # Save snapshots of the volumes after these numbers of fused frames, e.g.
+    # 10,50,200, as compressed deltas to OUTPUT_PATH.snapshotNNNNNN.npz, see
+    # snapshot.load_snapshot.
+    parser.add_argument("--snapshots", type=parse_snapshots, default=[])
+    args = parser.parse_args()
+    if args.output_path is None and not args.target:
+        parser.error("either --output_path or --target is required")
+    if args.sparse and args.bricked:
+        parser.error("--sparse and --bricked cannot be combined")
+    # Bricked volumes are fused with the kernels of the sparse volumes.
+    blocks = args.sparse or args.bricked
+    if blocks and args.top_k is not None:
+        parser.error("--sparse and --bricked cannot be combined with --top_k")
+    if args.precision == "reduced" and (blocks or args.top_k is not None):
+        parser.error("--precision reduced is only supported by dense volumes")
+    if args.pixel_stride is not None and (blocks or args.top_k is not None):
+        parser.error("--pixel_stride is only supported by dense volumes")
+    if args.batch_size > 1 and (blocks or args.top_k is not None or
+                                args.pixel_stride is not None):
+        parser.error("--batch_size is only supported by the dense voxel sweep")
+    if ((args.checkpoint_interval > 0 or args.resume) and
+            (blocks or args.top_k is not None)):
+        parser.error("checkpoints are only supported by dense volumes")
+    if args.projection_cache is not None and (
+            args.target or blocks or args.top_k is not None or
+            args.pixel_stride is not None or args.batch_size > 1 or
+            args.checkpoint_interval > 0 or args.resume):
+        parser.error("--projection_cache only supports a single dense "
+                     "--output_path fused with the voxel sweep")
+    if args.memmap and (blocks or args.top_k is not None or
+                        args.checkpoint_interval > 0 or args.resume):
+        parser.error("--memmap only supports dense volumes and no "
+                     "checkpoints")
+    if args.backend == "numpy" and (
+            blocks or args.top_k is not None or
+            args.precision == "reduced" or args.pixel_stride is not None or
+            args.batch_size > 1 or args.projection_cache is not None):
+        parser.error("--backend numpy only supports dense full precision "
+                     "volumes fused with the voxel sweep")
+    if args.snapshots and (args.top_k is not None or args.resume):
+        parser.error("--snapshots cannot be combined with --top_k or --resume")
+    if is_registered(args.input_path, "label") and (
+            blocks or args.top_k is not None or
+            args.pixel_stride is not None or args.batch_size > 1 or
+            args.projection_cache is not None):
+        parser.error("registered images are only fused into dense volumes "
+                     "with the voxel sweep")
+    return args
+
+
+def parse_target(values, args):
+    target = {
+        "output_path": values[0],
+        "frame_rate": args.frame_rate,
+        "frame_ids": None,
+        "resolution": args.resolution,
+    }
+    for option in values[1:]:
+        key, _, value = option.partition("=")
+        if key == "frame_rate":
+            target["frame_rate"] = int(value)
+        elif key == "frame_ids":
+            if value.startswith("@"):
+                frame_ids = np.loadtxt(value[1:], dtype=np.int64, ndmin=1)
+            else:
+                frame_ids = value.split(",")
+            target["frame_ids"] = set(map(int, frame_ids))
+        elif key == "resolution":
+            target["resolution"] = float(value)
+        else:
+            raise ValueError("Unknown target option: {}".format(option))
+    return target
+
+
+def read_labels(input_path):
+    num_labels = 0
+    unknown_label = -1
+    with open(os.path.join(input_path, "labels.txt"), "r") as fid:
+        for line in fid:
+            if line.strip() and not "freespace" in line:
+                if line.split(":")[0].split(None, 1)[1].strip() == "unknown":
+                    unknown_label = num_labels
+                num_labels += 1
+    return num_labels, unknown_label
+
+
+def selects_frame(target, index, image_path):
+    # Only targets with frame_ids need numeric image names.
+    if target["frame_ids"] is not None:
+        image_id = int(os.path.splitext(os.path.basename(image_path))[0])
+        return image_id in target["frame_ids"]
+    return index % target["frame_rate"] == 0
+
+
+def fuse_image(tsdf_volume, depth_proj_matrix, label_proj_matrix, depth_map,
+               label_map, unknown_label, num_threads, pixel_stride=None):
+    # Hard label maps are fused directly, pixels without a valid label
+    # vote for the unknown label. With a pixel_stride, the voxels are found
+    # by marching the rays of the depth pixels instead of sweeping the volume.
+    # Label maps registered to the depth map (register_images) have no
+    # label_proj_matrix.
+    if label_proj_matrix is None:
+        if label_map.dtype == np.int32:
+            tsdf_volume.fuse_labels_registered(depth_proj_matrix, depth_map,
+                                               label_map,
+                                               unknown_label=unknown_label,
+                                               num_threads=num_threads)
+        else:
+            tsdf_volume.fuse_registered(depth_proj_matrix, depth_map,
+                                        label_map, num_threads=num_threads)
+    elif pixel_stride is not None:
+        if label_map.dtype == np.int32:
+            tsdf_volume.fuse_labels_rays(depth_proj_matrix, label_proj_matrix,
+                                         depth_map, label_map,
+                                         unknown_label=unknown_label,
+                                         pixel_stride=pixel_stride,
+                                         num_threads=num_threads)
+        else:
+            tsdf_volume.fuse_rays(depth_proj_matrix, label_proj_matrix,
+                                  depth_map, label_map,
+                                  pixel_stride=pixel_stride,
+                                  num_threads=num_threads)
+    elif label_map.dtype == np.int32:
+        tsdf_volume.fuse_labels(depth_proj_matrix, label_proj_matrix,
+                                depth_map, label_map,
+                                unknown_label=unknown_label,
+                                num_threads=num_threads)
+    else:
+        tsdf_volume.fuse(depth_proj_matrix, label_proj_matrix,
+                         depth_map, label_map,
+                         num_threads=num_threads)
+
+
+def refuse_image(tsdf_volume, voxel_indices, pixel_indices, behind, label_map,
+                 unknown_label, num_threads):
+    # Apply the label votes of a frame from the correspondences returned by
+    # TSDFVolume.project.
+    if label_map.dtype == np.int32:
+        tsdf_volume.refuse_labels(voxel_indices, pixel_indices, behind,
+                                  label_map, unknown_label=unknown_label,
+                                  num_threads=num_threads)
+    else:
+        tsdf_volume.refuse(voxel_indices, pixel_indices, behind, label_map,
+                           num_threads=num_threads)
+
+
+def fuse_image_cached(tsdf_volume, cache_path, image_path, depth_proj_matrix,
+                      label_proj_matrix, depth_map, label_map, unknown_label,
+                      num_threads):
+    # Same as fuse_image, but also saves the correspondences of the frame to
+    # the projection cache.
+    voxel_indices, pixel_indices, behind = tsdf_volume.project(
+        depth_proj_matrix, label_proj_matrix, depth_map,
+        label_map.shape[0], label_map.shape[1], num_threads=num_threads)
+    refuse_image(tsdf_volume, voxel_indices, pixel_indices, behind,
+                 label_map, unknown_label, num_threads)
+    np.savez(os.path.join(cache_path, "frames", os.path.basename(image_path)),
+             voxel_indices=voxel_indices,
+             pixel_indices=pixel_indices,
+             behind=behind,
+             label_shape=label_map.shape[:2])
+
+
+def fuse_image_batch(tsdf_volume, images, unknown_label, num_threads):
+    # Fuse a list of (depth_proj_matrix, label_proj_matrix, depth_map,
+    # label_map) tuples in order with a single sweep over the volume.
+    depth_proj_matrices, label_proj_matrices, depth_maps, label_maps = \
+        [np.stack(values) for values in zip(*images)]
+    if label_maps.dtype == np.int32:
+        tsdf_volume.fuse_labels_batch(depth_proj_matrices,
+                                      label_proj_matrices, depth_maps,
+                                      label_maps, unknown_label=unknown_label,
+                                      num_threads=num_threads)
+    else:
+        tsdf_volume.fuse_batch(depth_proj_matrices, label_proj_matrices,
+                               depth_maps, label_maps,
+                               num_threads=num_threads)
+
+
+def flush_batch(target, unknown_label, num_threads):
+    if target["batch"]:
+        fuse_image_batch(target["tsdf_volume"], target["batch"],
+                         unknown_label, num_threads)
+        target["batch"] = []
+
+
+def save_target_snapshot(target, unknown_label, num_threads):
+    # Save the volume of the target as a delta against its last snapshot.
+    flush_batch(target, unknown_label, num_threads)
+    volume = target["tsdf_volume"].get_volume()
+    save_snapshot(target["output_path"], target["num_fused"], volume,
+                  target["snapshot"], target["snapshot_num_fused"],
+                  resolution=target["resolution"])
+    target["snapshot"] = volume
+    target["snapshot_num_fused"] = target["num_fused"]
 
 
 def write_ply(path, points, color):
@@ -38,46 +281,176 @@ def main():
 
     bbox = np.loadtxt(os.path.join(args.input_path, "bbox.txt"))
 
-    num_labels = 0
-    with open(os.path.join(args.input_path, "labels.txt"), "r") as fid:
-        for line in fid:
-            if line.strip() and not "freespace" in line:
-                num_labels += 1
+    num_labels, unknown_label = read_labels(args.input_path)
+
+    targets = [parse_target(values, args) for values in args.target]
+    if args.output_path is not None:
+        targets.insert(0, parse_target([args.output_path], args))
+
+    for target in targets:
+        if args.top_k is not None:
+            TopKTSDFVolume = volume_class("TopKTSDFVolume", args.backend)
+            target["tsdf_volume"] = TopKTSDFVolume(num_labels, bbox,
+                                                   target["resolution"],
+                                                   args.resolution_factor,
+                                                   top_k=args.top_k)
+        elif args.sparse:
+            SparseTSDFVolume = volume_class("SparseTSDFVolume", args.backend)
+            target["tsdf_volume"] = SparseTSDFVolume(num_labels, bbox,
+                                                     target["resolution"],
+                                                     args.resolution_factor)
+        elif args.bricked:
+            BrickedTSDFVolume = volume_class("BrickedTSDFVolume",
+                                             args.backend)
+            target["tsdf_volume"] = BrickedTSDFVolume(num_labels, bbox,
+                                                      target["resolution"],
+                                                      args.resolution_factor)
+        elif args.memmap:
+            # A stale file would be fused into again.
+            volume_path = target["output_path"] + ".npy"
+            if os.path.exists(volume_path):
+                os.remove(volume_path)
+            TSDFVolume = volume_class("TSDFVolume", args.backend)
+            target["tsdf_volume"] = TSDFVolume(num_labels, bbox,
+                                               target["resolution"],
+                                               args.resolution_factor,
+                                               precision=args.precision,
+                                               volume=volume_path)
+        else:
+            TSDFVolume = volume_class("TSDFVolume", args.backend)
+            target["tsdf_volume"] = TSDFVolume(num_labels, bbox,
+                                               target["resolution"],
+                                               args.resolution_factor,
+                                               precision=args.precision)
+        target["batch"] = []
+
+        # The number of frames fused into the target and its last snapshot.
+        target["num_fused"] = 0
+        target["snapshot"] = None
+        target["snapshot_num_fused"] = 0
 
-    tsdf_volume = TSDFVolume(num_labels, bbox, args.resolution,
-                             args.resolution_factor)
+        # The index of the last frame fused into the target.
+        target["last_frame"] = -1
+        if args.resume:
+            checkpoint = load_checkpoint(checkpoint_path(target["output_path"]))
+            if checkpoint is not None:
+                assert checkpoint["resolution"] == target["resolution"]
+                target["tsdf_volume"].set_volume(checkpoint["volume"])
+                target["last_frame"] = int(checkpoint["last_frame"])
+                print("Resuming {} after frame {}".format(
+                      target["output_path"], target["last_frame"] + 1))
 
     image_paths = sorted(glob.glob(os.path.join(args.input_path,
                                                 "images/*.npz")))
 
+    # Every image is loaded once and fused into all the targets selecting it.
+    selected_images = []
     for i, image_path in enumerate(image_paths):
-        if i % args.frame_rate != 0:
-            continue
+        fused_targets = [target for target in targets
+                         if i > target["last_frame"] and
+                         selects_frame(target, i, image_path)]
+        if fused_targets:
+            selected_images.append((i, image_path, fused_targets))
 
+    images = prefetch(load_npz, [image_path for _, image_path, _
+                                 in selected_images],
+                      args.prefetch, args.prefetch_workers,
+                      args.prefetch_memory_mb)
+
+    checkpoint_writer = CheckpointWriter()
+
+    # Remove the frames of a previous recording into the same cache.
+    if args.projection_cache is not None:
+        os.makedirs(os.path.join(args.projection_cache, "frames"),
+                    exist_ok=True)
+        for frame_path in glob.glob(os.path.join(args.projection_cache,
+                                                 "frames/*.npz")):
+            os.remove(frame_path)
+
+    for n, ((i, image_path, fused_targets), image) in \
+            enumerate(zip(selected_images, images)):
         print("Processing {} [{}/{}]".format(
               os.path.basename(image_path), i + 1, len(image_paths)))
-        image = np.load(image_path)
-
-        if image["label_map"].dtype == np.int32:
-            label_map = np.zeros((image["label_map"].shape[0],
-                                  image["label_map"].shape[1],
-                                  num_labels), dtype=np.float32)
-            rr, cc = np.mgrid[:label_map.shape[0], :label_map.shape[1]]
-            label_map[(rr.ravel(), cc.ravel(), image["label_map"].ravel())] = 1
-        else:
-            label_map = image["label_map"]
 
-        tsdf_volume.fuse(image["depth_proj_matrix"], image["label_proj_matrix"],
-                         image["depth_map"], label_map)
+        depth_proj_matrix = image["depth_proj_matrix"]
+        label_proj_matrix = image.get("label_proj_matrix")
+        depth_map = image["depth_map"]
+        label_map = image["label_map"]
+
+        for target in fused_targets:
+            if args.batch_size > 1:
+                target["batch"].append((depth_proj_matrix, label_proj_matrix,
+                                        depth_map, label_map))
+                if len(target["batch"]) == args.batch_size:
+                    flush_batch(target, unknown_label, args.num_threads)
+            elif args.projection_cache is not None:
+                fuse_image_cached(target["tsdf_volume"], args.projection_cache,
+                                  image_path, depth_proj_matrix,
+                                  label_proj_matrix, depth_map, label_map,
+                                  unknown_label, args.num_threads)
+            else:
+                fuse_image(target["tsdf_volume"], depth_proj_matrix,
+                           label_proj_matrix, depth_map, label_map,
+                           unknown_label, args.num_threads, args.pixel_stride)
+
+            target["num_fused"] += 1
+            if target["num_fused"] in args.snapshots:
+                save_target_snapshot(target, unknown_label, args.num_threads)
+
+        # Once the batches are flushed, all the frames up to i are fused into
+        # every target. get_volume returns a copy, which is written in the
+        # background while the fusion continues.
+        if (args.checkpoint_interval > 0 and
+                (n + 1) % args.checkpoint_interval == 0):
+            for target in targets:
+                flush_batch(target, unknown_label, args.num_threads)
+                checkpoint_writer.write(
+                    checkpoint_path(target["output_path"]),
+                    {"volume": target["tsdf_volume"].get_volume(),
+                     "last_frame": max(i, target["last_frame"]),
+                     "resolution": target["resolution"]})
+
+    for target in targets:
+        flush_batch(target, unknown_label, args.num_threads)
+
+    checkpoint_writer.close()
 
     # occupied_volume_idxs = np.column_stack(
     #     np.where(np.sum(tsdf_volume.get_volume()[..., :-1], axis=-1) < 0))
     # write_ply(args.output_path + ".ply",
     #           occupied_volume_idxs * args.resolution, color=[255, 0, 0])
 
-    np.savez(args.output_path + ".npz",
-             volume=tsdf_volume.get_volume(),
-             resolution=args.resolution)
+    for target in targets:
+        if args.top_k is not None:
+            # Load with tsdf_volume.expand_top_k to get the dense volume.
+            np.savez(target["output_path"] + ".npz",
+                     label_ids=target["tsdf_volume"].get_label_ids(copy=False),
+                     label_votes=target["tsdf_volume"].get_label_votes(
+                         copy=False),
+                     free_space=target["tsdf_volume"].get_free_space(
+                         copy=False),
+                     num_labels=num_labels,
+                     resolution=target["resolution"])
+        elif args.memmap:
+            target["tsdf_volume"].flush()
+        else:
+            np.savez(target["output_path"] + ".npz",
+                     volume=target["tsdf_volume"].get_volume(copy=False),
+                     resolution=target["resolution"])
+        remove_checkpoint(checkpoint_path(target["output_path"]))
+
+    # The free space votes do not depend on the labels, so they are cached as
+    # the free space channel of the fused volume.
+    if args.projection_cache is not None:
+        target = targets[0]
+        np.savez(os.path.join(args.projection_cache, "volume.npz"),
+                 free_space=target["tsdf_volume"].get_volume(
+                     copy=False)[..., -1],
+                 num_labels=num_labels,
+                 bbox=bbox,
+                 resolution=target["resolution"],
+                 resolution_factor=args.resolution_factor,
+                 precision=args.precision)
 
 
 if __name__ == "__main__":
@@ -5,6 +5,131 @@
 import numpy as np
 cimport numpy as np
 from libc.math cimport round
+from libc.stdint cimport uint16_t
+from libc.stdlib cimport calloc, realloc, free
+from libc.string cimport memcpy
+from cython.parallel cimport prange
+
+from frustum cimport FrustumBounds, frustum_voxel_bounds, clip_column, \
+    max_depth, tile_max_depth, box_in_frustum, DEPTH_TILE_SIZE, \
+    DepthPyramid, ProjectedBox, init_depth_pyramid, build_depth_pyramid, \
+    classify_box, project_box, box_inside_image, BOX_OUTSIDE, BOX_FREE
+from projection cimport ColumnProjection, fill_z_table, column_projection, \
+    project_voxel, project_voxel_column, depth_signed_distance_column
+from precision cimport float_to_half, half_to_float
+from label_votes cimport vote_label_probs, vote_label, vote_label_probs_half, \
+    vote_label_half
+from raycast cimport Camera, RayTraversal, init_camera, start_ray, next_voxel, \
+    claim_voxel
+
+from bricks import morton_order, bricks_to_dense
+from memmap_volume import open_volume, flush_volume
+
+
+# Side length in voxels of the blocks of the sparse volumes.
+cdef enum:
+    BLOCK_SIZE = 8
+
+# Side length in voxels of the smallest boxes that TSDFVolume.fuse tests
+# against the depth pyramid, and the size of its stack of boxes (7 siblings
+# per level of the octree of a block plus the current box).
+cdef enum:
+    MIN_BOX_SIZE = 4
+    BOX_STACK_SIZE = 32
+
+
+# Label id of the unused slots of TopKTSDFVolume.
+cdef enum:
+    EMPTY_LABEL = 255
+
+
+cdef inline void add_top_k_vote(np.uint8_t* label_ids, float* label_votes,
+                                int top_k, int label,
+                                float vote) noexcept nogil:
+    # Add a vote for a label to the top_k (label id, vote) slots of a voxel.
+    # A label without a slot takes the first empty slot. If all slots are
+    # used, it evicts the label whose accumulated vote has the smallest
+    # magnitude, but only if that magnitude is smaller than the magnitude of
+    # the new vote, otherwise the new vote is dropped.
+    cdef int n
+    cdef int evicted = -1
+
+    if vote == 0:
+        return
+
+    for n in range(top_k):
+        if label_ids[n] == label:
+            label_votes[n] += vote
+            return
+        if label_ids[n] == EMPTY_LABEL:
+            label_ids[n] = label
+            label_votes[n] += vote
+            return
+        if evicted < 0 or abs(label_votes[n]) < abs(label_votes[evicted]):
+            evicted = n
+
+    if abs(label_votes[evicted]) < abs(vote):
+        label_ids[evicted] = label
+        label_votes[evicted] = vote
+
+
+cdef inline void vote_top_k_label_probs(np.uint8_t* label_ids,
+                                        float* label_votes, float* free_space,
+                                        int top_k, float signed_distance,
+                                        float max_distance,
+                                        float free_space_vote,
+                                        float occupied_space_vote,
+                                        float[:, :, ::1] label_map,
+                                        int label_image_proj_x,
+                                        int label_image_proj_y) noexcept nogil:
+    # Same as vote_label_probs for the top_k label slots of a voxel.
+    cdef int label
+    cdef float label_prob
+
+    # Check if voxel is inside the truncated distance field.
+    if abs(signed_distance) > max_distance:
+        # Check if voxel is between observed depth and camera.
+        if signed_distance > 0:
+            # Vote for free space.
+            free_space[0] -= free_space_vote
+        return
+
+    # Accumulate the votes for each label.
+    for label in range(label_map.shape[2]):
+        label_prob = label_map[label_image_proj_y, label_image_proj_x, label]
+        if signed_distance < 0:
+            add_top_k_vote(label_ids, label_votes, top_k, label,
+                           -(label_prob * occupied_space_vote))
+        else:
+            add_top_k_vote(label_ids, label_votes, top_k, label,
+                           label_prob * occupied_space_vote)
+
+
+cdef struct Correspondences:
+    # Growable buffer of (voxel index, packed label pixel index) pairs.
+    int* values
+    int size
+    int capacity
+
+
+cdef inline bint append_correspondence(Correspondences* correspondences,
+                                       int voxel_index,
+                                       int pixel_index) noexcept nogil:
+    # Returns False if the buffer cannot be grown.
+    cdef int* values
+    cdef int capacity
+    if correspondences.size == correspondences.capacity:
+        capacity = 2 * correspondences.capacity + 256
+        values = <int*>realloc(correspondences.values,
+                               2 * sizeof(int) * capacity)
+        if values == NULL:
+            return False
+        correspondences.values = values
+        correspondences.capacity = capacity
+    correspondences.values[2 * correspondences.size] = voxel_index
+    correspondences.values[2 * correspondences.size + 1] = pixel_index
+    correspondences.size += 1
+    return True
 
 
 cdef class TSDFVolume:
@@ -14,11 +139,20 @@ cdef class TSDFVolume:
     cdef float occupied_space_vote
     cdef float resolution
     cdef float max_distance
+    cdef int x_offset
+    cdef int volume_shape[4]
+    cdef bint reduced
     cdef float[:, :, :, ::1] volume
+    cdef uint16_t[:, :, :, ::1] half_volume
+    cdef int[:, :, ::1] ray_stamps
+    cdef int ray_frame
+    cdef object volume_array
 
     def __init__(self, num_labels, bbox, resolution, resolution_factor,
-                 free_space_vote=0.5, occupied_space_vote=1):
+                 free_space_vote=0.5, occupied_space_vote=1, x_range=None,
+                 precision="full", volume=None):
         assert num_labels > 0
+        assert precision in ("full", "reduced")
         assert resolution > 0
         assert resolution_factor > 0
         assert free_space_vote >= 0
@@ -33,101 +167,1626 @@ cdef class TSDFVolume:
         volume_size = np.diff(bbox, axis=1)
         volume_shape = volume_size.ravel() / self.resolution
         volume_shape = np.ceil(volume_shape).astype(np.int32).tolist()
-        self.volume = np.zeros(volume_shape + [num_labels + 1],
-                               dtype=np.float32)
 
-    def get_volume(self):
-        return np.array(self.volume)
+        # Only allocate the slab [x_range[0], x_range[1]) of the voxels along
+        # x, the voxel positions stay the same as in the full volume.
+        self.x_offset = 0
+        if x_range is not None:
+            assert 0 <= x_range[0] < x_range[1] <= volume_shape[0]
+            self.x_offset = x_range[0]
+            volume_shape[0] = x_range[1] - x_range[0]
+
+        self.volume_shape = volume_shape + [num_labels + 1]
+
+        # The reduced precision volume stores the votes as float16 bits, they
+        # are accumulated in float32 and rounded once per update.
+        self.reduced = precision == "reduced"
+
+        # The votes are fused into volume if given, e.g. a np.memmap (of the
+        # slab for an x_range) or the path of a .npy file that is memory-
+        # mapped, see memmap_volume.open_volume. It keeps its votes, so that
+        # the fusion of an existing file continues.
+        if volume is not None:
+            self.volume_array = open_volume(
+                volume, volume_shape + [num_labels + 1],
+                np.float16 if self.reduced else np.float32)
+        elif self.reduced:
+            self.volume_array = np.zeros(volume_shape + [num_labels + 1],
+                                         dtype=np.float16)
+        else:
+            self.volume_array = np.zeros(volume_shape + [num_labels + 1],
+                                         dtype=np.float32)
+        if self.reduced:
+            self.half_volume = self.volume_array.view(np.uint16)
+        else:
+            self.volume = self.volume_array
+
+    def get_volume(self, copy=True):
+        # With copy=False, the volume is returned as a view of its buffer,
+        # which follows the later updates of the volume. np.savez writes the
+        # view without copying the volume, and it exports the buffer protocol
+        # and DLPack (np.from_dlpack, torch.from_dlpack), also transposed to
+        # the label-major axis order of the .dat files (save.dat_layout).
+        if self.reduced:
+            return np.array(self.half_volume, copy=copy).view(np.float16)
+        return np.array(self.volume, copy=copy)
+
+    def set_volume(self, volume):
+        # Restore a volume returned by get_volume, e.g. from a checkpoint. It
+        # is copied into the volume, which stays backed by its file if it is
+        # memory-mapped.
+        assert tuple(volume.shape) == tuple(self.volume_shape)
+        self.volume_array[...] = volume
+
+    def flush(self):
+        # Write the votes of a memory-mapped volume to its file.
+        flush_volume(self.volume_array)
+
+    cdef FrustumBounds _frustum_bounds(self, float[:, ::1] depth_proj_matrix,
+                                       float[:, ::1] depth_map,
+                                       float far_depth):
+        # The frustum AABB in the local voxel indices of this volume.
+        cdef FrustumBounds bounds
+        bounds = frustum_voxel_bounds(depth_proj_matrix,
+                                      depth_map.shape[1], depth_map.shape[0],
+                                      far_depth, self.bbox, self.resolution,
+                                      self.x_offset + self.volume_shape[0],
+                                      self.volume_shape[1])
+        bounds.i_min = max(bounds.i_min - self.x_offset, 0)
+        bounds.i_max = max(bounds.i_max - self.x_offset, 0)
+        return bounds
+
+    cdef float[:, ::1] _z_table(self, float[:, ::1] proj_matrix):
+        # The z terms of the projections of the voxels of a column.
+        z_table = np.empty((self.volume_shape[2], 3), dtype=np.float32)
+        fill_z_table(proj_matrix, self.bbox[2, 0], self.resolution, z_table)
+        return z_table
+
+    def in_frustum(self,
+                   np.float32_t[:, ::1] depth_proj_matrix,
+                   np.float32_t[:, ::1] depth_map):
+        # Whether fusing the frame could update any voxel of this volume.
+        cdef FrustumBounds bounds
+        bounds = self._frustum_bounds(depth_proj_matrix, depth_map,
+                                      max_depth(depth_map) + self.max_distance)
+        return bounds.i_min < bounds.i_max and bounds.j_min < bounds.j_max
+
+    def merge(self, volume):
+        # Merge a volume fused from a disjoint set of frames into this one.
+        # The votes are additive, so merging sums them. The volume is the
+        # float32 or float16 output of get_volume of a full or reduced
+        # precision volume.
+        assert tuple(volume.shape) == tuple(self.volume_shape)
+
+        cdef int i, j, k, c
+        cdef np.float32_t[:, :, :, ::1] other_volume
+
+        # The reduced precision votes are summed in float32 and rounded once,
+        # in place, so that a memory-mapped volume stays backed by its file.
+        if self.reduced:
+            self.volume_array[...] = (
+                self.volume_array.astype(np.float32) +
+                np.asarray(volume, dtype=np.float32)).astype(np.float16)
+            return
+
+        other_volume = np.ascontiguousarray(volume, dtype=np.float32)
+        for i in range(self.volume_shape[0]):
+            for j in range(self.volume_shape[1]):
+                for k in range(self.volume_shape[2]):
+                    for c in range(self.volume_shape[3]):
+                        self.volume[i, j, k, c] += other_volume[i, j, k, c]
+
+    cdef void _free_space_block(self, int i_begin, int i_end, int j_begin,
+                                int j_end, int k_begin,
+                                int k_end) noexcept nogil:
+        # Apply the free space vote to every voxel of a block.
+        cdef int i, j, k
+        cdef int num_labels = self.volume_shape[3] - 1
+
+        for i in range(i_begin, i_end):
+            for j in range(j_begin, j_end):
+                for k in range(k_begin, k_end):
+                    if self.reduced:
+                        self.half_volume[i, j, k, num_labels] = float_to_half(
+                            half_to_float(
+                                self.half_volume[i, j, k, num_labels]) -
+                            self.free_space_vote)
+                    else:
+                        self.volume[i, j, k, num_labels] -= \
+                            self.free_space_vote
+
+    cdef void _fuse_block_column(self, int bi, int bj, FrustumBounds bounds,
+                                 float far_depth,
+                                 float[:, ::1] depth_proj_matrix,
+                                 float[:, ::1] label_proj_matrix,
+                                 float[:, ::1] depth_z_table,
+                                 float[:, ::1] label_z_table,
+                                 float[:, ::1] depth_map,
+                                 DepthPyramid* pyramid,
+                                 float[::1] min_depths,
+                                 float[::1] max_depths,
+                                 float[:, :, ::1] label_probs,
+                                 np.int32_t[:, ::1] label_ids,
+                                 bint hard_labels,
+                                 int unknown_label) noexcept nogil:
+        # Fuse the BLOCK_SIZE^3 blocks of the block column (bi, bj). Boxes
+        # that the depth pyramid proves to be outside of the frustum or
+        # behind the truncation band are skipped, boxes in front of it get
+        # the free space vote in bulk, and the remaining boxes are split into
+        # octants down to MIN_BOX_SIZE, whose voxels are projected one by one.
+        cdef int bk, box, size, i, j, k, i0, j0, k0
+        cdef int i_begin = max(bi * BLOCK_SIZE, bounds.i_min)
+        cdef int i_end = min((bi + 1) * BLOCK_SIZE, bounds.i_max)
+        cdef int j_begin = max(bj * BLOCK_SIZE, bounds.j_min)
+        cdef int j_end = min((bj + 1) * BLOCK_SIZE, bounds.j_max)
+        cdef int box_i_begin, box_i_end, box_j_begin, box_j_end
+        cdef int box_k_begin, box_k_end
+        cdef int k_min[BLOCK_SIZE][BLOCK_SIZE]
+        cdef int k_max[BLOCK_SIZE][BLOCK_SIZE]
+        cdef ColumnProjection depth_columns[BLOCK_SIZE][BLOCK_SIZE]
+        cdef ColumnProjection label_columns[BLOCK_SIZE][BLOCK_SIZE]
+        cdef int boxes[BOX_STACK_SIZE][4]
+        cdef int num_boxes
+        cdef float extent
+        cdef float x, y, z
+        cdef float signed_distance
+        cdef int label_image_proj_x, label_image_proj_y
+        cdef int label_height, label_width
+        cdef int num_labels = self.volume_shape[3] - 1
+        cdef ProjectedBox label_box
+
+        if hard_labels:
+            label_height = label_ids.shape[0]
+            label_width = label_ids.shape[1]
+        else:
+            label_height = label_probs.shape[0]
+            label_width = label_probs.shape[1]
+
+        # The frustum clipped range and the projections of every voxel column
+        # of the blocks.
+        for i in range(i_begin, i_end):
+            x = self.bbox[0, 0] + (i + self.x_offset) * self.resolution
+            for j in range(j_begin, j_end):
+                y = self.bbox[1, 0] + j * self.resolution
+                depth_columns[i - i_begin][j - j_begin] = column_projection(
+                    depth_proj_matrix, x, y)
+                label_columns[i - i_begin][j - j_begin] = column_projection(
+                    label_proj_matrix, x, y)
+                if not clip_column(depth_proj_matrix,
+                                   depth_map.shape[1], depth_map.shape[0],
+                                   far_depth, x, y, self.bbox[2, 0],
+                                   self.resolution, self.volume_shape[2],
+                                   &k_min[i - i_begin][j - j_begin],
+                                   &k_max[i - i_begin][j - j_begin]):
+                    k_min[i - i_begin][j - j_begin] = 0
+                    k_max[i - i_begin][j - j_begin] = 0
+
+        for bk in range((self.volume_shape[2] + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            # Depth first traversal of the octree of the block.
+            boxes[0][0] = bi * BLOCK_SIZE
+            boxes[0][1] = bj * BLOCK_SIZE
+            boxes[0][2] = bk * BLOCK_SIZE
+            boxes[0][3] = BLOCK_SIZE
+            num_boxes = 1
+            while num_boxes > 0:
+                num_boxes -= 1
+                i0 = boxes[num_boxes][0]
+                j0 = boxes[num_boxes][1]
+                k0 = boxes[num_boxes][2]
+                size = boxes[num_boxes][3]
+                box_i_begin = max(i0, i_begin)
+                box_i_end = min(i0 + size, i_end)
+                box_j_begin = max(j0, j_begin)
+                box_j_end = min(j0 + size, j_end)
+                box_k_begin = k0
+                box_k_end = min(k0 + size, self.volume_shape[2])
+                if (box_i_begin >= box_i_end or box_j_begin >= box_j_end or
+                        box_k_begin >= box_k_end):
+                    continue
+
+                x = self.bbox[0, 0] + (i0 + self.x_offset) * self.resolution
+                y = self.bbox[1, 0] + j0 * self.resolution
+                z = self.bbox[2, 0] + k0 * self.resolution
+                extent = (size - 1) * self.resolution
+                box = classify_box(depth_proj_matrix, pyramid, min_depths,
+                                   max_depths, depth_map.shape[1],
+                                   depth_map.shape[0], self.max_distance,
+                                   x, y, z, extent)
+                if box == BOX_OUTSIDE:
+                    continue
+
+                # The free space vote also needs every voxel to project into
+                # the label image.
+                if box == BOX_FREE:
+                    project_box(label_proj_matrix, x, y, z, extent,
+                                &label_box)
+                    if box_inside_image(&label_box, label_width,
+                                        label_height):
+                        self._free_space_block(box_i_begin, box_i_end,
+                                               box_j_begin, box_j_end,
+                                               box_k_begin, box_k_end)
+                        continue
+
+                if size > MIN_BOX_SIZE:
+                    for k in range(8):
+                        boxes[num_boxes][0] = i0 + (k & 1) * (size // 2)
+                        boxes[num_boxes][1] = j0 + ((k >> 1) & 1) * (size // 2)
+                        boxes[num_boxes][2] = k0 + ((k >> 2) & 1) * (size // 2)
+                        boxes[num_boxes][3] = size // 2
+                        num_boxes += 1
+                    continue
+
+                for i in range(box_i_begin, box_i_end):
+                    for j in range(box_j_begin, box_j_end):
+                        for k in range(max(box_k_begin,
+                                           k_min[i - i_begin][j - j_begin]),
+                                       min(box_k_end,
+                                           k_max[i - i_begin][j - j_begin])):
+                            if not project_voxel_column(
+                                    &depth_columns[i - i_begin][j - j_begin],
+                                    depth_z_table,
+                                    &label_columns[i - i_begin][j - j_begin],
+                                    label_z_table, depth_map, label_height,
+                                    label_width, k, &signed_distance,
+                                    &label_image_proj_x, &label_image_proj_y):
+                                continue
+
+                            if hard_labels and self.reduced:
+                                vote_label_half(
+                                    &self.half_volume[i, j, k, 0], num_labels,
+                                    signed_distance, self.max_distance,
+                                    self.free_space_vote,
+                                    self.occupied_space_vote,
+                                    label_ids[label_image_proj_y,
+                                              label_image_proj_x],
+                                    unknown_label)
+                            elif hard_labels:
+                                vote_label(&self.volume[i, j, k, 0],
+                                           num_labels, signed_distance,
+                                           self.max_distance,
+                                           self.free_space_vote,
+                                           self.occupied_space_vote,
+                                           label_ids[label_image_proj_y,
+                                                     label_image_proj_x],
+                                           unknown_label)
+                            elif self.reduced:
+                                vote_label_probs_half(
+                                    &self.half_volume[i, j, k, 0],
+                                    signed_distance, self.max_distance,
+                                    self.free_space_vote,
+                                    self.occupied_space_vote, label_probs,
+                                    label_image_proj_x, label_image_proj_y)
+                            else:
+                                vote_label_probs(
+                                    &self.volume[i, j, k, 0], signed_distance,
+                                    self.max_distance, self.free_space_vote,
+                                    self.occupied_space_vote, label_probs,
+                                    label_image_proj_x, label_image_proj_y)
+
+    cdef void _fuse(self,
+                    float[:, ::1] depth_proj_matrix,
+                    float[:, ::1] label_proj_matrix,
+                    float[:, ::1] depth_map,
+                    float[:, :, ::1] label_probs,
+                    np.int32_t[:, ::1] label_ids,
+                    bint hard_labels,
+                    int unknown_label,
+                    int num_threads):
+        cdef int n, bi_min, bj_min, num_bi, num_bj
+        cdef float far_depth
+        cdef FrustumBounds bounds
+        cdef DepthPyramid pyramid
+        cdef float[::1] min_depths
+        cdef float[::1] max_depths
+        cdef float[:, ::1] depth_z_table
+        cdef float[:, ::1] label_z_table
+
+        # Voxels beyond the largest measured depth plus the truncation distance
+        # are never updated, so only sweep the part of the volume inside the
+        # camera frustum clipped at that depth.
+        far_depth = max_depth(depth_map) + self.max_distance
+        bounds = self._frustum_bounds(depth_proj_matrix, depth_map, far_depth)
+        if bounds.i_min >= bounds.i_max or bounds.j_min >= bounds.j_max:
+            return
+
+        # The min / max depth pyramid bounds the depths seen by a block with
+        # at most 4 lookups.
+        min_depths = np.empty(init_depth_pyramid(depth_map.shape[1],
+                                                 depth_map.shape[0],
+                                                 &pyramid), dtype=np.float32)
+        max_depths = np.empty_like(min_depths)
+        build_depth_pyramid(depth_map, &pyramid, min_depths, max_depths)
+        depth_z_table = self._z_table(depth_proj_matrix)
+        label_z_table = self._z_table(label_proj_matrix)
+
+        bi_min = bounds.i_min // BLOCK_SIZE
+        bj_min = bounds.j_min // BLOCK_SIZE
+        num_bi = (bounds.i_max - 1) // BLOCK_SIZE + 1 - bi_min
+        num_bj = (bounds.j_max - 1) // BLOCK_SIZE + 1 - bj_min
+
+        # Every voxel is only written by the iteration of its block column,
+        # so the block columns are fused in parallel without the GIL.
+        for n in prange(num_bi * num_bj, nogil=True, schedule="dynamic",
+                        num_threads=num_threads):
+            self._fuse_block_column(bi_min + n // num_bj, bj_min + n % num_bj,
+                                    bounds, far_depth, depth_proj_matrix,
+                                    label_proj_matrix, depth_z_table,
+                                    label_z_table, depth_map, &pyramid,
+                                    min_depths, max_depths, label_probs,
+                                    label_ids, hard_labels, unknown_label)
 
     def fuse(self,
              np.float32_t[:, ::1] depth_proj_matrix,
              np.float32_t[:, ::1] label_proj_matrix,
              np.float32_t[:, ::1] depth_map,
-             np.float32_t[:, :, ::1] label_map):
-        assert label_map.shape[2] == self.volume.shape[3] - 1
+             np.float32_t[:, :, ::1] label_map,
+             int num_threads=1):
+        assert label_map.shape[2] == self.volume_shape[3] - 1
+        assert num_threads > 0
 
-        cdef int i, j, k
-        cdef float x, y, z
-        cdef float depth_proj_x, depth_proj_y, depth_proj_z
-        cdef float label_proj_x, label_proj_y, label_proj_z
+        self._fuse(depth_proj_matrix, label_proj_matrix, depth_map, label_map,
+                   None, False, -1, num_threads)
+
+    def fuse_labels(self,
+                    np.float32_t[:, ::1] depth_proj_matrix,
+                    np.float32_t[:, ::1] label_proj_matrix,
+                    np.float32_t[:, ::1] depth_map,
+                    np.int32_t[:, ::1] label_map,
+                    int unknown_label=-1,
+                    int num_threads=1):
+        # Same as fuse, but for a hard label image instead of per-label
+        # probabilities, so only the voted label channel is updated. Labels
+        # outside [0, num_labels) are voted to unknown_label, or only
+        # contribute free space votes if unknown_label is negative.
+        assert unknown_label < self.volume_shape[3] - 1
+        assert num_threads > 0
+
+        self._fuse(depth_proj_matrix, label_proj_matrix, depth_map, None,
+                   label_map, True, unknown_label, num_threads)
+
+    cdef void _fuse_registered_slice(self, int i, FrustumBounds bounds,
+                                     float far_depth,
+                                     float[:, ::1] depth_proj_matrix,
+                                     float[:, ::1] depth_z_table,
+                                     float[:, ::1] depth_map,
+                                     float[:, :, ::1] label_probs,
+                                     np.int32_t[:, ::1] label_ids,
+                                     bint hard_labels,
+                                     int unknown_label) noexcept nogil:
+        cdef int j, k, k_min, k_max
+        cdef float x = self.bbox[0, 0] + (i + self.x_offset) * self.resolution
+        cdef float y
+        cdef float signed_distance
         cdef int depth_image_proj_x, depth_image_proj_y
+        cdef int num_labels = self.volume_shape[3] - 1
+        cdef ColumnProjection depth_column
+
+        for j in range(bounds.j_min, bounds.j_max):
+            y = self.bbox[1, 0] + j * self.resolution
+            if not clip_column(depth_proj_matrix,
+                               depth_map.shape[1], depth_map.shape[0],
+                               far_depth, x, y, self.bbox[2, 0],
+                               self.resolution, self.volume_shape[2],
+                               &k_min, &k_max):
+                continue
+            depth_column = column_projection(depth_proj_matrix, x, y)
+            for k in range(k_min, k_max):
+                if not depth_signed_distance_column(&depth_column,
+                                                    depth_z_table, depth_map,
+                                                    k, &signed_distance,
+                                                    &depth_image_proj_x,
+                                                    &depth_image_proj_y):
+                    continue
+
+                if hard_labels and self.reduced:
+                    vote_label_half(&self.half_volume[i, j, k, 0],
+                                    num_labels, signed_distance,
+                                    self.max_distance, self.free_space_vote,
+                                    self.occupied_space_vote,
+                                    label_ids[depth_image_proj_y,
+                                              depth_image_proj_x],
+                                    unknown_label)
+                elif hard_labels:
+                    vote_label(&self.volume[i, j, k, 0], num_labels,
+                               signed_distance, self.max_distance,
+                               self.free_space_vote, self.occupied_space_vote,
+                               label_ids[depth_image_proj_y,
+                                         depth_image_proj_x],
+                               unknown_label)
+                elif self.reduced:
+                    vote_label_probs_half(&self.half_volume[i, j, k, 0],
+                                          signed_distance, self.max_distance,
+                                          self.free_space_vote,
+                                          self.occupied_space_vote,
+                                          label_probs, depth_image_proj_x,
+                                          depth_image_proj_y)
+                else:
+                    vote_label_probs(&self.volume[i, j, k, 0],
+                                     signed_distance, self.max_distance,
+                                     self.free_space_vote,
+                                     self.occupied_space_vote, label_probs,
+                                     depth_image_proj_x, depth_image_proj_y)
+
+    cdef void _fuse_registered(self,
+                               float[:, ::1] depth_proj_matrix,
+                               float[:, ::1] depth_map,
+                               float[:, :, ::1] label_probs,
+                               np.int32_t[:, ::1] label_ids,
+                               bint hard_labels,
+                               int unknown_label,
+                               int num_threads):
+        cdef int i
+        cdef float far_depth
+        cdef FrustumBounds bounds
+        cdef float[:, ::1] depth_z_table = self._z_table(depth_proj_matrix)
+
+        far_depth = max_depth(depth_map) + self.max_distance
+        bounds = self._frustum_bounds(depth_proj_matrix, depth_map, far_depth)
+
+        for i in prange(bounds.i_min, bounds.i_max, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
+            self._fuse_registered_slice(i, bounds, far_depth,
+                                        depth_proj_matrix, depth_z_table,
+                                        depth_map, label_probs, label_ids,
+                                        hard_labels, unknown_label)
+
+    def fuse_registered(self,
+                        np.float32_t[:, ::1] depth_proj_matrix,
+                        np.float32_t[:, ::1] depth_map,
+                        np.float32_t[:, :, ::1] label_map,
+                        int num_threads=1):
+        # Same as fuse for a label image registered to the depth image (see
+        # registration.register_to_depth), i.e. with the same size and pixel
+        # to pixel correspondence, so every voxel is only projected into the
+        # depth image.
+        assert label_map.shape[0] == depth_map.shape[0]
+        assert label_map.shape[1] == depth_map.shape[1]
+        assert label_map.shape[2] == self.volume_shape[3] - 1
+        assert num_threads > 0
+
+        self._fuse_registered(depth_proj_matrix, depth_map, label_map, None,
+                              False, -1, num_threads)
+
+    def fuse_labels_registered(self,
+                               np.float32_t[:, ::1] depth_proj_matrix,
+                               np.float32_t[:, ::1] depth_map,
+                               np.int32_t[:, ::1] label_map,
+                               int unknown_label=-1,
+                               int num_threads=1):
+        # Same as fuse_registered for a hard label image, see fuse_labels.
+        assert label_map.shape[0] == depth_map.shape[0]
+        assert label_map.shape[1] == depth_map.shape[1]
+        assert unknown_label < self.volume_shape[3] - 1
+        assert num_threads > 0
+
+        self._fuse_registered(depth_proj_matrix, depth_map, None, label_map,
+                              True, unknown_label, num_threads)
+
+    cdef void _fuse_column_batch(self, int i, int j,
+                                 float[:, :, ::1] depth_proj_matrices,
+                                 float[:, :, ::1] label_proj_matrices,
+                                 float[:, :, ::1] depth_z_tables,
+                                 float[:, :, ::1] label_z_tables,
+                                 float[:, :, ::1] depth_maps,
+                                 float[::1] far_depths,
+                                 float[:, :, :, ::1] label_probs,
+                                 np.int32_t[:, :, ::1] label_ids,
+                                 bint hard_labels,
+                                 int unknown_label) noexcept nogil:
+        # Apply the updates of all frames in order to the voxel column (i, j),
+        # which stays in cache between the frames.
+        cdef int f, k, k_min, k_max
+        cdef float x = self.bbox[0, 0] + (i + self.x_offset) * self.resolution
+        cdef float y = self.bbox[1, 0] + j * self.resolution
         cdef int label_image_proj_x, label_image_proj_y
-        cdef float depth, signed_distance
-        cdef int label
-        cdef float label_prob
+        cdef float signed_distance
+        cdef int label_height, label_width
+        cdef int num_labels = self.volume_shape[3] - 1
+        cdef float[:, ::1] depth_proj_matrix
+        cdef float[:, ::1] depth_map
+        cdef ColumnProjection depth_column, label_column
+        cdef float[:, :, ::1] label_map_probs
+        cdef np.int32_t[:, ::1] label_map_ids
 
-        for i in range(self.volume.shape[0]):
-            x = self.bbox[0, 0] + i * self.resolution
-            for j in range(self.volume.shape[1]):
-                y = self.bbox[1, 0] + j * self.resolution
-                for k in range(self.volume.shape[2]):
+        if hard_labels:
+            label_height = label_ids.shape[1]
+            label_width = label_ids.shape[2]
+        else:
+            label_height = label_probs.shape[1]
+            label_width = label_probs.shape[2]
+
+        for f in range(depth_maps.shape[0]):
+            depth_proj_matrix = depth_proj_matrices[f]
+            depth_map = depth_maps[f]
+            if not clip_column(depth_proj_matrix,
+                               depth_map.shape[1], depth_map.shape[0],
+                               far_depths[f], x, y, self.bbox[2, 0],
+                               self.resolution, self.volume_shape[2],
+                               &k_min, &k_max):
+                continue
+
+            depth_column = column_projection(depth_proj_matrix, x, y)
+            label_column = column_projection(label_proj_matrices[f], x, y)
+            if hard_labels:
+                label_map_ids = label_ids[f]
+            else:
+                label_map_probs = label_probs[f]
+
+            for k in range(k_min, k_max):
+                if not project_voxel_column(&depth_column, depth_z_tables[f],
+                                            &label_column, label_z_tables[f],
+                                            depth_map, label_height,
+                                            label_width, k, &signed_distance,
+                                            &label_image_proj_x,
+                                            &label_image_proj_y):
+                    continue
+
+                if hard_labels and self.reduced:
+                    vote_label_half(&self.half_volume[i, j, k, 0],
+                                    num_labels, signed_distance,
+                                    self.max_distance, self.free_space_vote,
+                                    self.occupied_space_vote,
+                                    label_map_ids[label_image_proj_y,
+                                                  label_image_proj_x],
+                                    unknown_label)
+                elif hard_labels:
+                    vote_label(&self.volume[i, j, k, 0], num_labels,
+                               signed_distance, self.max_distance,
+                               self.free_space_vote, self.occupied_space_vote,
+                               label_map_ids[label_image_proj_y,
+                                             label_image_proj_x],
+                               unknown_label)
+                elif self.reduced:
+                    vote_label_probs_half(&self.half_volume[i, j, k, 0],
+                                          signed_distance, self.max_distance,
+                                          self.free_space_vote,
+                                          self.occupied_space_vote,
+                                          label_map_probs, label_image_proj_x,
+                                          label_image_proj_y)
+                else:
+                    vote_label_probs(&self.volume[i, j, k, 0],
+                                     signed_distance, self.max_distance,
+                                     self.free_space_vote,
+                                     self.occupied_space_vote,
+                                     label_map_probs, label_image_proj_x,
+                                     label_image_proj_y)
+
+    cdef void _fuse_batch(self,
+                          float[:, :, ::1] depth_proj_matrices,
+                          float[:, :, ::1] label_proj_matrices,
+                          float[:, :, ::1] depth_maps,
+                          float[:, :, :, ::1] label_probs,
+                          np.int32_t[:, :, ::1] label_ids,
+                          bint hard_labels,
+                          int unknown_label,
+                          int num_threads):
+        cdef int f, i, j
+        cdef FrustumBounds bounds
+        cdef FrustumBounds frame_bounds
+        cdef float[::1] far_depths
+        cdef float[:, :, ::1] depth_z_tables
+        cdef float[:, :, ::1] label_z_tables
+
+        depth_z_tables = np.stack([self._z_table(depth_proj_matrices[f])
+                                   for f in range(depth_maps.shape[0])])
+        label_z_tables = np.stack([self._z_table(label_proj_matrices[f])
+                                   for f in range(depth_maps.shape[0])])
+
+        # Sweep the union of the frustum AABBs of the frames.
+        far_depths = np.empty(depth_maps.shape[0], dtype=np.float32)
+        bounds.i_min = self.volume_shape[0]
+        bounds.i_max = 0
+        bounds.j_min = self.volume_shape[1]
+        bounds.j_max = 0
+        for f in range(depth_maps.shape[0]):
+            far_depths[f] = max_depth(depth_maps[f]) + self.max_distance
+            frame_bounds = self._frustum_bounds(depth_proj_matrices[f],
+                                                depth_maps[f], far_depths[f])
+            if (frame_bounds.i_min >= frame_bounds.i_max or
+                    frame_bounds.j_min >= frame_bounds.j_max):
+                continue
+            bounds.i_min = min(bounds.i_min, frame_bounds.i_min)
+            bounds.i_max = max(bounds.i_max, frame_bounds.i_max)
+            bounds.j_min = min(bounds.j_min, frame_bounds.j_min)
+            bounds.j_max = max(bounds.j_max, frame_bounds.j_max)
+
+        for i in prange(bounds.i_min, bounds.i_max, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
+            for j in range(bounds.j_min, bounds.j_max):
+                self._fuse_column_batch(i, j, depth_proj_matrices,
+                                        label_proj_matrices, depth_z_tables,
+                                        label_z_tables, depth_maps,
+                                        far_depths, label_probs, label_ids,
+                                        hard_labels, unknown_label)
+
+    def fuse_batch(self,
+                   np.float32_t[:, :, ::1] depth_proj_matrices,
+                   np.float32_t[:, :, ::1] label_proj_matrices,
+                   np.float32_t[:, :, ::1] depth_maps,
+                   np.float32_t[:, :, :, ::1] label_maps,
+                   int num_threads=1):
+        # Same as calling fuse for every frame of the stacked inputs in order,
+        # but in a single sweep over the volume.
+        assert depth_proj_matrices.shape[0] == depth_maps.shape[0]
+        assert label_proj_matrices.shape[0] == depth_maps.shape[0]
+        assert label_maps.shape[0] == depth_maps.shape[0]
+        assert label_maps.shape[3] == self.volume_shape[3] - 1
+        assert num_threads > 0
+
+        self._fuse_batch(depth_proj_matrices, label_proj_matrices, depth_maps,
+                         label_maps, None, False, -1, num_threads)
+
+    def fuse_labels_batch(self,
+                          np.float32_t[:, :, ::1] depth_proj_matrices,
+                          np.float32_t[:, :, ::1] label_proj_matrices,
+                          np.float32_t[:, :, ::1] depth_maps,
+                          np.int32_t[:, :, ::1] label_maps,
+                          int unknown_label=-1,
+                          int num_threads=1):
+        # Same as calling fuse_labels for every frame in order.
+        assert depth_proj_matrices.shape[0] == depth_maps.shape[0]
+        assert label_proj_matrices.shape[0] == depth_maps.shape[0]
+        assert label_maps.shape[0] == depth_maps.shape[0]
+        assert unknown_label < self.volume_shape[3] - 1
+        assert num_threads > 0
+
+        self._fuse_batch(depth_proj_matrices, label_proj_matrices, depth_maps,
+                         None, label_maps, True, unknown_label, num_threads)
+
+    cdef void _march_row(self, int v, int pixel_stride, Camera* camera,
+                         float[:, ::1] depth_proj_matrix,
+                         float[:, ::1] label_proj_matrix,
+                         float[:, ::1] depth_map,
+                         float[:, :, ::1] label_probs,
+                         np.int32_t[:, ::1] label_ids,
+                         bint hard_labels,
+                         int unknown_label) noexcept nogil:
+        # Update the voxels crossed by the rays of a row of the depth map.
+        cdef int n, u, i, j, k
+        cdef float x, y, z
+        cdef int label_image_proj_x, label_image_proj_y
+        cdef float signed_distance
+        cdef int label_height, label_width
+        cdef int num_labels = self.volume_shape[3] - 1
+        cdef RayTraversal ray
+
+        if hard_labels:
+            label_height = label_ids.shape[0]
+            label_width = label_ids.shape[1]
+        else:
+            label_height = label_probs.shape[0]
+            label_width = label_probs.shape[1]
+
+        for n in range((depth_map.shape[1] + pixel_stride - 1) // pixel_stride):
+            u = n * pixel_stride
+            if depth_map[v, u] <= 0:
+                continue
+            if not start_ray(&ray, camera, u, v,
+                             depth_map[v, u] + self.max_distance, self.bbox,
+                             self.resolution, self.x_offset,
+                             self.volume_shape[0], self.volume_shape[1],
+                             self.volume_shape[2]):
+                continue
+
+            while True:
+                i = ray.index[0]
+                j = ray.index[1]
+                k = ray.index[2]
+                # The voxels are updated with their own projection exactly
+                # like in the voxel sweep, the rays only select them.
+                if claim_voxel(&self.ray_stamps[i, j, k], self.ray_frame):
+                    x = self.bbox[0, 0] + (i + self.x_offset) * self.resolution
+                    y = self.bbox[1, 0] + j * self.resolution
                     z = self.bbox[2, 0] + k * self.resolution
+                    if project_voxel(depth_proj_matrix, label_proj_matrix,
+                                     depth_map, label_height, label_width,
+                                     x, y, z, &signed_distance,
+                                     &label_image_proj_x,
+                                     &label_image_proj_y):
+                        if hard_labels and self.reduced:
+                            vote_label_half(&self.half_volume[i, j, k, 0],
+                                            num_labels, signed_distance,
+                                            self.max_distance,
+                                            self.free_space_vote,
+                                            self.occupied_space_vote,
+                                            label_ids[label_image_proj_y,
+                                                      label_image_proj_x],
+                                            unknown_label)
+                        elif hard_labels:
+                            vote_label(&self.volume[i, j, k, 0], num_labels,
+                                       signed_distance, self.max_distance,
+                                       self.free_space_vote,
+                                       self.occupied_space_vote,
+                                       label_ids[label_image_proj_y,
+                                                 label_image_proj_x],
+                                       unknown_label)
+                        elif self.reduced:
+                            vote_label_probs_half(
+                                &self.half_volume[i, j, k, 0],
+                                signed_distance, self.max_distance,
+                                self.free_space_vote,
+                                self.occupied_space_vote, label_probs,
+                                label_image_proj_x, label_image_proj_y)
+                        else:
+                            vote_label_probs(&self.volume[i, j, k, 0],
+                                             signed_distance,
+                                             self.max_distance,
+                                             self.free_space_vote,
+                                             self.occupied_space_vote,
+                                             label_probs, label_image_proj_x,
+                                             label_image_proj_y)
+                if not next_voxel(&ray):
+                    break
 
-                    # Compute the depth of the current voxel wrt. the camera.
-                    depth_proj_z = depth_proj_matrix[2, 0] * x + \
-                                   depth_proj_matrix[2, 1] * y + \
-                                   depth_proj_matrix[2, 2] * z + \
-                                   depth_proj_matrix[2, 3]
-                    label_proj_z = label_proj_matrix[2, 0] * x + \
-                                   label_proj_matrix[2, 1] * y + \
-                                   label_proj_matrix[2, 2] * z + \
-                                   label_proj_matrix[2, 3]
-
-                    # Check if voxel behind camera.
-                    if depth_proj_z <= 0 or label_proj_z <= 0:
-                        continue
+    cdef void _fuse_rays(self,
+                         float[:, ::1] depth_proj_matrix,
+                         float[:, ::1] label_proj_matrix,
+                         float[:, ::1] depth_map,
+                         float[:, :, ::1] label_probs,
+                         np.int32_t[:, ::1] label_ids,
+                         bint hard_labels,
+                         int unknown_label,
+                         int pixel_stride,
+                         int num_threads):
+        cdef int v
+        cdef Camera camera
+
+        if not init_camera(depth_proj_matrix, &camera):
+            return
+
+        # Every voxel remembers the last frame that updated it, so the stamps
+        # only have to be allocated for the first frame.
+        if self.ray_frame == 0:
+            self.ray_stamps = np.zeros(list(self.volume_shape)[:3],
+                                       dtype=np.int32)
+        self.ray_frame += 1
+
+        for v in prange(0, depth_map.shape[0], pixel_stride, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
+            self._march_row(v, pixel_stride, &camera, depth_proj_matrix,
+                            label_proj_matrix, depth_map, label_probs,
+                            label_ids, hard_labels, unknown_label)
+
+    def fuse_rays(self,
+                  np.float32_t[:, ::1] depth_proj_matrix,
+                  np.float32_t[:, ::1] label_proj_matrix,
+                  np.float32_t[:, ::1] depth_map,
+                  np.float32_t[:, :, ::1] label_map,
+                  int pixel_stride=1,
+                  int num_threads=1):
+        # Same as fuse, but only visits the voxels crossed by the rays of
+        # every pixel_stride-th pixel (in both directions) with a valid depth,
+        # from the camera up to the truncation distance behind the measured
+        # depth. Every crossed voxel gets the same update as in fuse, voxels
+        # missed by all rays (e.g. smaller than the pixel footprint or behind
+        # depth discontinuities) are not updated.
+        assert label_map.shape[2] == self.volume_shape[3] - 1
+        assert pixel_stride > 0
+        assert num_threads > 0
+
+        self._fuse_rays(depth_proj_matrix, label_proj_matrix, depth_map,
+                        label_map, None, False, -1, pixel_stride, num_threads)
+
+    def fuse_labels_rays(self,
+                         np.float32_t[:, ::1] depth_proj_matrix,
+                         np.float32_t[:, ::1] label_proj_matrix,
+                         np.float32_t[:, ::1] depth_map,
+                         np.int32_t[:, ::1] label_map,
+                         int unknown_label=-1,
+                         int pixel_stride=1,
+                         int num_threads=1):
+        # Same as fuse_rays for a hard label image, see fuse_labels.
+        assert unknown_label < self.volume_shape[3] - 1
+        assert pixel_stride > 0
+        assert num_threads > 0
+
+        self._fuse_rays(depth_proj_matrix, label_proj_matrix, depth_map,
+                        None, label_map, True, unknown_label, pixel_stride,
+                        num_threads)
+
+    cdef bint _project_slice(self, int i, float[:, ::1] depth_proj_matrix,
+                             float[:, ::1] label_proj_matrix,
+                             float[:, ::1] depth_z_table,
+                             float[:, ::1] label_z_table,
+                             float[:, ::1] depth_map, float far_depth,
+                             FrustumBounds bounds, int label_height,
+                             int label_width, bint apply_free_space,
+                             Correspondences* correspondences) noexcept nogil:
+        # Apply the free space votes of the x slice i and append the
+        # correspondences of its voxels in the truncation band, or also of
+        # its free space voxels if not apply_free_space. Returns False if the
+        # correspondences cannot be allocated.
+        cdef int j, k, k_min, k_max
+        cdef float x = self.bbox[0, 0] + (i + self.x_offset) * self.resolution
+        cdef float y
+        cdef int label_image_proj_x, label_image_proj_y
+        cdef float signed_distance
+        cdef int num_labels = self.volume_shape[3] - 1
+        cdef int voxel_index, pixel_index
+        cdef ColumnProjection depth_column, label_column
+
+        for j in range(bounds.j_min, bounds.j_max):
+            y = self.bbox[1, 0] + j * self.resolution
+            if not clip_column(depth_proj_matrix,
+                               depth_map.shape[1], depth_map.shape[0],
+                               far_depth, x, y, self.bbox[2, 0],
+                               self.resolution, self.volume_shape[2],
+                               &k_min, &k_max):
+                continue
+            depth_column = column_projection(depth_proj_matrix, x, y)
+            label_column = column_projection(label_proj_matrix, x, y)
+            for k in range(k_min, k_max):
+                if not project_voxel_column(&depth_column, depth_z_table,
+                                            &label_column, label_z_table,
+                                            depth_map, label_height,
+                                            label_width, k, &signed_distance,
+                                            &label_image_proj_x,
+                                            &label_image_proj_y):
+                    continue
+
+                voxel_index = (i * self.volume_shape[1] + j) * \
+                    self.volume_shape[2] + k
+
+                if abs(signed_distance) > self.max_distance:
+                    if signed_distance > 0 and not apply_free_space:
+                        # Packed pixel index -1 of free space voxels.
+                        if not append_correspondence(correspondences,
+                                                     voxel_index, -2):
+                            return False
+                    elif signed_distance > 0 and self.reduced:
+                        self.half_volume[i, j, k, num_labels] = float_to_half(
+                            half_to_float(self.half_volume[i, j, k,
+                                                           num_labels]) -
+                            self.free_space_vote)
+                    elif signed_distance > 0:
+                        self.volume[i, j, k, num_labels] -= \
+                            self.free_space_vote
+                    continue
+
+                # The lowest bit of the pixel index is set for voxels behind
+                # the measured depth, which get negative label votes.
+                pixel_index = 2 * (label_image_proj_y * label_width +
+                                   label_image_proj_x)
+                if signed_distance < 0:
+                    pixel_index += 1
+                if not append_correspondence(correspondences, voxel_index,
+                                             pixel_index):
+                    return False
+
+        return True
+
+    def project(self,
+                np.float32_t[:, ::1] depth_proj_matrix,
+                np.float32_t[:, ::1] label_proj_matrix,
+                np.float32_t[:, ::1] depth_map,
+                int label_height,
+                int label_width,
+                bint apply_free_space=True,
+                int num_threads=1):
+        # Apply the free space votes of a frame, which do not depend on its
+        # labels, and return the correspondences of the voxels in the
+        # truncation band: their voxel indices into the flattened first three
+        # dimensions of the volume, the pixel indices into the flattened
+        # label image of size label_height x label_width and whether they are
+        # behind the measured depth. refuse or refuse_labels then apply the
+        # label votes of any label image of the frame by only gathering its
+        # pixels, so that project followed by refuse gives the same volume as
+        # fuse. If not apply_free_space, the free space voxels are returned as
+        # well with pixel index -1, so that the correspondences hold all votes
+        # of the frame.
+        assert label_height > 0 and label_width > 0
+        assert label_height * label_width < 2**30
+        assert np.prod(list(self.volume_shape)[:3]) < 2**31
+        assert num_threads > 0
+
+        cdef int i, n
+        cdef int failed = 0
+        cdef int size = 0
+        cdef float far_depth
+        cdef FrustumBounds bounds
+        cdef Correspondences* slices
+        cdef int num_slices
+        cdef np.int32_t[:, ::1] values
+        cdef float[:, ::1] depth_z_table = self._z_table(depth_proj_matrix)
+        cdef float[:, ::1] label_z_table = self._z_table(label_proj_matrix)
+
+        far_depth = max_depth(depth_map) + self.max_distance
+        bounds = self._frustum_bounds(depth_proj_matrix, depth_map, far_depth)
+        num_slices = max(bounds.i_max - bounds.i_min, 0)
+
+        # Every x slice collects its correspondences in its own buffer.
+        slices = <Correspondences*>calloc(max(num_slices, 1),
+                                          sizeof(Correspondences))
+        if slices == NULL:
+            raise MemoryError()
+
+        try:
+            for i in prange(bounds.i_min, bounds.i_max, nogil=True,
+                            schedule="dynamic", num_threads=num_threads):
+                if not self._project_slice(i, depth_proj_matrix,
+                                           label_proj_matrix, depth_z_table,
+                                           label_z_table, depth_map,
+                                           far_depth, bounds, label_height,
+                                           label_width, apply_free_space,
+                                           &slices[i - bounds.i_min]):
+                    failed += 1
+            if failed > 0:
+                raise MemoryError()
+
+            for n in range(num_slices):
+                size += slices[n].size
+            correspondences = np.empty((size, 2), dtype=np.int32)
+            values = correspondences
+            size = 0
+            for n in range(num_slices):
+                if slices[n].size > 0:
+                    memcpy(&values[size, 0], slices[n].values,
+                           2 * sizeof(int) * slices[n].size)
+                    size += slices[n].size
+        finally:
+            for n in range(num_slices):
+                free(slices[n].values)
+            free(slices)
+
+        voxel_indices = np.ascontiguousarray(correspondences[:, 0])
+        pixel_indices = correspondences[:, 1] >> 1
+        behind = (correspondences[:, 1] & 1).astype(np.uint8)
+        return voxel_indices, pixel_indices, behind
+
+    cdef void _refuse(self,
+                      np.int32_t[::1] voxel_indices,
+                      np.int32_t[::1] pixel_indices,
+                      np.uint8_t[::1] behind,
+                      float[:, :, ::1] label_probs,
+                      np.int32_t[:, ::1] label_ids,
+                      bint hard_labels,
+                      int unknown_label,
+                      int num_threads):
+        cdef int n
+        cdef int label_image_proj_x, label_image_proj_y
+        cdef float signed_distance
+        cdef Py_ssize_t offset
+        cdef float* voxel
+        cdef uint16_t* half_voxel
+        cdef int label_width
+        cdef int num_labels = self.volume_shape[3] - 1
+
+        if hard_labels:
+            label_width = label_ids.shape[1]
+        else:
+            label_width = label_probs.shape[1]
+
+        # Every voxel has at most one correspondence per frame, so the
+        # correspondences are applied in parallel.
+        for n in prange(voxel_indices.shape[0], nogil=True,
+                        schedule="static", num_threads=num_threads):
+            offset = <Py_ssize_t>voxel_indices[n] * (num_labels + 1)
+
+            # Free space voxel, see project.
+            if pixel_indices[n] < 0 and self.reduced:
+                half_voxel = &self.half_volume[0, 0, 0, 0] + offset
+                half_voxel[num_labels] = float_to_half(
+                    half_to_float(half_voxel[num_labels]) -
+                    self.free_space_vote)
+                continue
+            elif pixel_indices[n] < 0:
+                voxel = &self.volume[0, 0, 0, 0] + offset
+                voxel[num_labels] -= self.free_space_vote
+                continue
+
+            label_image_proj_x = pixel_indices[n] % label_width
+            label_image_proj_y = pixel_indices[n] // label_width
+            # Any signed distance inside the truncation band with the same
+            # sign gives the same votes.
+            if behind[n]:
+                signed_distance = -self.max_distance
+            else:
+                signed_distance = self.max_distance
+
+            if hard_labels and self.reduced:
+                vote_label_half(&self.half_volume[0, 0, 0, 0] + offset,
+                                num_labels, signed_distance,
+                                self.max_distance, self.free_space_vote,
+                                self.occupied_space_vote,
+                                label_ids[label_image_proj_y,
+                                          label_image_proj_x],
+                                unknown_label)
+            elif hard_labels:
+                vote_label(&self.volume[0, 0, 0, 0] + offset,
+                           num_labels, signed_distance, self.max_distance,
+                           self.free_space_vote, self.occupied_space_vote,
+                           label_ids[label_image_proj_y, label_image_proj_x],
+                           unknown_label)
+            elif self.reduced:
+                vote_label_probs_half(&self.half_volume[0, 0, 0, 0] + offset,
+                                      signed_distance, self.max_distance,
+                                      self.free_space_vote,
+                                      self.occupied_space_vote, label_probs,
+                                      label_image_proj_x, label_image_proj_y)
+            else:
+                vote_label_probs(&self.volume[0, 0, 0, 0] + offset,
+                                 signed_distance, self.max_distance,
+                                 self.free_space_vote,
+                                 self.occupied_space_vote, label_probs,
+                                 label_image_proj_x, label_image_proj_y)
+
+    def _check_correspondences(self, voxel_indices, pixel_indices, behind,
+                               label_height, label_width):
+        assert voxel_indices.shape == pixel_indices.shape == behind.shape
+        if voxel_indices.shape[0] > 0:
+            assert 0 <= np.min(voxel_indices)
+            assert np.max(voxel_indices) < np.prod(list(self.volume_shape)[:3])
+            assert -1 <= np.min(pixel_indices)
+            assert np.max(pixel_indices) < label_height * label_width
 
-                    # Compute pixel location of the current voxel in the image.
-                    depth_proj_x = depth_proj_matrix[0, 0] * x + \
-                                   depth_proj_matrix[0, 1] * y + \
-                                   depth_proj_matrix[0, 2] * z + \
-                                   depth_proj_matrix[0, 3]
-                    depth_proj_y = depth_proj_matrix[1, 0] * x + \
-                                   depth_proj_matrix[1, 1] * y + \
-                                   depth_proj_matrix[1, 2] * z + \
-                                   depth_proj_matrix[1, 3]
-                    label_proj_x = label_proj_matrix[0, 0] * x + \
-                                   label_proj_matrix[0, 1] * y + \
-                                   label_proj_matrix[0, 2] * z + \
-                                   label_proj_matrix[0, 3]
-                    label_proj_y = label_proj_matrix[1, 0] * x + \
-                                   label_proj_matrix[1, 1] * y + \
-                                   label_proj_matrix[1, 2] * z + \
-                                   label_proj_matrix[1, 3]
-                    depth_image_proj_x = <int>round(depth_proj_x / depth_proj_z)
-                    depth_image_proj_y = <int>round(depth_proj_y / depth_proj_z)
-                    label_image_proj_x = <int>round(label_proj_x / label_proj_z)
-                    label_image_proj_y = <int>round(label_proj_y / label_proj_z)
-
-                    # Check if projection is inside image.
-                    if (depth_image_proj_x < 0 or depth_image_proj_y < 0 or
-                        depth_image_proj_x >= depth_map.shape[1] or
-                        depth_image_proj_y >= depth_map.shape[0] or
-                        label_image_proj_x < 0 or label_image_proj_y < 0 or
-                        label_image_proj_x >= label_map.shape[1] or
-                        label_image_proj_y >= label_map.shape[0]):
+    def refuse(self,
+               np.int32_t[::1] voxel_indices,
+               np.int32_t[::1] pixel_indices,
+               np.uint8_t[::1] behind,
+               np.float32_t[:, :, ::1] label_map,
+               int num_threads=1):
+        # Apply the label votes of a frame, and the free space votes returned
+        # by project, from its correspondences for a label image of the same
+        # size.
+        assert label_map.shape[2] == self.volume_shape[3] - 1
+        assert num_threads > 0
+        self._check_correspondences(np.asarray(voxel_indices),
+                                    np.asarray(pixel_indices),
+                                    np.asarray(behind),
+                                    label_map.shape[0], label_map.shape[1])
+
+        self._refuse(voxel_indices, pixel_indices, behind, label_map, None,
+                     False, -1, num_threads)
+
+    def refuse_labels(self,
+                      np.int32_t[::1] voxel_indices,
+                      np.int32_t[::1] pixel_indices,
+                      np.uint8_t[::1] behind,
+                      np.int32_t[:, ::1] label_map,
+                      int unknown_label=-1,
+                      int num_threads=1):
+        # Same as refuse for a hard label image, see fuse_labels.
+        assert unknown_label < self.volume_shape[3] - 1
+        assert num_threads > 0
+        self._check_correspondences(np.asarray(voxel_indices),
+                                    np.asarray(pixel_indices),
+                                    np.asarray(behind),
+                                    label_map.shape[0], label_map.shape[1])
+
+        self._refuse(voxel_indices, pixel_indices, behind, None, label_map,
+                     True, unknown_label, num_threads)
+
+cdef class TopKTSDFVolume:
+
+    # Same votes as TSDFVolume, but every voxel only stores its free space
+    # vote and the votes of at most top_k labels as (label id, vote) pairs,
+    # see add_top_k_vote for the rule applied when more labels are observed.
+
+    cdef float[:, ::1] bbox
+    cdef float free_space_vote
+    cdef float occupied_space_vote
+    cdef float resolution
+    cdef float max_distance
+    cdef int num_labels
+    cdef int top_k
+    cdef np.uint8_t[:, :, :, ::1] label_ids
+    cdef float[:, :, :, ::1] label_votes
+    cdef float[:, :, ::1] free_space
+
+    def __init__(self, num_labels, bbox, resolution, resolution_factor,
+                 free_space_vote=0.5, occupied_space_vote=1, top_k=3):
+        assert 0 < num_labels < EMPTY_LABEL
+        assert resolution > 0
+        assert resolution_factor > 0
+        assert free_space_vote >= 0
+        assert occupied_space_vote >= 0
+        assert 0 < top_k <= num_labels
+
+        self.bbox = bbox.astype(np.float32)
+        self.resolution = resolution
+        self.max_distance = resolution_factor * self.resolution
+        self.free_space_vote = free_space_vote
+        self.occupied_space_vote = occupied_space_vote
+        self.num_labels = num_labels
+        self.top_k = top_k
+
+        volume_size = np.diff(bbox, axis=1)
+        volume_shape = volume_size.ravel() / self.resolution
+        volume_shape = np.ceil(volume_shape).astype(np.int32).tolist()
+
+        self.label_ids = np.full(volume_shape + [top_k], EMPTY_LABEL,
+                                 dtype=np.uint8)
+        self.label_votes = np.zeros(volume_shape + [top_k], dtype=np.float32)
+        self.free_space = np.zeros(volume_shape, dtype=np.float32)
+
+    def get_label_ids(self, copy=True):
+        # See TSDFVolume.get_volume for copy=False, same for the votes and
+        # free space.
+        return np.array(self.label_ids, copy=copy)
+
+    def get_label_votes(self, copy=True):
+        return np.array(self.label_votes, copy=copy)
+
+    def get_free_space(self, copy=True):
+        return np.array(self.free_space, copy=copy)
+
+    def get_volume(self, copy=True):
+        # Expand to the dense layout of TSDFVolume, which is always a new
+        # array.
+        return expand_top_k(np.asarray(self.label_ids),
+                            np.asarray(self.label_votes),
+                            np.asarray(self.free_space), self.num_labels)
+
+    cdef float[:, ::1] _z_table(self, float[:, ::1] proj_matrix):
+        z_table = np.empty((self.free_space.shape[2], 3), dtype=np.float32)
+        fill_z_table(proj_matrix, self.bbox[2, 0], self.resolution, z_table)
+        return z_table
+
+    def fuse(self,
+             np.float32_t[:, ::1] depth_proj_matrix,
+             np.float32_t[:, ::1] label_proj_matrix,
+             np.float32_t[:, ::1] depth_map,
+             np.float32_t[:, :, ::1] label_map,
+             int num_threads=1):
+        assert label_map.shape[2] == self.num_labels
+        assert num_threads > 0
+
+        cdef int i, j, k
+        cdef int k_min, k_max
+        cdef float far_depth
+        cdef FrustumBounds bounds
+        cdef float x, y
+        cdef int label_image_proj_x, label_image_proj_y
+        cdef float signed_distance
+        cdef ColumnProjection depth_column, label_column
+        cdef float[:, ::1] depth_z_table = self._z_table(depth_proj_matrix)
+        cdef float[:, ::1] label_z_table = self._z_table(label_proj_matrix)
+
+        far_depth = max_depth(depth_map) + self.max_distance
+        bounds = frustum_voxel_bounds(depth_proj_matrix,
+                                      depth_map.shape[1], depth_map.shape[0],
+                                      far_depth, self.bbox, self.resolution,
+                                      self.free_space.shape[0],
+                                      self.free_space.shape[1])
+
+        for i in prange(bounds.i_min, bounds.i_max, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
+            x = self.bbox[0, 0] + i * self.resolution
+            for j in range(bounds.j_min, bounds.j_max):
+                y = self.bbox[1, 0] + j * self.resolution
+                # Variables that are only written through pointers have to be
+                # assigned in the loop body to be thread-private in prange.
+                k_min = 0
+                k_max = 0
+                signed_distance = 0
+                label_image_proj_x = 0
+                label_image_proj_y = 0
+                if not clip_column(depth_proj_matrix,
+                                   depth_map.shape[1], depth_map.shape[0],
+                                   far_depth, x, y, self.bbox[2, 0],
+                                   self.resolution, self.free_space.shape[2],
+                                   &k_min, &k_max):
+                    continue
+                depth_column = column_projection(depth_proj_matrix, x, y)
+                label_column = column_projection(label_proj_matrix, x, y)
+                for k in range(k_min, k_max):
+                    if not project_voxel_column(&depth_column, depth_z_table,
+                                                &label_column, label_z_table,
+                                                depth_map, label_map.shape[0],
+                                                label_map.shape[1], k,
+                                                &signed_distance,
+                                                &label_image_proj_x,
+                                                &label_image_proj_y):
                         continue
 
-                    # Extract measured depth at projection.
-                    depth = depth_map[depth_image_proj_y, depth_image_proj_x]
+                    vote_top_k_label_probs(&self.label_ids[i, j, k, 0],
+                                           &self.label_votes[i, j, k, 0],
+                                           &self.free_space[i, j, k],
+                                           self.top_k, signed_distance,
+                                           self.max_distance,
+                                           self.free_space_vote,
+                                           self.occupied_space_vote,
+                                           label_map, label_image_proj_x,
+                                           label_image_proj_y)
+
+    def fuse_labels(self,
+                    np.float32_t[:, ::1] depth_proj_matrix,
+                    np.float32_t[:, ::1] label_proj_matrix,
+                    np.float32_t[:, ::1] depth_map,
+                    np.int32_t[:, ::1] label_map,
+                    int unknown_label=-1,
+                    int num_threads=1):
+        assert unknown_label < self.num_labels
+        assert num_threads > 0
+
+        cdef int i, j, k
+        cdef int k_min, k_max
+        cdef float far_depth
+        cdef FrustumBounds bounds
+        cdef float x, y
+        cdef int label_image_proj_x, label_image_proj_y
+        cdef float signed_distance
+        cdef ColumnProjection depth_column, label_column
+        cdef float[:, ::1] depth_z_table = self._z_table(depth_proj_matrix)
+        cdef float[:, ::1] label_z_table = self._z_table(label_proj_matrix)
+        cdef int label
+
+        far_depth = max_depth(depth_map) + self.max_distance
+        bounds = frustum_voxel_bounds(depth_proj_matrix,
+                                      depth_map.shape[1], depth_map.shape[0],
+                                      far_depth, self.bbox, self.resolution,
+                                      self.free_space.shape[0],
+                                      self.free_space.shape[1])
+
+        for i in prange(bounds.i_min, bounds.i_max, nogil=True,
+                        schedule="dynamic", num_threads=num_threads):
+            x = self.bbox[0, 0] + i * self.resolution
+            for j in range(bounds.j_min, bounds.j_max):
+                y = self.bbox[1, 0] + j * self.resolution
+                # Variables that are only written through pointers have to be
+                # assigned in the loop body to be thread-private in prange.
+                k_min = 0
+                k_max = 0
+                signed_distance = 0
+                label_image_proj_x = 0
+                label_image_proj_y = 0
+                if not clip_column(depth_proj_matrix,
+                                   depth_map.shape[1], depth_map.shape[0],
+                                   far_depth, x, y, self.bbox[2, 0],
+                                   self.resolution, self.free_space.shape[2],
+                                   &k_min, &k_max):
+                    continue
+                depth_column = column_projection(depth_proj_matrix, x, y)
+                label_column = column_projection(label_proj_matrix, x, y)
+                for k in range(k_min, k_max):
+                    if not project_voxel_column(&depth_column, depth_z_table,
+                                                &label_column, label_z_table,
+                                                depth_map, label_map.shape[0],
+                                                label_map.shape[1], k,
+                                                &signed_distance,
+                                                &label_image_proj_x,
+                                                &label_image_proj_y):
+                        continue
 
                     # Check if voxel is inside the truncated distance field.
-                    signed_distance = depth - depth_proj_z
                     if abs(signed_distance) > self.max_distance:
                         # Check if voxel is between observed depth and camera.
                         if signed_distance > 0:
                             # Vote for free space.
-                            self.volume[i, j, k, -1] -= self.free_space_vote
+                            self.free_space[i, j, k] -= self.free_space_vote
                         continue
 
-                    # Accumulate the votes for each label.
-                    for label in range(label_map.shape[2]):
-                        label_prob = label_map[label_image_proj_y,
-                                               label_image_proj_x,
-                                               label]
-                        if signed_distance < 0:
-                            self.volume[i, j, k, label] -= \
-                                label_prob * self.occupied_space_vote
+                    label = label_map[label_image_proj_y, label_image_proj_x]
+                    if label < 0 or label >= self.num_labels:
+                        label = unknown_label
+                        if label < 0:
+                            continue
+                    if signed_distance < 0:
+                        add_top_k_vote(&self.label_ids[i, j, k, 0],
+                                       &self.label_votes[i, j, k, 0],
+                                       self.top_k, label,
+                                       -self.occupied_space_vote)
+                    else:
+                        add_top_k_vote(&self.label_ids[i, j, k, 0],
+                                       &self.label_votes[i, j, k, 0],
+                                       self.top_k, label,
+                                       self.occupied_space_vote)
+
+
+def expand_top_k(label_ids, label_votes, free_space, num_labels):
+    # Expand the (label id, vote) slots and free space votes of a
+    # TopKTSDFVolume to the dense layout of TSDFVolume.
+    volume = np.zeros(free_space.shape + (num_labels + 2,), dtype=np.float32)
+    np.put_along_axis(volume, label_ids.astype(np.intp).clip(0, num_labels + 1),
+                      label_votes, axis=-1)
+    volume[..., num_labels] = free_space
+    return volume[..., :num_labels + 1]
+
+
+cdef class SparseTSDFVolume:
+
+    # Same votes as TSDFVolume, but the voxels are stored in BLOCK_SIZE^3
+    # blocks, which are only allocated once a frame can update one of their
+    # voxels. The block table maps the coordinates of every block of the
+    # bbox to its slot in the block pool, or -1 if it is not allocated.
+
+    cdef float[:, ::1] bbox
+    cdef float free_space_vote
+    cdef float occupied_space_vote
+    cdef float resolution
+    cdef float max_distance
+    cdef int num_labels
+    cdef int num_blocks
+    cdef int[:, :, ::1] block_table
+    cdef int[:, ::1] block_coords
+    cdef float[:, :, :, :, ::1] blocks
+    cdef object volume_shape
+
+    def __init__(self, num_labels, bbox, resolution, resolution_factor,
+                 free_space_vote=0.5, occupied_space_vote=1,
+                 initial_num_blocks=1024):
+        assert num_labels > 0
+        assert resolution > 0
+        assert resolution_factor > 0
+        assert free_space_vote >= 0
+        assert occupied_space_vote >= 0
+        assert initial_num_blocks > 0
+
+        self.bbox = bbox.astype(np.float32)
+        self.resolution = resolution
+        self.max_distance = resolution_factor * self.resolution
+        self.free_space_vote = free_space_vote
+        self.occupied_space_vote = occupied_space_vote
+        self.num_labels = num_labels
+
+        volume_size = np.diff(bbox, axis=1)
+        volume_shape = volume_size.ravel() / self.resolution
+        volume_shape = np.ceil(volume_shape).astype(np.int32).tolist()
+        self.volume_shape = volume_shape
+
+        block_table_shape = [(s + BLOCK_SIZE - 1) // BLOCK_SIZE
+                             for s in volume_shape]
+        self.block_table = np.full(block_table_shape, -1, dtype=np.int32)
+        self.block_coords = np.zeros((initial_num_blocks, 3), dtype=np.int32)
+        self.blocks = np.zeros((initial_num_blocks, BLOCK_SIZE, BLOCK_SIZE,
+                                BLOCK_SIZE, num_labels + 1), dtype=np.float32)
+        self.num_blocks = 0
+
+    def get_num_blocks(self):
+        return self.num_blocks
+
+    def get_volume(self, copy=True):
+        # The dense volume is always a new array.
+        return self.to_dense()
+
+    def to_dense(self):
+        volume = np.zeros(self.volume_shape + [self.num_labels + 1],
+                          dtype=np.float32)
+        blocks = np.asarray(self.blocks)
+        block_coords = np.asarray(self.block_coords)
+        for slot in range(self.num_blocks):
+            i, j, k = block_coords[slot] * BLOCK_SIZE
+            block_volume = volume[i:i + BLOCK_SIZE,
+                                  j:j + BLOCK_SIZE,
+                                  k:k + BLOCK_SIZE]
+            block_volume[...] = blocks[slot,
+                                       :block_volume.shape[0],
+                                       :block_volume.shape[1],
+                                       :block_volume.shape[2]]
+        return volume
+
+    def to_coords_features(self):
+        # The voxel indices and votes of all voxels with at least one vote.
+        offsets = np.arange(BLOCK_SIZE, dtype=np.int32)
+        offsets = np.stack(np.meshgrid(offsets, offsets, offsets,
+                                       indexing="ij"), axis=-1)
+        block_coords = np.asarray(self.block_coords)[:self.num_blocks]
+        coords = block_coords[:, None, None, None] * BLOCK_SIZE + offsets
+        coords = coords.reshape(-1, 3)
+        features = np.asarray(self.blocks)[:self.num_blocks]
+        features = features.reshape(-1, self.num_labels + 1)
+        mask = np.all(coords < np.array(self.volume_shape), axis=1) & \
+            np.any(features != 0, axis=1)
+        return coords[mask], features[mask]
+
+    cdef int _allocate_block(self, int bi, int bj, int bk):
+        cdef int num_allocated = self.blocks.shape[0]
+        if self.num_blocks == num_allocated:
+            blocks = np.zeros((2 * num_allocated, BLOCK_SIZE, BLOCK_SIZE,
+                               BLOCK_SIZE, self.num_labels + 1),
+                              dtype=np.float32)
+            blocks[:num_allocated] = self.blocks
+            self.blocks = blocks
+            block_coords = np.zeros((2 * num_allocated, 3), dtype=np.int32)
+            block_coords[:num_allocated] = self.block_coords
+            self.block_coords = block_coords
+
+        self.block_coords[self.num_blocks, 0] = bi
+        self.block_coords[self.num_blocks, 1] = bj
+        self.block_coords[self.num_blocks, 2] = bk
+        self.block_table[bi, bj, bk] = self.num_blocks
+        self.num_blocks += 1
+        return self.num_blocks - 1
+
+    cdef object _touched_blocks(self, float[:, ::1] depth_proj_matrix,
+                                float[:, ::1] depth_map):
+        # Allocate the blocks that the frame can update and return their slots.
+        cdef FrustumBounds bounds
+        cdef int bi, bj, bk, slot
+        cdef int num_touched = 0
+        cdef float extent = (BLOCK_SIZE - 1) * self.resolution
+        cdef float[:, ::1] tiles
+        cdef int[::1] touched
+
+        bounds = frustum_voxel_bounds(depth_proj_matrix,
+                                      depth_map.shape[1], depth_map.shape[0],
+                                      max_depth(depth_map) + self.max_distance,
+                                      self.bbox, self.resolution,
+                                      self.volume_shape[0],
+                                      self.volume_shape[1])
+        if bounds.i_min >= bounds.i_max or bounds.j_min >= bounds.j_max:
+            return np.zeros(0, dtype=np.int32)
+
+        tiles = np.zeros(((depth_map.shape[0] + DEPTH_TILE_SIZE - 1) //
+                          DEPTH_TILE_SIZE,
+                          (depth_map.shape[1] + DEPTH_TILE_SIZE - 1) //
+                          DEPTH_TILE_SIZE), dtype=np.float32)
+        tile_max_depth(depth_map, tiles)
+
+        touched = np.empty(self.block_table.shape[0] *
+                           self.block_table.shape[1] *
+                           self.block_table.shape[2], dtype=np.int32)
+
+        for bi in range(bounds.i_min // BLOCK_SIZE,
+                        (bounds.i_max - 1) // BLOCK_SIZE + 1):
+            for bj in range(bounds.j_min // BLOCK_SIZE,
+                            (bounds.j_max - 1) // BLOCK_SIZE + 1):
+                for bk in range(self.block_table.shape[2]):
+                    if not box_in_frustum(
+                            depth_proj_matrix, tiles,
+                            depth_map.shape[1], depth_map.shape[0],
+                            self.max_distance,
+                            self.bbox[0, 0] + bi * BLOCK_SIZE * self.resolution,
+                            self.bbox[1, 0] + bj * BLOCK_SIZE * self.resolution,
+                            self.bbox[2, 0] + bk * BLOCK_SIZE * self.resolution,
+                            extent):
+                        continue
+                    slot = self.block_table[bi, bj, bk]
+                    if slot < 0:
+                        slot = self._allocate_block(bi, bj, bk)
+                    touched[num_touched] = slot
+                    num_touched += 1
+
+        # In slot order, so that the blocks are fused in the order of the
+        # block pool in memory.
+        return np.sort(np.asarray(touched)[:num_touched])
+
+    cdef void _fuse_blocks(self,
+                           float[:, ::1] depth_proj_matrix,
+                           float[:, ::1] label_proj_matrix,
+                           float[:, ::1] depth_map,
+                           float[:, :, ::1] label_probs,
+                           np.int32_t[:, ::1] label_ids,
+                           bint hard_labels,
+                           int unknown_label,
+                           np.int32_t[::1] touched,
+                           int num_threads):
+        cdef int n, slot, a, b, c, i, j, k
+        cdef float x, y
+        cdef ColumnProjection depth_column, label_column
+        cdef float[:, ::1] depth_z_table = np.empty((self.volume_shape[2], 3),
+                                                    dtype=np.float32)
+        cdef float[:, ::1] label_z_table = np.empty_like(depth_z_table)
+        cdef int label_image_proj_x, label_image_proj_y
+        cdef float signed_distance
+        cdef int label_height, label_width
+        cdef int nx = self.volume_shape[0]
+        cdef int ny = self.volume_shape[1]
+        cdef int nz = self.volume_shape[2]
+
+        if hard_labels:
+            label_height = label_ids.shape[0]
+            label_width = label_ids.shape[1]
+        else:
+            label_height = label_probs.shape[0]
+            label_width = label_probs.shape[1]
+
+        fill_z_table(depth_proj_matrix, self.bbox[2, 0], self.resolution,
+                     depth_z_table)
+        fill_z_table(label_proj_matrix, self.bbox[2, 0], self.resolution,
+                     label_z_table)
+
+        # Every voxel is only written by the iteration of its block, so the
+        # blocks are fused in parallel without the GIL.
+        for n in prange(touched.shape[0], nogil=True, schedule="dynamic",
+                        num_threads=num_threads):
+            slot = touched[n]
+            # Variables that are only written through pointers have to be
+            # assigned in the loop body to be thread-private in prange.
+            signed_distance = 0
+            label_image_proj_x = 0
+            label_image_proj_y = 0
+            for a in range(BLOCK_SIZE):
+                i = self.block_coords[slot, 0] * BLOCK_SIZE + a
+                if i >= nx:
+                    break
+                x = self.bbox[0, 0] + i * self.resolution
+                for b in range(BLOCK_SIZE):
+                    j = self.block_coords[slot, 1] * BLOCK_SIZE + b
+                    if j >= ny:
+                        break
+                    y = self.bbox[1, 0] + j * self.resolution
+                    depth_column = column_projection(depth_proj_matrix, x, y)
+                    label_column = column_projection(label_proj_matrix, x, y)
+                    for c in range(BLOCK_SIZE):
+                        k = self.block_coords[slot, 2] * BLOCK_SIZE + c
+                        if k >= nz:
+                            break
+
+                        if not project_voxel_column(
+                                &depth_column, depth_z_table, &label_column,
+                                label_z_table, depth_map, label_height,
+                                label_width, k, &signed_distance,
+                                &label_image_proj_x, &label_image_proj_y):
+                            continue
+
+                        if hard_labels:
+                            vote_label(&self.blocks[slot, a, b, c, 0],
+                                       self.num_labels, signed_distance,
+                                       self.max_distance,
+                                       self.free_space_vote,
+                                       self.occupied_space_vote,
+                                       label_ids[label_image_proj_y,
+                                                 label_image_proj_x],
+                                       unknown_label)
                         else:
-                            self.volume[i, j, k, label] += \
-                                label_prob * self.occupied_space_vote
+                            vote_label_probs(&self.blocks[slot, a, b, c, 0],
+                                             signed_distance,
+                                             self.max_distance,
+                                             self.free_space_vote,
+                                             self.occupied_space_vote,
+                                             label_probs,
+                                             label_image_proj_x,
+                                             label_image_proj_y)
+
+    def fuse(self,
+             np.float32_t[:, ::1] depth_proj_matrix,
+             np.float32_t[:, ::1] label_proj_matrix,
+             np.float32_t[:, ::1] depth_map,
+             np.float32_t[:, :, ::1] label_map,
+             int num_threads=1):
+        assert label_map.shape[2] == self.num_labels
+        assert num_threads > 0
+
+        touched = self._touched_blocks(depth_proj_matrix, depth_map)
+        self._fuse_blocks(depth_proj_matrix, label_proj_matrix, depth_map,
+                          label_map, None, False, -1, touched, num_threads)
+
+    def fuse_labels(self,
+                    np.float32_t[:, ::1] depth_proj_matrix,
+                    np.float32_t[:, ::1] label_proj_matrix,
+                    np.float32_t[:, ::1] depth_map,
+                    np.int32_t[:, ::1] label_map,
+                    int unknown_label=-1,
+                    int num_threads=1):
+        assert unknown_label < self.num_labels
+        assert num_threads > 0
+
+        touched = self._touched_blocks(depth_proj_matrix, depth_map)
+        self._fuse_blocks(depth_proj_matrix, label_proj_matrix, depth_map,
+                          None, label_map, True, unknown_label, touched,
+                          num_threads)
+
+
+cdef class BrickedTSDFVolume(SparseTSDFVolume):
+
+    # Same as SparseTSDFVolume, but all blocks of the bbox are allocated up
+    # front in the Morton order of their block coordinates. The voxels of a
+    # block are contiguous and neighbouring blocks are close in memory, so
+    # the block-wise fusion only touches the pages of the blocks it updates,
+    # instead of one page per voxel column as in the [X, Y, Z, C] layout.
+
+    def __init__(self, num_labels, bbox, resolution, resolution_factor,
+                 free_space_vote=0.5, occupied_space_vote=1):
+        SparseTSDFVolume.__init__(self, num_labels, bbox, resolution,
+                                  resolution_factor, free_space_vote,
+                                  occupied_space_vote, initial_num_blocks=1)
+
+        block_coords = morton_order(np.asarray(self.block_table).shape)
+        num_blocks = len(block_coords)
+        self.blocks = np.zeros((num_blocks, BLOCK_SIZE, BLOCK_SIZE,
+                                BLOCK_SIZE, num_labels + 1), dtype=np.float32)
+        self.block_coords = block_coords
+        np.asarray(self.block_table)[tuple(block_coords.T)] = \
+            np.arange(num_blocks, dtype=np.int32)
+        self.num_blocks = num_blocks
+
+    def get_bricks(self):
+        # The (num_blocks, BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE, num_labels + 1)
+        # block pool without copying, with the block coordinates of its slots.
+        return np.asarray(self.blocks), np.asarray(self.block_coords)
+
+    def to_dense(self):
+        return bricks_to_dense(np.asarray(self.blocks),
+                               np.asarray(self.block_table),
+                               self.volume_shape)
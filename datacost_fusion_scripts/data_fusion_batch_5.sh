@@ -48,10 +48,12 @@ do
     rm -r ${scene_path}/label
     rm -r ${scene_path}/sensor
 
-    # Fuse all depth maps and segmentation to create the ground-truth
+    # Fuse all depth maps and segmentation to create the ground-truth, and
+    # every 50 frame to generate incomplete input data, in a single pass
     python3 $SCANNET_PATH/TSDF/tsdf_fusion.py \
         --input_path $scene_path/converted/ \
-        --output_path $scene_path/converted/groundtruth_datacost \
+        --target $scene_path/converted/groundtruth_datacost \
+        --target $scene_path/converted/datacost frame_rate=50 \
         --resolution 0.05
 
     # # Run total variation on the datacost obtained from all depth
@@ -62,13 +64,6 @@ do
     #     --label_map_path $scene_path/converted/labels.txt \
     #     --niter_steps 10 --lam 10 --nclasses 42
 
-    # Fuse every 50 frame to generate incomplete input data
-    python3 $SCANNET_PATH/TSDF/tsdf_fusion.py \
-        --input_path $scene_path/converted/ \
-        --output_path $scene_path/converted/datacost \
-        --frame_rate 50 \
-        --resolution 0.05
-
     rm -r $scene_path/converted/images
 
     count=count+1
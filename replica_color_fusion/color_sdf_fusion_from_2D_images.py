@@ -4,6 +4,7 @@ import argparse
 import numpy as np
 from PIL import Image
 from color_sdf_fusion_volume import ColorSDFVolume
+from prefetch import prefetch
 
 
 def parse_args():
@@ -15,6 +16,15 @@ def parse_args():
     parser.add_argument("--frame_rate", type=int, default=1)
     parser.add_argument("--resolution", type=float, default=0.05)
     parser.add_argument("--resolution_factor", type=int, default=2)
+    parser.add_argument("--num_threads", type=int, default=1)
+    # uint8 colors, float16 sdf and uint16 weights instead of float32.
+    parser.add_argument("--precision", choices=("full", "reduced"),
+                        default="full")
+    # Load and decode up to this many of the next frames in background
+    # threads while the current one is fused.
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--prefetch_workers", type=int, default=1)
+    parser.add_argument("--prefetch_memory_mb", type=float)
     return parser.parse_args()
 
 
@@ -35,49 +45,60 @@ def write_ply(path, points, color):
                                                    points[i, 2], *color))
 
 
+def load_frame(input_path, camera_path):
+    frame_id = int(os.path.basename(camera_path)[6:11])
+    depth_map_path = os.path.join(input_path,
+                               "frames/frame-{:05d}.depth.png".format(frame_id))
+
+    color_map_path = os.path.join(input_path,
+                               "frames/frame-{:05d}.rgba.png".format(frame_id))
+    
+    camera = np.load(camera_path)
+    proj_matrix = camera['projection_matrix']
+    cam_matrix = camera['camera_matrix']
+    transform_matrix =  np.matmul(proj_matrix, cam_matrix)
+
+    depth_map = Image.open(depth_map_path)
+    depth_map = np.ascontiguousarray(depth_map, dtype=np.float32)
+    depth_map = depth_map*10/255 ## here depth map stores unprojected depth value
+
+    # The uint8 RGBA image is fused as it is, the alpha channel is ignored.
+    color_image = Image.open(color_map_path)
+    color_image = np.array(color_image, dtype=np.uint8)
+
+    return frame_id, transform_matrix, depth_map, color_image
+
+
 def main():
     args = parse_args()
 
     bbox = np.loadtxt(os.path.join(args.input_path, "bbox.txt"))
 
-    color_sdf_volume = ColorSDFVolume(bbox, args.viewport_height, args.viewport_width, args.resolution, args.resolution_factor)
+    color_sdf_volume = ColorSDFVolume(bbox, args.viewport_height, args.viewport_width, args.resolution, args.resolution_factor,
+                                      precision=args.precision)
 
     camera_paths = sorted(glob.glob(os.path.join(args.input_path,
                                                 "frames/frame*.npz")))
 
-    for i, camera_path in enumerate(camera_paths):
-        if i % args.frame_rate != 0:
-            continue
+    frame_ids = range(0, len(camera_paths), args.frame_rate)
+    frames = prefetch(lambda camera_path: load_frame(args.input_path,
+                                                     camera_path),
+                      [camera_paths[i] for i in frame_ids],
+                      args.prefetch, args.prefetch_workers,
+                      args.prefetch_memory_mb)
 
-        frame_id = int(os.path.basename(camera_path)[6:11])
+    for i, (frame_id, transform_matrix, depth_map, color_image) in \
+            zip(frame_ids, frames):
         print("Processing frame {} [{}/{}]".format(
              frame_id, i + 1, len(camera_paths)))
-        depth_map_path = os.path.join(args.input_path,
-                                   "frames/frame-{:05d}.depth.png".format(frame_id))
-
-        color_map_path = os.path.join(args.input_path,
-                                   "frames/frame-{:05d}.rgba.png".format(frame_id))
-        
-        camera = np.load(camera_path)
-        proj_matrix = camera['projection_matrix']
-        cam_matrix = camera['camera_matrix']
-        transform_matrix =  np.matmul(proj_matrix, cam_matrix)
-
-        depth_map = Image.open(depth_map_path)
-        depth_map = np.ascontiguousarray(depth_map, dtype=np.float32)
-        depth_map = depth_map*10/255 ## here depth map stores unprojected depth value
-
-        color_image = Image.open(color_map_path)
-        color_image = np.ascontiguousarray(color_image, dtype=np.float32)
-        color_image = color_image[:,:,:-1].copy(order='C')
-
-        
+
         color_sdf_volume.fuse(transform_matrix,
-                            depth_map, color_image)
+                            depth_map, color_image,
+                            num_threads=args.num_threads)
 
 
     np.savez(args.output_path + "color_sdf.npz",
-             volume=color_sdf_volume.get_volume(),
+             volume=color_sdf_volume.get_volume(copy=False),
              resolution=args.resolution)
 
 
@@ -5,8 +5,60 @@
 import numpy as np
 cimport numpy as np
 from libc.math cimport round
+from libc.stdint cimport uint8_t, uint16_t
+from cython.parallel cimport prange
 from libc.stdio cimport printf
 
+from precision cimport float_to_half, half_to_float, float_to_uint8, \
+    increment_weight, color_t
+
+
+# Number of color channels of the volume, the fourth (alpha) channel of the
+# RGBA color maps is ignored.
+cdef enum:
+    NUM_COLORS = 3
+
+
+cdef inline void update_color_sdf_reduced(uint8_t* color, uint16_t* sdf,
+                                          uint16_t* sdf_weight,
+                                          uint16_t* color_weight,
+                                          float signed_distance,
+                                          float max_distance,
+                                          color_t[:, :, ::1] color_map,
+                                          int color_image_proj_x,
+                                          int color_image_proj_y) noexcept nogil:
+    # Same running averages as ColorSDFVolume.fuse for uint8 colors, a float16
+    # sdf and uint16 weights, which stop counting at MAX_WEIGHT.
+    cdef int ch
+    cdef float truncated_distance
+    cdef float prior_weight, new_weight
+
+    if signed_distance >= -max_distance:
+        if signed_distance > 0:
+            truncated_distance = min(signed_distance, max_distance)
+        else:
+            truncated_distance = signed_distance
+
+        prior_weight = sdf_weight[0]
+        new_weight = prior_weight + 1
+        sdf[0] = float_to_half((prior_weight * half_to_float(sdf[0]) +
+                                truncated_distance) / new_weight)
+        increment_weight(sdf_weight)
+
+    if abs(signed_distance) > max_distance:
+        return
+
+    prior_weight = color_weight[0]
+    new_weight = prior_weight + 1
+
+    for ch in range(NUM_COLORS):
+        color[ch] = float_to_uint8(
+            (prior_weight * color[ch] +
+             color_map[color_image_proj_y, color_image_proj_x, ch]) /
+            new_weight)
+
+    increment_weight(color_weight)
+
 
 cdef class ColorSDFVolume:
 
@@ -18,10 +70,18 @@ cdef class ColorSDFVolume:
     cdef float[:, :, :, ::1] volume
     cdef float[:, :, ::1] sdf_weight_data
     cdef float[:, :, ::1] color_weight_data
-
-    def __init__(self, bbox, viewport_height, viewport_width, resolution, resolution_factor):
+    cdef int volume_shape[4]
+    cdef bint reduced
+    cdef uint8_t[:, :, :, ::1] color_data
+    cdef uint16_t[:, :, ::1] half_sdf_data
+    cdef uint16_t[:, :, ::1] sdf_weight_counts
+    cdef uint16_t[:, :, ::1] color_weight_counts
+
+    def __init__(self, bbox, viewport_height, viewport_width, resolution, resolution_factor,
+                 precision="full"):
         assert resolution > 0
         assert resolution_factor > 0
+        assert precision in ("full", "reduced")
         self.max_distance = resolution * resolution_factor
 
         self.bbox = bbox.astype(np.float32)
@@ -32,6 +92,22 @@ cdef class ColorSDFVolume:
         volume_size = np.diff(bbox, axis=1)
         volume_shape = volume_size.ravel() / self.resolution
         volume_shape = np.ceil(volume_shape).astype(np.int32).tolist()
+        self.volume_shape = volume_shape + [4]
+
+        # The reduced precision volume stores uint8 colors, float16 sdf bits
+        # and saturating uint16 weight counters (9 instead of 24 bytes per
+        # voxel). The running averages are computed in float32 and rounded
+        # once per update.
+        self.reduced = precision == "reduced"
+        if self.reduced:
+            self.color_data = np.zeros(volume_shape + [3], dtype=np.uint8)
+            self.half_sdf_data = np.full(
+                volume_shape, np.float16(self.max_distance).view(np.uint16),
+                dtype=np.uint16)
+            self.sdf_weight_counts = np.zeros(volume_shape, dtype=np.uint16)
+            self.color_weight_counts = np.zeros(volume_shape, dtype=np.uint16)
+            return
+
         self.volume = np.zeros(volume_shape + [4],
                                dtype=np.float32)
 
@@ -40,57 +116,68 @@ cdef class ColorSDFVolume:
         self.sdf_weight_data = np.zeros(volume_shape, dtype=np.float32)
         self.color_weight_data = np.zeros(volume_shape, dtype=np.float32)
 
-    def get_volume(self):
-        return np.array(self.volume)
+    def get_volume(self, copy=True):
+        # With copy=False, a view of the volume without copying, which
+        # follows its later updates. The float32 volume of a reduced volume
+        # is assembled from its colors and sdf, which is always a new array.
+        if self.reduced:
+            volume = np.empty(list(self.volume_shape), dtype=np.float32)
+            volume[..., :-1] = self.color_data
+            volume[..., -1] = np.asarray(self.half_sdf_data).view(np.float16)
+            return volume
+        return np.array(self.volume, copy=copy)
 
     def fuse(self,
              np.float32_t[:, ::1] transform_matrix,
              np.float32_t[:, ::1] depth_map,
-             np.float32_t[:, :, ::1] color_map):
+             color_t[:, :, ::1] color_map,
+             int num_threads=1):
+        # The color map is float32 or uint8, RGB or RGBA.
+        assert color_map.shape[2] in (NUM_COLORS, NUM_COLORS + 1)
+        assert num_threads > 0
 
-        assert color_map.shape[2] == self.volume.shape[3]-1
-
-        cdef int i, j, k
+        cdef int i, j, k, ch, r
         cdef float x, y, z
         cdef float x_clip, y_clip, z_clip, w_clip
+        cdef float x_clip_xy, y_clip_xy, z_clip_xy, w_clip_xy
         cdef float x_ndc, y_ndc
         cdef int x_screen, y_screen
 
     
         cdef float depth ## measured depth in depth map
-        cdef float signed_distance, truncated_signed_distance
+        cdef float signed_distance, truncated_distance
         cdef float prior_sdf_weight, prior_color_weight,new_sdf_weight, new_color_weight
 
-        for i in range(self.volume.shape[0]):
+        # The z terms of the clip coordinates only depend on the slice along
+        # z, so they are computed once per frame, and the x and y terms once
+        # per column. The sums are evaluated in the same order as the full
+        # matrix product, so the clip coordinates are identical to it.
+        cdef float[:, ::1] z_table = np.empty((self.volume_shape[2], 4),
+                                              dtype=np.float32)
+        for k in range(self.volume_shape[2]):
+            z = self.bbox[2, 0] + k * self.resolution
+            for r in range(4):
+                z_table[k, r] = transform_matrix[r, 2] * z
+
+        # Every voxel is only written by the iteration that owns it, so the
+        # slices along x are fused in parallel without the GIL.
+        for i in prange(self.volume_shape[0], nogil=True,
+                        schedule="static", num_threads=num_threads):
             x = self.bbox[0, 0] + i * self.resolution
-            for j in range(self.volume.shape[1]):
+            for j in range(self.volume_shape[1]):
                 y = self.bbox[1, 0] + j * self.resolution
-                for k in range(self.volume.shape[2]):
-                    z = self.bbox[2, 0] + k * self.resolution
+                x_clip_xy = transform_matrix[0, 0] * x + transform_matrix[0, 1] * y
+                y_clip_xy = transform_matrix[1, 0] * x + transform_matrix[1, 1] * y
+                z_clip_xy = transform_matrix[2, 0] * x + transform_matrix[2, 1] * y
+                w_clip_xy = transform_matrix[3, 0] * x + transform_matrix[3, 1] * y
+                for k in range(self.volume_shape[2]):
 
-                    
                     # compute the coords in the clip volume
-                    x_clip = transform_matrix[0, 0] * x + \
-                                   transform_matrix[0, 1] * y + \
-                                   transform_matrix[0, 2] * z + \
-                                   transform_matrix[0, 3]
-
-                    y_clip = transform_matrix[1, 0] * x + \
-                                   transform_matrix[1, 1] * y + \
-                                   transform_matrix[1, 2] * z + \
-                                   transform_matrix[1, 3]
-
-                    z_clip = transform_matrix[2, 0] * x + \
-                                   transform_matrix[2, 1] * y + \
-                                   transform_matrix[2, 2] * z + \
-                                   transform_matrix[2, 3]
-
-                    w_clip = transform_matrix[3, 0] * x + \
-                                   transform_matrix[3, 1] * y + \
-                                   transform_matrix[3, 2] * z + \
-                                   transform_matrix[3, 3]
-
-                    
+                    x_clip = (x_clip_xy + z_table[k, 0]) + transform_matrix[0, 3]
+                    y_clip = (y_clip_xy + z_table[k, 1]) + transform_matrix[1, 3]
+                    z_clip = (z_clip_xy + z_table[k, 2]) + transform_matrix[2, 3]
+                    w_clip = (w_clip_xy + z_table[k, 3]) + transform_matrix[3, 3]
+
                     # ignore invisible point which has positive z value
                     if w_clip <= 0:
                         continue
@@ -109,6 +196,11 @@ cdef class ColorSDFVolume:
                     x_screen = <int>round((self.viewport_width * x_ndc + self.viewport_width)*0.5)
                     y_screen = <int>round((self.viewport_height * y_ndc + self.viewport_height)*0.5)
 
+                    # x_ndc = 1 and y_ndc = -1 round to one pixel past the
+                    # border of the depth map.
+                    if x_screen >= self.viewport_width or y_screen <= 0:
+                        continue
+
 
                     # Extract depth of visible surface
                     depth = depth_map[self.viewport_height-y_screen, x_screen] ## the index of y need to be flipped
@@ -116,6 +208,16 @@ cdef class ColorSDFVolume:
                     # w_clip = -z_e, w_clip is the distance between the point to the camera in the camera coords space
                     signed_distance = depth-w_clip
 
+                    if self.reduced:
+                        update_color_sdf_reduced(
+                            &self.color_data[i, j, k, 0],
+                            &self.half_sdf_data[i, j, k],
+                            &self.sdf_weight_counts[i, j, k],
+                            &self.color_weight_counts[i, j, k],
+                            signed_distance, self.max_distance, color_map,
+                            x_screen, self.viewport_height-y_screen)
+                        continue
+
                     ## sdf fusion
                     if signed_distance >= -self.max_distance:
 
@@ -137,7 +239,7 @@ cdef class ColorSDFVolume:
                     prior_color_weight = self.color_weight_data[i,j,k]
                     new_color_weight = prior_color_weight+1.0
 
-                    for ch in range(color_map.shape[2]):
+                    for ch in range(NUM_COLORS):
                         self.volume[i, j, k, ch] = min((prior_color_weight * self.volume[i,j,k,ch] + 1.0 *  color_map[self.viewport_height-y_screen, x_screen, ch])/new_color_weight, 255.0)
 
                     self.color_weight_data[i,j,k] = new_color_weight
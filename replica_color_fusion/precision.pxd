@@ -0,0 +1,109 @@
+#cython: boundscheck=False
+#cython: initializedcheck=False
+#cython: cdivision=True
+
+from libc.stdint cimport uint8_t, uint16_t, uint32_t
+from libc.string cimport memcpy
+
+
+# Reduced precision storage (precision="reduced"), values are accumulated in
+# float32 and rounded once per update:
+# - tsdf votes are float16, sums of the default votes (multiples of 0.5) are
+#   exact up to 1024, larger sums have a relative error of 2^-11 per update
+#   and stop growing at 2048 (1 votes) or 1024 (0.5 free space votes), label
+#   probabilities are rounded to a relative error of 2^-11 per update.
+# - color sdf volumes store uint8 colors, a float16 sdf and uint16 weights (9
+#   instead of 24 bytes per voxel). The sdf has a relative error of at most
+#   2^-11 per update (< 5e-5m for max_distance 0.1m), colors are rounded to
+#   the nearest integer after every update (up to 0.5 per update, damped by
+#   the weight of later updates, ~1 in practice) and the weights saturate at
+#   MAX_WEIGHT observations.
+
+
+# Largest value of the saturating uint16 weight counters.
+cdef enum:
+    MAX_WEIGHT = 65535
+
+
+# The element types of the color maps, so that uint8 images are fused as they
+# are loaded, without a float32 copy.
+ctypedef fused color_t:
+    float
+    uint8_t
+
+
+cdef inline uint16_t float_to_half(float value) noexcept nogil:
+    # Convert to the bits of the nearest IEEE 754 half precision float, ties
+    # are rounded to even like numpy's float32 to float16 conversion.
+    cdef uint32_t bits, sign, exponent, mantissa, shift, remainder, halfway
+    cdef uint16_t result
+
+    memcpy(&bits, &value, 4)
+    sign = (bits >> 16) & 0x8000
+    bits &= 0x7fffffff
+
+    # NaN and infinity.
+    if bits >= 0x7f800000:
+        if bits > 0x7f800000:
+            return sign | 0x7e00
+        return sign | 0x7c00
+
+    # Values from 65520 on round to infinity.
+    if bits >= 0x477ff000:
+        return sign | 0x7c00
+
+    # Normal half floats, rebias the exponent from 127 to 15.
+    if bits >= 0x38800000:
+        bits -= 0x38000000
+        return sign | ((bits + 0x0fff + ((bits >> 13) & 1)) >> 13)
+
+    # Values up to 2^-25 round to zero.
+    if bits <= 0x33000000:
+        return sign
+
+    # Subnormal half floats.
+    exponent = bits >> 23
+    mantissa = (bits & 0x7fffff) | 0x800000
+    shift = 126 - exponent
+    result = mantissa >> shift
+    remainder = mantissa & ((1 << shift) - 1)
+    halfway = 1 << (shift - 1)
+    if remainder > halfway or (remainder == halfway and (result & 1)):
+        result += 1
+    return sign | result
+
+
+cdef inline float half_to_float(uint16_t value) noexcept nogil:
+    cdef uint32_t bits
+    cdef uint32_t sign = (<uint32_t>value & 0x8000) << 16
+    cdef uint32_t exponent = (value >> 10) & 0x1f
+    cdef uint32_t mantissa = value & 0x3ff
+    cdef float result
+
+    if exponent == 0x1f:
+        bits = sign | 0x7f800000 | (mantissa << 13)
+    elif exponent == 0:
+        # Zero and subnormal half floats, mantissa * 2^-24.
+        result = mantissa * 5.9604644775390625e-08
+        if sign:
+            return -result
+        return result
+    else:
+        bits = sign | ((exponent + 112) << 23) | (mantissa << 13)
+
+    memcpy(&result, &bits, 4)
+    return result
+
+
+cdef inline uint8_t float_to_uint8(float value) noexcept nogil:
+    # Round to the nearest integer in [0, 255].
+    if value <= 0:
+        return 0
+    if value >= 255:
+        return 255
+    return <uint8_t>(value + 0.5)
+
+
+cdef inline void increment_weight(uint16_t* weight) noexcept nogil:
+    if weight[0] < MAX_WEIGHT:
+        weight[0] += 1
@@ -0,0 +1,57 @@
+import collections
+import concurrent.futures
+import numpy as np
+
+
+def load_npz(path):
+    # np.load only decompresses the arrays of an npz file on access, so read
+    # them all to do the decompression in the loading thread.
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def frame_nbytes(frame):
+    if isinstance(frame, dict):
+        frame = list(frame.values())
+    if isinstance(frame, (list, tuple)):
+        return sum(frame_nbytes(value) for value in frame)
+    return getattr(frame, "nbytes", 0)
+
+
+def prefetch(load, items, queue_depth=0, num_workers=1, max_memory_mb=None):
+    # Yield load(item) for all items in order. While a frame is being fused,
+    # up to queue_depth of the following frames are loaded in a pool of
+    # num_workers threads (decompression and image decoding release the GIL).
+    # With max_memory_mb, the queue is shortened so that the prefetched
+    # frames, estimated from the size of the last frame, fit into it. A queue
+    # depth of 0 loads every frame when it is needed.
+    assert queue_depth >= 0
+    assert num_workers > 0
+
+    if queue_depth == 0:
+        for item in items:
+            yield load(item)
+        return
+
+    items = iter(items)
+    end = object()
+    pending = collections.deque()
+    max_pending = queue_depth
+
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        while True:
+            while len(pending) < max_pending:
+                item = next(items, end)
+                if item is end:
+                    break
+                pending.append(executor.submit(load, item))
+
+            if not pending:
+                return
+
+            frame = pending.popleft().result()
+            if max_memory_mb is not None:
+                max_pending = int(max_memory_mb * 2**20 //
+                                  max(frame_nbytes(frame), 1))
+                max_pending = min(max(max_pending, 1), queue_depth)
+            yield frame
@@ -3,7 +3,7 @@ import glob
 import argparse
 import numpy as np
 import plyfile
-from observation_volume_from_2D_cameras import ObservedVolume
+from backends import BACKENDS, volume_class
 from quaternion_util import quat_from_two_vectors, quat_rotate_vector
 
 def parse_args():
@@ -12,6 +12,11 @@ def parse_args():
     parser.add_argument("--scene_path", required=True)
     parser.add_argument("--viewport_height", type=int, default=480)
     parser.add_argument("--viewport_width", type=int, default=640)
+    parser.add_argument("--num_threads", type=int, default=1)
+    # The visibility backend, auto uses the compiled kernel if it can be
+    # imported and the NumPy engine otherwise, see backends.py.
+    parser.add_argument("--backend", choices=["auto"] + list(BACKENDS),
+                        default="auto")
     return parser.parse_args()
 
 
@@ -41,6 +46,7 @@ def main():
 
     rotated_points = np.asarray(rotated_points, dtype=np.float32)
 
+    ObservedVolume = volume_class("ObservedVolume", args.backend)
     observed_volume = ObservedVolume(args.viewport_height, args.viewport_width, rotated_points)
 
     
@@ -62,11 +68,12 @@ def main():
  
 
         
-        observed_volume.fuse(transform_matrix, depth_map)
+        observed_volume.fuse(transform_matrix, depth_map,
+                             num_threads=args.num_threads)
 
 
 
-    observed_volume_flag = observed_volume.get_volume()
+    observed_volume_flag = observed_volume.get_volume(copy=False)
     num_observed_vertex = np.sum(observed_volume_flag)
     coverage = num_observed_vertex/num_vertex
     print("There are {} covered points among the {} points in the scene".format(num_observed_vertex, num_vertex))
@@ -0,0 +1,70 @@
+import numpy as np
+
+
+# NumPy version of ObservedVolume (observation_volume_from_2D_cameras), which
+# only needs NumPy, see backends.py. The points are projected in chunks of
+# chunk_size points with the float32 arithmetic of the kernel.
+
+
+def round_half_away(values):
+    # libc round of float32 values.
+    values = values.astype(np.float64)
+    return np.copysign(np.floor(np.abs(values) + 0.5), values)
+
+
+class ObservedVolume:
+
+    def __init__(self, viewport_height, viewport_width, coords,
+                 chunk_size=65536):
+        assert coords.shape[1] == 3
+        assert chunk_size > 0
+        self.viewport_height = viewport_height
+        self.viewport_width = viewport_width
+        self.coords = coords.astype(np.float32)
+        self.chunk_size = chunk_size
+        self.observed = np.zeros([self.coords.shape[0]], dtype=np.int32)
+
+    def get_volume(self, copy=True):
+        return np.array(self.observed, copy=copy)
+
+    def fuse(self, transform_matrix, depth_map, num_threads=1):
+        # num_threads is accepted for the kernel signature, the chunks are
+        # processed by NumPy in the calling thread.
+        transform_matrix = np.asarray(transform_matrix, dtype=np.float32)
+        depth_map = np.asarray(depth_map, dtype=np.float32)
+        width = np.float32(self.viewport_width)
+        height = np.float32(self.viewport_height)
+
+        with np.errstate(divide="ignore", over="ignore", invalid="ignore"):
+            for begin in range(0, self.coords.shape[0], self.chunk_size):
+                coords = self.coords[begin:begin + self.chunk_size]
+                x, y, z = coords[:, 0], coords[:, 1], coords[:, 2]
+
+                # The clip coordinates, inside of the view frustum.
+                x_clip, y_clip, z_clip, w_clip = [
+                    transform_matrix[r, 0] * x + transform_matrix[r, 1] * y +
+                    transform_matrix[r, 2] * z + transform_matrix[r, 3]
+                    for r in range(4)]
+                visible = (w_clip > 0) & \
+                    (x_clip >= -w_clip) & (x_clip <= w_clip) & \
+                    (y_clip >= -w_clip) & (y_clip <= w_clip) & \
+                    (z_clip >= -w_clip) & (z_clip <= w_clip)
+
+                # The viewport transform, x_ndc = 1 and y_ndc = -1 round to
+                # one past the border of the depth map.
+                x_screen = round_half_away(
+                    (width * (x_clip / w_clip) + width).astype(np.float64) *
+                    0.5)
+                y_screen = round_half_away(
+                    (height * (y_clip / w_clip) + height).astype(np.float64) *
+                    0.5)
+                visible &= (x_screen >= 0) & (x_screen < width) & \
+                    (y_screen > 0) & (y_screen <= height)
+                row = np.where(visible, self.viewport_height - y_screen,
+                               0).astype(np.intp)
+                column = np.where(visible, x_screen, 0).astype(np.intp)
+
+                depth = depth_map[row, column]
+                observed = visible & \
+                    (np.abs(w_clip - depth).astype(np.float64) <= 1e-2)
+                self.observed[begin:begin + self.chunk_size][observed] = 1
@@ -5,6 +5,7 @@
 import numpy as np
 cimport numpy as np
 from libc.math cimport round
+from cython.parallel cimport prange
 
 cdef class ObservedVolume:
 
@@ -27,14 +28,19 @@ cdef class ObservedVolume:
         self.observed= np.zeros([num_point],
                                dtype=np.int32)
 
-    def get_volume(self):
-        return np.array(self.observed)
+    def get_volume(self, copy=True):
+        # With copy=False, a view of the volume without copying, which
+        # follows its later updates.
+        return np.array(self.observed, copy=copy)
 
     def fuse(self,
              np.float32_t[:, ::1] transform_matrix,
-             np.float32_t[:, ::1] depth_map):
+             np.float32_t[:, ::1] depth_map,
+             int num_threads=1):
+        assert num_threads > 0
 
 
+        cdef int i
         cdef float x, y, z
         cdef float x_clip, y_clip, z_clip, w_clip
         cdef float x_ndc, y_ndc
@@ -43,7 +49,10 @@ cdef class ObservedVolume:
     
         cdef float depth ## measured depth in depth map
 
-        for i in range(self.coords.shape[0]):
+        # Every point is only written by the iteration that owns it, so the
+        # points are processed in parallel without the GIL.
+        for i in prange(self.coords.shape[0], nogil=True,
+                        schedule="static", num_threads=num_threads):
 
             if self.observed[i] == 1:
                 continue
@@ -93,6 +102,12 @@ cdef class ObservedVolume:
             x_screen = <int>round((self.viewport_width * x_ndc + self.viewport_width)*0.5)
             y_screen = <int>round((self.viewport_height * y_ndc + self.viewport_height)*0.5)
 
+            # x_ndc = 1 and y_ndc = -1 round to one past the border of the
+            # depth map.
+            if (x_screen < 0 or x_screen >= self.viewport_width or y_screen <= 0 or
+                y_screen > self.viewport_height):
+                continue
+
             # Extract depth of visible surface
 
             depth = depth_map[self.viewport_height-y_screen, x_screen] ## the index of y need to be flipped
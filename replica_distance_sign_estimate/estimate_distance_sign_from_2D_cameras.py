@@ -4,7 +4,7 @@ import argparse
 import numpy as np
 import plyfile
 import json
-from freespace_volume_from_2D_cameras import FreespaceVolume
+from backends import BACKENDS, volume_class
 
 selected_classes = ['wall', 'floor', 'cabinet', 'bed', 'chair', 'sofa', 'table', 'door', 'window', 'shelf', 
     'rug', 'blinds', 'lamp', 'refrigerator', 'cushion', 'ceiling', 'wall-cabinet']
@@ -27,6 +27,11 @@ def parse_args():
     parser.add_argument("--viewport_height", type=int, default=480)
     parser.add_argument("--viewport_width", type=int, default=640)
     parser.add_argument("--truncated_distance", type=float, default=0.1)
+    parser.add_argument("--num_threads", type=int, default=1)
+    # The visibility backend, auto uses the compiled kernel if it can be
+    # imported and the NumPy engine otherwise, see backends.py.
+    parser.add_argument("--backend", choices=["auto"] + list(BACKENDS),
+                        default="auto")
     return parser.parse_args()
 
 
@@ -53,6 +58,7 @@ def main():
     ##################################
 
 
+    FreespaceVolume = volume_class("FreespaceVolume", args.backend)
     observed_volume = FreespaceVolume(args.viewport_height, args.viewport_width, coords)
 
     
@@ -75,11 +81,12 @@ def main():
         depth_map = np.load(depth_map_path)['depth']
 
         
-        observed_volume.fuse(transform_matrix, depth_map)
+        observed_volume.fuse(transform_matrix, depth_map,
+                             num_threads=args.num_threads)
 
 
 
-    observed_volume_flag = observed_volume.get_volume()
+    observed_volume_flag = observed_volume.get_volume(copy=False)
 
     valid_coords = []
     valid_distance_to_mesh = []
@@ -5,6 +5,7 @@
 import numpy as np
 cimport numpy as np
 from libc.math cimport round
+from cython.parallel cimport prange
 from libc.stdio cimport printf
 cdef class FreespaceVolume:
 
@@ -27,14 +28,19 @@ cdef class FreespaceVolume:
         self.observed= np.zeros([num_point],
                                dtype=np.int32)
 
-    def get_volume(self):
-        return np.array(self.observed)
+    def get_volume(self, copy=True):
+        # With copy=False, a view of the volume without copying, which
+        # follows its later updates.
+        return np.array(self.observed, copy=copy)
 
     def fuse(self,
              np.float32_t[:, ::1] transform_matrix,
-             np.float32_t[:, ::1] depth_map):
+             np.float32_t[:, ::1] depth_map,
+             int num_threads=1):
+        assert num_threads > 0
 
 
+        cdef int i
         cdef float x, y, z
         cdef float x_clip, y_clip, z_clip, w_clip
         cdef float x_ndc, y_ndc
@@ -43,7 +49,10 @@ cdef class FreespaceVolume:
     
         cdef float depth ## measured depth in depth map
 
-        for i in range(self.coords.shape[0]):
+        # Every point is only written by the iteration that owns it, so the
+        # points are processed in parallel without the GIL.
+        for i in prange(self.coords.shape[0], nogil=True,
+                        schedule="static", num_threads=num_threads):
 
             if self.observed[i] == 1:
                 continue
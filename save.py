@@ -2,6 +2,18 @@ import numpy as np
 import struct
 import sys
 
+def dat_layout(data):
+    # The [num_labels, X, Y, Z] axis order of the grids in the .dat files, as
+    # a view of an [X, Y, Z, num_labels] volume without copying.
+    return data.transpose(3, 0, 1, 2)
+
+def write_dat_grid(fid, data):
+    # Write the grid in the .dat layout one label at a time, so that only one
+    # label of the volume is copied at once, e.g. for a view returned by
+    # get_volume(copy=False).
+    for label_grid in dat_layout(data):
+        fid.write(np.ascontiguousarray(label_grid).data)
+
 def write_dat_groundtruth(data, outfile):
 
     with open(outfile, "wb") as fid:
@@ -28,8 +40,7 @@ def write_dat_groundtruth(data, outfile):
         fid.write(struct.pack("I", data_shape[2]))
         
         # Write the grid to file
-        data_trans = data.transpose(3, 0, 1, 2)
-        fid.write(data_trans.tobytes())
+        write_dat_grid(fid, data)
         fid.close()
 
     return
@@ -59,8 +70,7 @@ def write_dat_datacost(data, outfile):
         fid.write(struct.pack("I", data_shape[2]))
         
         # Write the grid to file
-        data_trans = data.transpose(3, 0, 1, 2)
-        fid.write(data_trans.tobytes())
+        write_dat_grid(fid, data)
         fid.close()
 
     return
\ No newline at end of file
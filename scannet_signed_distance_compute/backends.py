@@ -0,0 +1,51 @@
+import importlib
+import collections
+
+
+# The modules that implement the visibility volume of every backend, in the
+# order in which "auto" tries them: the compiled Cython kernel, then the NumPy
+# engine, which runs wherever NumPy does.
+BACKENDS = collections.OrderedDict([
+    ("cython", {
+        "ObservationVolume": "observation_volume_from_2D_cameras",
+    }),
+    ("numpy", {
+        "ObservationVolume": "numpy_observation_volume",
+    }),
+])
+
+
+def register_backend(name, modules):
+    # Add a backend, modules maps the names of the volume classes that it
+    # implements to the modules that define them.
+    BACKENDS[name] = dict(modules)
+
+
+def available_backends(name):
+    # The backends whose module of the volume class name can be imported.
+    backends = []
+    for backend, modules in BACKENDS.items():
+        if name not in modules:
+            continue
+        try:
+            importlib.import_module(modules[name])
+        except ImportError:
+            continue
+        backends.append(backend)
+    return backends
+
+
+def volume_class(name, backend="auto"):
+    # The volume class name of a backend. "auto" picks the first backend that
+    # can be imported, e.g. the NumPy engine if the extensions are not built
+    # for this interpreter.
+    if backend == "auto":
+        backends = available_backends(name)
+        if not backends:
+            raise ImportError("No available backend implements {}".format(
+                name))
+        backend = backends[0]
+    if name not in BACKENDS[backend]:
+        raise ImportError("The {} backend does not implement {}".format(
+            backend, name))
+    return getattr(importlib.import_module(BACKENDS[backend][name]), name)
@@ -5,7 +5,7 @@ import numpy as np
 import plyfile
 import json
 import skimage.io
-from observation_volume_from_2D_cameras import ObservationVolume
+from backends import BACKENDS, volume_class
 
 def create_color_palette():
     return [
@@ -90,6 +90,11 @@ def parse_args():
     parser.add_argument("--visualization", type=bool, default=False)
     parser.add_argument("--visual_output_file", type=str, default='mesh_vis.ply')
     parser.add_argument("--truncated_distance", type=float, default=0.1)
+    parser.add_argument("--num_threads", type=int, default=1)
+    # The visibility backend, auto uses the compiled kernel if it can be
+    # imported and the NumPy engine otherwise, see backends.py.
+    parser.add_argument("--backend", choices=["auto"] + list(BACKENDS),
+                        default="auto")
     return parser.parse_args()
 
 
@@ -135,6 +140,7 @@ def main():
     ##################################
 
 
+    ObservationVolume = volume_class("ObservationVolume", args.backend)
     observed_volume = ObservationVolume(coords)
     pose_paths = sorted(glob.glob(os.path.join(args.scene_path, "sensor/*.pose.txt")))
     num_frames = len(pose_paths)
@@ -158,11 +164,12 @@ def main():
         depth_map = skimage.io.imread(depth_map_path)
         depth_map = depth_map.astype(np.float32) / 1000
 
-        observed_volume.fuse(depth_proj_matrix, depth_map)
+        observed_volume.fuse(depth_proj_matrix, depth_map,
+                             num_threads=args.num_threads)
 
 
 
-    front_of_camera = observed_volume.get_volume()
+    front_of_camera = observed_volume.get_volume(copy=False)
 
     valid_coords = []
     valid_nearest_point_in_mesh = []
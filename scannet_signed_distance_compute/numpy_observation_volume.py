@@ -0,0 +1,57 @@
+import numpy as np
+
+
+# NumPy version of ObservationVolume (observation_volume_from_2D_cameras),
+# which only needs NumPy, see backends.py. The points are projected in chunks
+# of chunk_size points with the float32 arithmetic of the kernel.
+
+
+def round_half_away(values):
+    # libc round of float32 values.
+    values = values.astype(np.float64)
+    return np.copysign(np.floor(np.abs(values) + 0.5), values)
+
+
+class ObservationVolume:
+
+    def __init__(self, coords, chunk_size=65536):
+        assert coords.shape[1] == 3
+        assert chunk_size > 0
+        self.coords = coords.astype(np.float32)
+        self.chunk_size = chunk_size
+        self.front_of_camera = np.zeros([self.coords.shape[0]],
+                                        dtype=np.int32)
+
+    def get_volume(self, copy=True):
+        return np.array(self.front_of_camera, copy=copy)
+
+    def fuse(self, depth_proj_matrix, depth_map, num_threads=1):
+        # num_threads is accepted for the kernel signature, the chunks are
+        # processed by NumPy in the calling thread.
+        depth_proj_matrix = np.asarray(depth_proj_matrix, dtype=np.float32)
+        depth_map = np.asarray(depth_map, dtype=np.float32)
+
+        with np.errstate(divide="ignore", over="ignore", invalid="ignore"):
+            for begin in range(0, self.coords.shape[0], self.chunk_size):
+                coords = self.coords[begin:begin + self.chunk_size]
+                x, y, z = coords[:, 0], coords[:, 1], coords[:, 2]
+
+                # The projection of the points, in front of the camera.
+                depth_proj_x, depth_proj_y, depth_proj_z = [
+                    depth_proj_matrix[r, 0] * x + depth_proj_matrix[r, 1] * y +
+                    depth_proj_matrix[r, 2] * z + depth_proj_matrix[r, 3]
+                    for r in range(3)]
+                valid = depth_proj_z > 0
+
+                # The pixel location of the points, inside of the image.
+                pixel_x = round_half_away(depth_proj_x / depth_proj_z)
+                pixel_y = round_half_away(depth_proj_y / depth_proj_z)
+                valid &= (pixel_x >= 0) & (pixel_y >= 0) & \
+                    (pixel_x < depth_map.shape[1]) & \
+                    (pixel_y < depth_map.shape[0])
+                row = np.where(valid, pixel_y, 0).astype(np.intp)
+                column = np.where(valid, pixel_x, 0).astype(np.intp)
+
+                depth = depth_map[row, column]
+                front = valid & (depth_proj_z < depth)
+                self.front_of_camera[begin:begin + self.chunk_size][front] = 1
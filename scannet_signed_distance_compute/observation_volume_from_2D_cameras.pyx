@@ -5,6 +5,7 @@
 import numpy as np
 cimport numpy as np
 from libc.math cimport round
+from cython.parallel cimport prange
 from libc.stdio cimport printf
 
 cdef class ObservationVolume:
@@ -21,21 +22,29 @@ cdef class ObservationVolume:
         self.front_of_camera = np.zeros([num_point],
                                dtype=np.int32)
 
-    def get_volume(self):
-        return np.array(self.front_of_camera)
+    def get_volume(self, copy=True):
+        # With copy=False, a view of the volume without copying, which
+        # follows its later updates.
+        return np.array(self.front_of_camera, copy=copy)
 
     def fuse(self,
              np.float32_t[:, ::1] depth_proj_matrix,
-             np.float32_t[:, ::1] depth_map):
+             np.float32_t[:, ::1] depth_map,
+             int num_threads=1):
+        assert num_threads > 0
 
 
+        cdef int i
         cdef float x, y, z
         cdef float depth_proj_x, depth_proj_y, depth_proj_z
         cdef int depth_image_proj_x, depth_image_proj_y
         cdef float depth
  
 
-        for i in range(self.coords.shape[0]):
+        # Every point is only written by the iteration that owns it, so the
+        # points are processed in parallel without the GIL.
+        for i in prange(self.coords.shape[0], nogil=True,
+                        schedule="static", num_threads=num_threads):
 
             if self.front_of_camera[i] == 1:
                 continue
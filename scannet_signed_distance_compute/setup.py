@@ -1,14 +1,49 @@
+import os
 import sys
+import shutil
+import tempfile
 from distutils.core import setup
 from distutils.extension import Extension
+from distutils.ccompiler import new_compiler
+from distutils.sysconfig import customize_compiler
+from distutils.errors import CompileError, LinkError
 from Cython.Build import cythonize
 import numpy as np
 
+
+def openmp_flags():
+    # Returns the flags to build with OpenMP, or no flags if the compiler does
+    # not support it, in which case the prange loops are compiled serially.
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        source_path = os.path.join(tmp_dir, "check_openmp.c")
+        with open(source_path, "w") as fid:
+            fid.write("#include <omp.h>\n"
+                      "int main(void) { return omp_get_max_threads() < 1; }\n")
+        objects = compiler.compile([source_path], output_dir=tmp_dir,
+                                   extra_postargs=["-fopenmp"])
+        compiler.link_executable(objects,
+                                 os.path.join(tmp_dir, "check_openmp"),
+                                 extra_postargs=["-fopenmp"])
+    except (CompileError, LinkError):
+        print("OpenMP is not available, building serial fusion kernels")
+        return []
+    finally:
+        shutil.rmtree(tmp_dir)
+    return ["-fopenmp"]
+
+
 sys.argv[1:] = ["build_ext", "--inplace"]
 
+openmp_args = openmp_flags()
+
 ext_modules = [
     Extension("observation_volume_from_2D_cameras", ["observation_volume_from_2D_cameras.pyx"],
-    		  include_dirs=[np.get_include()]),
+              include_dirs=[np.get_include()],
+              extra_compile_args=openmp_args,
+              extra_link_args=openmp_args),
 ]
 
 setup(ext_modules=cythonize(ext_modules))